@@ -13,8 +13,27 @@ import datetime
 import sys
 import re
 from typing import Dict, List, Tuple, Optional, Any, Union
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from dataclasses import dataclass
 import json
+import queue
+import asyncio
+import functools
+import bisect
+import heapq
+import argparse
+import csv
+import hashlib
+import shutil
+import tempfile
+import zipfile
+import zlib
+import mmap
+import gc
+import struct
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -45,6 +64,77 @@ MUTE_TIME = 60 * 60 * 24  # Время мута по умолчанию (24 ча
 FLOOD_THRESHOLD = 5     # Количество сообщений для обнаружения флуда
 FLOOD_TIME = 5          # Временное окно для обнаружения флуда (секунды)
 FLOOD_MUTE_TIME = 60 * 15  # Время мута за флуд (15 минут)
+FLOOD_STRATEGY = 'sliding_log'  # Алгоритм антифлуда по умолчанию: sliding_log или token_bucket
+NEWCOMER_FLOOD_THRESHOLD = 3    # Количество сообщений для обнаружения флуда у новичков
+NEWCOMER_PERIOD = 60 * 60 * 24  # Сколько секунд после вступления участник считается новичком
+RATE_LIMIT_MAX_MESSAGES = 100   # Максимальный лимит сообщений в правиле антифлуда
+RATE_LIMIT_MAX_PERIOD = 60 * 60  # Максимальное окно правила антифлуда (секунды)
+RATE_LIMIT_SWEEP_INTERVAL = 60  # Интервал очистки состояний антифлуда молчащих пользователей (секунды)
+
+# Защита от рейдов (много аккаунтов одновременно); в группе включается командой /raid on
+RAID_WINDOW = 60                # Окно подсчета активности чата (секунды)
+RAID_DUPLICATE_USERS = 5        # Сколько разных участников с одинаковым текстом в окне - рейд
+RAID_MIN_TEXT_LENGTH = 20       # Более короткие сообщения ("привет", "+") не сравниваются между участниками
+RAID_MAX_DISTANCE = 7           # Сколько бит SimHash могут различаться у «одинаковых» сообщений рейда
+RAID_JOIN_LIMIT = 15            # Сколько вступлений в окне - рейд
+RAID_MESSAGE_LIMIT = 300        # Сколько сообщений чата в окне - рейд
+RAID_LOCKDOWN_TIME = 60 * 10    # На сколько закрывать чат при рейде (секунды)
+RAID_MUTE_TIME = 60 * 60 * 24   # Мут участников рейда (секунды)
+RAID_SWEEP_INTERVAL = 60        # Интервал очистки активности молчащих чатов (секунды)
+
+# Типы нарушений умных предупреждений
+VIOLATION_TYPES = ('spam', 'obscenity', 'rudeness', 'flood')
+
+# Словарь ключевых слов нарушений (дополняется владельцами через /lexicon)
+LEXICON_MAX_TERMS = 50000       # Максимум слов в словаре сверх встроенных
+LEXICON_MAX_TERM_LENGTH = 64    # Максимальная длина слова или фразы словаря (символы)
+
+# Алгоритмы антифлуда и классы участников с отдельными правилами
+RATE_LIMIT_STRATEGIES = ('sliding_log', 'token_bucket')
+USER_CLASSES = ('member', 'newcomer')
+
+# Настройки базы данных
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # Хранилище данных: sqlite или memory
+DB_POOL_SIZE = 4                # Максимальное количество соединений в пуле
+DB_POOL_TIMEOUT = 5.0           # Сколько ждать свободного соединения (секунды)
+DB_CACHE_SIZE_KB = 16384        # Размер страничного кэша SQLite на соединение (КБ)
+DB_STATEMENT_CACHE_SIZE = 256   # Количество подготовленных запросов в кэше соединения
+DB_WRITE_BATCH_SIZE = 200       # Максимум отложенных записей в одной транзакции
+DB_WRITE_INTERVAL = 0.05        # Как часто сбрасывать отложенные записи (секунды)
+DB_WRITE_QUEUE_SIZE = 5000      # Размер очереди отложенных записей
+LOOP_LAG_INTERVAL = 0.5         # Интервал замера задержки цикла событий (секунды)
+GROUP_SETTINGS_CACHE_SIZE = 1000  # Максимальное количество групп в кэше настроек
+ADMIN_CACHE_TTL = 60 * 5  # Время жизни списка администраторов чата (секунды)
+ADMIN_CACHE_RETRY = 15    # Пауза перед повтором после ошибки загрузки списка (удваивается до ADMIN_CACHE_TTL)
+USER_PROFILE_CACHE_SIZE = 50000  # Количество профилей, для которых помним последнюю запись
+ANALYSES_PAGE_SIZE = 5          # Количество результатов анализа на странице /analyses
+SEARCH_PAGE_SIZE = 5            # Количество найденных сообщений на странице /search
+SEARCH_RANK_WINDOW = 1000       # Среди скольких последних совпадений ранжировать результаты поиска
+
+# История сообщений в памяти
+MESSAGE_HISTORY_SIZE = 100      # Сколько последних сообщений пользователя помнить в каждом чате
+TRACKER_MAX_BYTES = 64 * 1024 * 1024  # Лимит памяти истории сообщений (примерно, байты)
+TRACKER_IDLE_TTL = 60 * 60      # Через сколько секунд молчания забывать историю пользователя
+TRACKER_SWEEP_INTERVAL = 60     # Интервал очистки историй молчащих пользователей (секунды)
+TRACKER_SHARDS = 16             # Число секций истории (у каждой своя блокировка и доля лимита памяти)
+TRACKER_CONTEXT_MESSAGES = 5    # Для скольких последних сообщений хранить текст (контекст анализа)
+TRACKER_CONTEXT_CHARS = 200     # Сколько символов текста хранить для контекста
+SIMHASH_MAX_CHARS = 200         # Сколько первых символов нормализованного текста учитывать в SimHash
+SIMILAR_MAX_DISTANCE = 10       # Максимальное расстояние Хэмминга (из 64 бит) между похожими сообщениями
+HISTORY_OVERHEAD_BYTES = 1792   # Примерный объем пустой истории с ключами и буферами (байты)
+TRACKER_SNAPSHOT_FILE = os.getenv("TRACKER_SNAPSHOT_FILE", "tracker.snapshot")  # Снимок истории и антифлуда
+TRACKER_SNAPSHOT_INTERVAL = 60  # Как часто сохранять снимок (секунды)
+TRACKER_RESTORE_BUDGET = 2.0    # Сколько секунд запуска можно потратить на восстановление снимка
+
+# Экспорт и импорт данных
+EXPORT_CHUNK_SIZE = 1000        # Сколько строк читать из курсора за раз при экспорте
+IMPORT_CHUNK_SIZE = 1000        # Сколько строк записывать в одной транзакции при импорте
+
+# Хранение результатов анализа
+ANALYSIS_RETENTION_DAYS = 30    # Сколько дней хранить результаты анализа (по умолчанию для группы)
+RETENTION_INTERVAL = 60 * 60    # Интервал очистки старых результатов анализа (секунды)
+RETENTION_BATCH_SIZE = 1000     # Сколько строк удалять в одной транзакции
+VACUUM_PAGES_PER_RUN = 2000     # Сколько свободных страниц возвращать системе за один проход
 
 # ---------------------- МОДЕЛИ ДАННЫХ ---------------------- #
 
@@ -53,29 +143,431 @@ import sqlite3
 from contextlib import contextmanager
 
 # Создаем соединение с базой данных
-DB_PATH = "bot.db"
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+
+class ConnectionPool:
+    def __init__(self, db_path, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        """Инициализация пула долгоживущих соединений SQLite"""
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self.hits = 0     # Соединение взято из пула
+        self.misses = 0   # Пришлось открыть новое соединение
+        self.waits = 0    # Пришлось ждать освобождения соединения
+    
+    def _connect(self):
+        """Открытие и настройка нового соединения"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def _open(self):
+        """Открытие соединения с учетом счетчика открытых соединений"""
+        with self._lock:
+            self._opened += 1
+            self.misses += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+    
+    def acquire(self):
+        """Получение соединения из пула"""
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+            return conn
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_open = self._opened < self.max_size
+            if not can_open:
+                self.waits += 1
+        
+        if can_open:
+            return self._open()
+        
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+            with self._lock:
+                self.hits += 1
+            return conn
+        except queue.Empty:
+            # Все соединения заняты (например, вложенные вызовы) - открываем временное
+            logger.warning(f"Пул соединений исчерпан ({self.max_size}), открываем дополнительное соединение")
+            return self._open()
+    
+    def release(self, conn):
+        """Возврат соединения в пул"""
+        try:
+            # Не возвращаем в пул незавершенные транзакции
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при откате транзакции: {e}")
+            self._discard(conn)
+            return
+        
+        if self._idle.qsize() >= self.max_size:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+    
+    def _discard(self, conn):
+        """Закрытие соединения, которое не возвращается в пул"""
+        with self._lock:
+            self._opened -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    
+    def close(self):
+        """Закрытие всех свободных соединений"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+    
+    def stats(self):
+        """Статистика использования пула"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'open': self._opened,
+                'idle': self._idle.qsize(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+db_pool = ConnectionPool(DB_PATH)
 
 @contextmanager
 def get_db_connection():
-    """Контекстный менеджер для соединения с базой данных"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Контекстный менеджер для соединения с базой данных из пула"""
+    conn = db_pool.acquire()
     try:
         yield conn
     finally:
-        conn.close()
+        db_pool.release(conn)
 
-def init_db():
-    """Инициализация базы данных"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+# Отдельные потоки для работы с базой, чтобы не блокировать цикл событий
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """Выполнение блокирующей функции работы с базой в потоке БД"""
+    # Хранилище в памяти не блокирует - вызываем сразу, без перехода в поток
+    if not storage.blocking:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+class DatabaseWriter:
+    def __init__(self, batch_size=DB_WRITE_BATCH_SIZE, interval=DB_WRITE_INTERVAL, max_queue=DB_WRITE_QUEUE_SIZE,
+                 pool=None):
+        """Инициализация фоновой записи в базу данных пачками"""
+        self.pool = pool or db_pool
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queue = max_queue
+        self._queue = None   # Очередь (sql, params, future); создается в start()
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self.batches = 0
+        self.written = 0
+        self.errors = 0
+    
+    @property
+    def running(self):
+        """Запущена ли фоновая запись"""
+        return self._task is not None and not self._task.done()
+    
+    async def start(self):
+        """Запуск фоновой задачи записи"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Фоновая запись в базу запущена (пачка: {self.batch_size}, интервал: {self.interval}s)")
+    
+    async def submit(self, sql, params=()):
+        """Постановка записи в очередь; возвращает future с lastrowid"""
+        future = asyncio.get_running_loop().create_future()
         
-        # Создаем таблицу настроек группы
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS group_settings (
-            id INTEGER PRIMARY KEY,
-            group_id TEXT UNIQUE,
-            welcome_message TEXT DEFAULT 'Добро пожаловать, {name}!',
+        if not self.running:
+            # Фоновая запись не запущена - пишем сразу
+            try:
+                future.set_result(self._write_batch([(sql, params, future)])[0])
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        
+        # При заполненной очереди ждем, пока писатель ее разгрузит
+        await self._queue.put((sql, params, future))
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return future
+    
+    async def flush(self):
+        """Ожидание записи всех операций, поставленных в очередь ранее"""
+        if not self.running:
+            return
+        barrier = asyncio.get_running_loop().create_future()
+        await self._queue.put((None, None, barrier))
+        self._wakeup.set()
+        await barrier
+    
+    async def stop(self):
+        """Остановка фоновой записи с сохранением всей очереди"""
+        if not self.running:
+            return
+        self._stopping = True
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Фоновая запись в базу остановлена, очередь сохранена")
+    
+    def drain_sync(self):
+        """Синхронная запись оставшейся очереди (для обработчика сигналов)"""
+        if self._queue is None:
+            return
+        ops = []
+        while True:
+            try:
+                ops.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        self._complete(ops)
+    
+    async def _run(self):
+        """Основной цикл: собираем пачку и пишем ее одной транзакцией"""
+        while True:
+            ops = [await self._queue.get()]
+            
+            # Даем пачке накопиться, если никто не ждет сброса
+            if ops[0][0] is not None and not self._stopping and self._queue.qsize() < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            
+            while len(ops) < self.batch_size:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            
+            writes = [op for op in ops if op[0] is not None]
+            results = []
+            if writes:
+                results = await run_db(self._write_batch_safe, writes)
+            self._resolve(writes, results)
+            
+            # Барьеры flush() отпускаем только после записи всего, что было до них
+            for sql, _, future in ops:
+                if sql is None and not future.done():
+                    future.set_result(None)
+    
+    def _complete(self, ops):
+        """Синхронная запись операций и завершение их future"""
+        writes = [op for op in ops if op[0] is not None]
+        self._resolve(writes, self._write_batch_safe(writes) if writes else [])
+        for sql, _, future in ops:
+            if sql is None and not future.done():
+                future.set_result(None)
+    
+    def _resolve(self, writes, results):
+        """Передача результатов записи ожидающим"""
+        for (_, _, future), result in zip(writes, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    def _write_batch(self, ops):
+        """Запись пачки операций одной транзакцией"""
+        conn = self.pool.acquire()
+        try:
+            cursor = conn.cursor()
+            results = []
+            for sql, params, _ in ops:
+                cursor.execute(sql, params)
+                results.append(cursor.lastrowid)
+            conn.commit()
+        finally:
+            self.pool.release(conn)
+        self.batches += 1
+        self.written += len(ops)
+        return results
+    
+    def _write_batch_safe(self, ops):
+        """Запись пачки; при ошибке пишем операции по одной, чтобы не терять остальные"""
+        try:
+            return self._write_batch(ops)
+        except Exception as e:
+            logger.error(f"Ошибка при записи пачки из {len(ops)} операций: {e}")
+        
+        results = []
+        for op in ops:
+            try:
+                results.append(self._write_batch([op])[0])
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка при отложенной записи в базу: {e}")
+                results.append(e)
+        return results
+    
+    def stats(self):
+        """Статистика фоновой записи"""
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'batches': self.batches,
+            'written': self.written,
+            'errors': self.errors
+        }
+
+db_writer = DatabaseWriter()
+
+# ------ Миграции схемы ------ #
+
+def _migration_initial_schema(cursor):
+    """Базовая схема: таблицы настроек, предупреждений, пользователей и анализа"""
+    # Создаем таблицу настроек группы
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS group_settings (
+        id INTEGER PRIMARY KEY,
+        group_id TEXT UNIQUE,
+        welcome_message TEXT DEFAULT 'Добро пожаловать, {name}!',
+        rules TEXT DEFAULT 'Правила не установлены!',
+        anti_flood BOOLEAN DEFAULT 1,
+        smart_warnings BOOLEAN DEFAULT 0,
+        smart_warnings_auto BOOLEAN DEFAULT 0,
+        smart_warnings_min_confidence REAL DEFAULT 0.8,
+        smart_warnings_enabled_types TEXT DEFAULT 'spam,obscenity,rudeness,flood',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Создаем таблицу предупреждений пользователей
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_warnings (
+        id INTEGER PRIMARY KEY,
+        group_id TEXT,
+        user_id TEXT,
+        warnings INTEGER DEFAULT 0,
+        reason TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Создаем таблицу информации о пользователях
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_info (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT UNIQUE,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_admin BOOLEAN DEFAULT 0
+    )
+    ''')
+    
+    # Создаем таблицу анализа сообщений
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS message_analysis (
+        id INTEGER PRIMARY KEY,
+        group_id TEXT,
+        user_id TEXT,
+        message_id TEXT,
+        message_text TEXT,
+        has_violation BOOLEAN DEFAULT 0,
+        violation_types TEXT,
+        confidence REAL,
+        suggested_warning TEXT,
+        is_warned BOOLEAN DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+def _migration_keys_and_indexes(cursor):
+    """Уникальный ключ предупреждений и индекс истории анализа"""
+    # Удаляем дубликаты предупреждений, оставляя запись с наибольшим счетчиком
+    cursor.execute('''
+    DELETE FROM user_warnings WHERE id IN (
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY group_id, user_id
+                ORDER BY warnings DESC, updated_at DESC, id DESC
+            ) AS position
+            FROM user_warnings
+        ) WHERE position > 1
+    )
+    ''')
+    if cursor.rowcount > 0:
+        logger.info(f"Удалено дублирующихся записей предупреждений: {cursor.rowcount}")
+    
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_warnings_group_user "
+        "ON user_warnings (group_id, user_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_analysis_group_created "
+        "ON message_analysis (group_id, created_at)"
+    )
+
+def _rebuild_table(cursor, table, create_sql, columns, select_columns):
+    """Пересоздание таблицы с новой схемой и переносом данных"""
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_new")
+    cursor.execute(create_sql.format(table=f"{table}_new"))
+    cursor.execute(
+        f"INSERT INTO {table}_new ({columns}) SELECT {select_columns} FROM {table}"
+    )
+    logger.info(f"Таблица {table}: перенесено строк {cursor.rowcount}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def _migration_integer_ids(cursor):
+    """Перевод ID Telegram из TEXT в INTEGER и компактные первичные ключи"""
+    # Настройки: ID группы становится первичным ключом (псевдонимом rowid)
+    _rebuild_table(
+        cursor, 'group_settings',
+        '''
+        CREATE TABLE {table} (
+            group_id INTEGER PRIMARY KEY,
+            welcome_message TEXT DEFAULT 'Добро пожаловать, {{name}}!',
             rules TEXT DEFAULT 'Правила не установлены!',
             anti_flood BOOLEAN DEFAULT 1,
             smart_warnings BOOLEAN DEFAULT 0,
@@ -85,143 +577,2390 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-        ''')
-        
-        # Создаем таблицу предупреждений пользователей
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_warnings (
-            id INTEGER PRIMARY KEY,
-            group_id TEXT,
-            user_id TEXT,
+        ''',
+        "group_id, welcome_message, rules, anti_flood, smart_warnings, smart_warnings_auto, "
+        "smart_warnings_min_confidence, smart_warnings_enabled_types, created_at, updated_at",
+        "CAST(group_id AS INTEGER), welcome_message, rules, anti_flood, smart_warnings, smart_warnings_auto, "
+        "smart_warnings_min_confidence, smart_warnings_enabled_types, created_at, updated_at"
+    )
+    
+    # Предупреждения: ключ (группа, пользователь) хранится прямо в B-дереве без rowid
+    _rebuild_table(
+        cursor, 'user_warnings',
+        '''
+        CREATE TABLE {table} (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
             warnings INTEGER DEFAULT 0,
             reason TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        "group_id, user_id, warnings, reason, created_at, updated_at",
+        "CAST(group_id AS INTEGER), CAST(user_id AS INTEGER), warnings, reason, created_at, updated_at"
+    )
+    
+    # Пользователи: ID пользователя становится первичным ключом
+    _rebuild_table(
+        cursor, 'user_info',
+        '''
+        CREATE TABLE {table} (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_admin BOOLEAN DEFAULT 0
+        )
+        ''',
+        "user_id, username, first_name, last_name, join_date, is_admin",
+        "CAST(user_id AS INTEGER), username, first_name, last_name, join_date, is_admin"
+    )
+    
+    # Анализ: сохраняем id (на него ссылаются кнопки), остальные ID - INTEGER
+    _rebuild_table(
+        cursor, 'message_analysis',
+        '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY,
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_id INTEGER,
+            message_text TEXT,
+            has_violation BOOLEAN DEFAULT 0,
+            violation_types TEXT,
+            confidence REAL,
+            suggested_warning TEXT,
+            is_warned BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "id, group_id, user_id, message_id, message_text, has_violation, violation_types, "
+        "confidence, suggested_warning, is_warned, created_at",
+        "id, CAST(group_id AS INTEGER), CAST(user_id AS INTEGER), CAST(message_id AS INTEGER), message_text, "
+        "has_violation, violation_types, confidence, suggested_warning, is_warned, created_at"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_analysis_group_created "
+        "ON message_analysis (group_id, created_at)"
+    )
+
+def _migration_analysis_retention(cursor):
+    """Срок хранения анализа для группы и таблица дневной статистики"""
+    # NULL - срок хранения по умолчанию (ANALYSIS_RETENTION_DAYS)
+    cursor.execute("ALTER TABLE group_settings ADD COLUMN analysis_retention_days INTEGER")
+    # Последний день, уже свернутый в дневную статистику
+    cursor.execute("ALTER TABLE group_settings ADD COLUMN analysis_rollup_day TEXT")
+    
+    # Пустой violation_type - все проанализированные сообщения за день
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analysis_daily_stats (
+        group_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        violation_type TEXT NOT NULL,
+        messages INTEGER DEFAULT 0,
+        warned INTEGER DEFAULT 0,
+        PRIMARY KEY (group_id, day, violation_type)
+    ) WITHOUT ROWID
+    ''')
+
+def _migration_analysis_user_index(cursor):
+    """Индекс для постраничного просмотра анализа с фильтром по пользователю"""
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_analysis_group_user_created "
+        "ON message_analysis (group_id, user_id, created_at)"
+    )
+
+def _migration_analysis_fts(cursor):
+    """Индекс FTS5 по тексту сообщений, синхронизируемый триггерами"""
+    # Внешнее содержимое: текст хранится только в message_analysis, в FTS - индекс
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS message_analysis_fts USING fts5(
+        message_text,
+        content='message_analysis',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    
+    # Триггеры покрывают и запись через DatabaseWriter, и удаление при очистке
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS message_analysis_fts_insert AFTER INSERT ON message_analysis BEGIN
+        INSERT INTO message_analysis_fts (rowid, message_text) VALUES (new.id, new.message_text);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS message_analysis_fts_delete AFTER DELETE ON message_analysis BEGIN
+        INSERT INTO message_analysis_fts (message_analysis_fts, rowid, message_text)
+        VALUES ('delete', old.id, old.message_text);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS message_analysis_fts_update AFTER UPDATE OF message_text ON message_analysis BEGIN
+        INSERT INTO message_analysis_fts (message_analysis_fts, rowid, message_text)
+        VALUES ('delete', old.id, old.message_text);
+        INSERT INTO message_analysis_fts (rowid, message_text) VALUES (new.id, new.message_text);
+    END
+    ''')
+    
+    # Индексируем уже накопленную историю
+    cursor.execute("INSERT INTO message_analysis_fts (message_analysis_fts) VALUES ('rebuild')")
+
+def _migration_import_progress(cursor):
+    """Таблица прогресса импорта для продолжения после прерывания"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS import_progress (
+        import_id TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        rows_done INTEGER DEFAULT 0,
+        finished BOOLEAN DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (import_id, table_name)
+    ) WITHOUT ROWID
+    ''')
+
+def _migration_flood_rules(cursor):
+    """Правила антифлуда группы для обычных участников и новичков"""
+    # NULL - правило по умолчанию (FLOOD_THRESHOLD сообщений за FLOOD_TIME секунд)
+    cursor.execute("ALTER TABLE group_settings ADD COLUMN flood_rule TEXT")
+    cursor.execute("ALTER TABLE group_settings ADD COLUMN newcomer_flood_rule TEXT")
+
+def _migration_raid_protection(cursor):
+    """Флаг защиты группы от рейдов (включается администраторами через /raid on)"""
+    cursor.execute("ALTER TABLE group_settings ADD COLUMN raid_protection BOOLEAN DEFAULT 0")
+
+def _migration_lexicon(cursor):
+    """Словарь ключевых слов нарушений"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS lexicon (
+        term TEXT PRIMARY KEY,
+        violation_type TEXT NOT NULL,
+        added_by INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+    ''')
+
+# Список миграций: (версия, описание, функция). Новые миграции добавляются только в конец.
+SCHEMA_MIGRATIONS = [
+    (1, "Базовая схема", _migration_initial_schema),
+    (2, "Уникальные ключи и индексы", _migration_keys_and_indexes),
+    (3, "Целочисленные ID Telegram", _migration_integer_ids),
+    (4, "Срок хранения и дневная статистика анализа", _migration_analysis_retention),
+    (5, "Индекс истории анализа по пользователю", _migration_analysis_user_index),
+    (6, "Полнотекстовый поиск по сообщениям", _migration_analysis_fts),
+    (7, "Прогресс импорта данных", _migration_import_progress),
+    (8, "Правила антифлуда группы", _migration_flood_rules),
+    (9, "Защита от рейдов", _migration_raid_protection),
+    (10, "Словарь ключевых слов нарушений", _migration_lexicon),
+]
+
+def get_schema_version(conn):
+    """Текущая версия схемы базы данных"""
+    row = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+    return row['version'] or 0
+
+def run_migrations(conn):
+    """Применение недостающих миграций, каждая в отдельной транзакции"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.commit()
+    
+    current_version = get_schema_version(conn)
+    
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        
+        logger.info(f"Применяем миграцию {version}: {description}")
+        started = time.time()
+        cursor = conn.cursor()
+        # Блокируем запись сразу, чтобы миграция не конфликтовала с другими писателями
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Ошибка миграции {version} ({description}): {e}")
+            raise
+        
+        logger.info(f"Миграция {version} применена за {time.time() - started:.2f}s")
+
+def database_size(conn):
+    """Размер файла базы и свободного места в нем (байты)"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * page_size, free * page_size
+
+def enable_incremental_vacuum(conn):
+    """Включение инкрементального auto_vacuum (для существующей базы требует VACUUM)"""
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if mode == 2:
+        return False
+    
+    size, free = database_size(conn)
+    logger.info(f"Включаем инкрементальный auto_vacuum, база ({size / 2**20:.1f} МБ) будет перестроена")
+    started = time.time()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    logger.info(f"База перестроена за {time.time() - started:.2f}s, освобождено {free / 2**20:.1f} МБ")
+    return True
+
+def check_incremental_vacuum(conn):
+    """Проверка режима auto_vacuum при запуске: новая база создается сразу в нужном режиме,
+    существующую не перестраиваем (VACUUM блокирует базу), а только сообщаем об этом"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        # В пустой базе перестраивать нечего
+        enable_incremental_vacuum(conn)
+        return
+    
+    size, free = database_size(conn)
+    logger.warning(
+        f"В базе выключен инкрементальный auto_vacuum: место после очистки не возвращается системе. "
+        f"Перестройка займет время и до {size / 2**20:.1f} МБ на диске (сейчас свободно внутри базы "
+        f"{free / 2**20:.1f} МБ); запустите ее при остановленном боте: python \"{os.path.basename(__file__)}\" vacuum"
+    )
+
+# ------ Хранилище ------ #
+
+# Интерфейс хранилища: настройки групп, предупреждения, пользователи и результаты анализа.
+# Обработчики работают с ним через функции модуля, поэтому движок можно заменить, не трогая их.
+class Storage(ABC):
+    # Блокирует ли хранилище поток (такие вызовы run_db выполняет в потоке БД)
+    blocking = True
+    
+    @abstractmethod
+    def init(self):
+        """Подготовка хранилища (схема, миграции)"""
+    
+    async def start(self):
+        """Запуск фоновых задач хранилища"""
+    
+    async def stop(self):
+        """Остановка фоновых задач с сохранением данных"""
+    
+    async def flush(self):
+        """Ожидание записи всех отложенных операций"""
+    
+    def drain_sync(self):
+        """Синхронная запись отложенных операций (для обработчика сигналов)"""
+    
+    def close(self):
+        """Освобождение ресурсов хранилища"""
+    
+    def stats(self):
+        """Метрики хранилища для файла состояния"""
+        return {}
+    
+    # Настройки групп
+    
+    @abstractmethod
+    def get_group_settings(self, group_id):
+        """Настройки группы (создаются по умолчанию при первом обращении)"""
+    
+    @abstractmethod
+    def update_group_setting(self, group_id, column, value):
+        """Изменение одной настройки группы; возвращает, найдена ли группа"""
+    
+    @abstractmethod
+    def get_retention_groups(self):
+        """Группы со сроком хранения анализа и последним свернутым днем"""
+    
+    # Предупреждения
+    
+    @abstractmethod
+    def get_user_warnings(self, group_id, user_id):
+        """Запись предупреждений пользователя (создается при первом обращении)"""
+    
+    @abstractmethod
+    def get_warning_count(self, group_id, user_id):
+        """Текущее количество предупреждений пользователя"""
+    
+    @abstractmethod
+    def add_warning(self, group_id, user_id, reason, max_warnings=MAX_WARNINGS, analysis_id=None):
+        """Атомарная выдача предупреждения: (количество, достигнут ли лимит) или None"""
+    
+    @abstractmethod
+    def remove_warning(self, group_id, user_id):
+        """Снятие одного предупреждения; остаток или None, если снимать нечего"""
+    
+    @abstractmethod
+    def reset_warnings(self, group_id, user_id):
+        """Сброс счетчика предупреждений"""
+    
+    # Пользователи
+    
+    @abstractmethod
+    def get_user_record(self, user_id):
+        """Запись о пользователе"""
+    
+    @abstractmethod
+    def get_admin_flag(self, user_id):
+        """Флаг администратора из записи пользователя"""
+    
+    @abstractmethod
+    async def submit_user(self, user_id, username, first_name, last_name, admin_flag):
+        """Сохранение профиля (пустые поля не затирают старые); возвращает future записи"""
+    
+    # Результаты анализа
+    
+    @abstractmethod
+    async def submit_analysis(self, group_id, user_id, message_id, message_text, has_violation,
+                              violation_types, confidence, suggested_warning, is_warned):
+        """Сохранение результата анализа; возвращает future с ID записи"""
+    
+    @abstractmethod
+    def get_analysis(self, analysis_id):
+        """Результат анализа по ID"""
+    
+    @abstractmethod
+    def get_analyses_page(self, group_id, analysis_filters, after_id=None, limit=ANALYSES_PAGE_SIZE):
+        """Страница анализа после записи after_id: (строки, есть_еще) или None"""
+    
+    @abstractmethod
+    def search_analyses(self, group_id, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Поиск сообщений группы по тексту: (строки, есть_еще, обрезано окном ранжирования)"""
+    
+    @abstractmethod
+    def get_violation_stats(self, group_id, days=7):
+        """Количество сообщений по типам нарушений за последние дни"""
+    
+    @abstractmethod
+    def rollup_analysis_stats(self, group_id, rollup_day, today):
+        """Свертка закрытых дней в дневную статистику; число записанных строк"""
+    
+    @abstractmethod
+    def prune_analyses(self, group_id, cutoff, limit=RETENTION_BATCH_SIZE):
+        """Удаление порции результатов анализа старше cutoff; число удаленных строк"""
+    
+    # Словарь нарушений
+    
+    @abstractmethod
+    def get_lexicon(self):
+        """Слова словаря: список (слово, тип нарушения)"""
+    
+    @abstractmethod
+    def add_lexicon_terms(self, violation_type, terms, added_by=None):
+        """Добавление слов (у существующих меняется тип); число добавленных или измененных"""
+    
+    @abstractmethod
+    def remove_lexicon_terms(self, terms):
+        """Удаление слов словаря; число удаленных"""
+    
+    def compact(self, pages):
+        """Возврат свободного места; число освобожденных страниц"""
+        return 0
+
+# Хранилище в SQLite
+class SQLiteStorage(Storage):
+    def __init__(self, pool=None, writer=None):
+        """Инициализация хранилища поверх пула соединений и фоновой записи"""
+        self.pool = pool or db_pool
+        self.writer = writer or db_writer
+    
+    @contextmanager
+    def connection(self):
+        """Соединение из пула хранилища"""
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+    
+    def init(self):
+        """Применение миграций схемы"""
+        with self.connection() as conn:
+            check_incremental_vacuum(conn)
+            run_migrations(conn)
+    
+    async def start(self):
+        """Запуск фоновой записи"""
+        await self.writer.start()
+    
+    async def stop(self):
+        """Остановка фоновой записи с сохранением очереди"""
+        await self.writer.stop()
+    
+    async def flush(self):
+        """Ожидание записи очереди"""
+        await self.writer.flush()
+    
+    def drain_sync(self):
+        """Синхронная запись очереди"""
+        self.writer.drain_sync()
+    
+    def close(self):
+        """Закрытие соединений пула"""
+        self.pool.close()
+    
+    def stats(self):
+        """Метрики пула и фоновой записи"""
+        metrics = {}
+        for key, value in self.pool.stats().items():
+            metrics[f"pool_{key}"] = value
+        for key, value in self.writer.stats().items():
+            metrics[f"writer_{key}"] = value
+        return metrics
+    
+    def update_group_setting(self, group_id, column, value):
+        """Изменение одной настройки группы"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE group_settings SET {column} = ?, updated_at = CURRENT_TIMESTAMP WHERE group_id = ?",
+                (value, int(group_id))
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    
+    async def submit_user(self, user_id, username, first_name, last_name, admin_flag):
+        """Постановка профиля в очередь записи"""
+        return await self.writer.submit(
+            """
+            INSERT INTO user_info (user_id, username, first_name, last_name, is_admin)
+            VALUES (?, ?, ?, ?, COALESCE(?, 0))
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                first_name = COALESCE(excluded.first_name, first_name),
+                last_name = COALESCE(excluded.last_name, last_name),
+                is_admin = COALESCE(?, is_admin)
+            """,
+            (int(user_id), username, first_name, last_name, admin_flag, admin_flag)
+        )
+    
+    async def submit_analysis(self, group_id, user_id, message_id, message_text, has_violation,
+                              violation_types, confidence, suggested_warning, is_warned):
+        """Постановка результата анализа в очередь записи"""
+        return await self.writer.submit(
+            """
+            INSERT INTO message_analysis
+            (group_id, user_id, message_id, message_text, has_violation,
+             violation_types, confidence, suggested_warning, is_warned)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                int(group_id),
+                int(user_id),
+                int(message_id),
+                message_text,
+                1 if has_violation else 0,
+                violation_types,
+                confidence,
+                suggested_warning,
+                1 if is_warned else 0
+            )
+        )
+    
+    def get_admin_flag(self, user_id):
+        """Флаг администратора из таблицы user_info"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT is_admin FROM user_info WHERE user_id = ?", (int(user_id),))
+            row = cursor.fetchone()
+            
+            if row and row['is_admin']:
+                return True
+        
+        return False
+    
+    def get_group_settings(self, group_id):
+        """Получение настроек группы"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM group_settings WHERE group_id = ?",
+                (int(group_id),)
+            )
+            row = cursor.fetchone()
+            
+            if not row:
+                # Создаем настройки по умолчанию
+                cursor.execute(
+                    "INSERT INTO group_settings (group_id) VALUES (?)",
+                    (int(group_id),)
+                )
+                conn.commit()
+                
+                cursor.execute(
+                    "SELECT * FROM group_settings WHERE group_id = ?",
+                    (int(group_id),)
+                )
+                row = cursor.fetchone()
+            
+            return dict(row) if row else None
+    
+    def get_user_warnings(self, group_id, user_id):
+        """Получение предупреждений пользователя"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM user_warnings WHERE group_id = ? AND user_id = ?",
+                (int(group_id), int(user_id))
+            )
+            row = cursor.fetchone()
+            
+            if not row:
+                # Создаем запись с нулевыми предупреждениями
+                cursor.execute(
+                    "INSERT INTO user_warnings (group_id, user_id, warnings) VALUES (?, ?, 0)",
+                    (int(group_id), int(user_id))
+                )
+                conn.commit()
+                
+                cursor.execute(
+                    "SELECT * FROM user_warnings WHERE group_id = ? AND user_id = ?",
+                    (int(group_id), int(user_id))
+                )
+                row = cursor.fetchone()
+            
+            return dict(row) if row else None
+    
+    def get_warning_count(self, group_id, user_id):
+        """Текущее количество предупреждений пользователя (без создания записи)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT warnings FROM user_warnings WHERE group_id = ? AND user_id = ?",
+                (int(group_id), int(user_id))
+            )
+            row = cursor.fetchone()
+            return row['warnings'] if row else 0
+    
+    def add_warning(self, group_id, user_id, reason, max_warnings=MAX_WARNINGS, analysis_id=None):
+        """Атомарная выдача предупреждения.
+        
+        Одной транзакцией увеличивает счетчик (создавая запись при необходимости),
+        сбрасывает его при достижении лимита и помечает анализ как предупрежденный.
+        Возвращает (количество предупреждений, достигнут ли лимит) или None,
+        если за этот анализ предупреждение уже было выдано.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Не выдаем второе предупреждение за один и тот же анализ
+                if analysis_id is not None:
+                    cursor.execute(
+                        "UPDATE message_analysis SET is_warned = 1 WHERE id = ? AND is_warned = 0",
+                        (analysis_id,)
+                    )
+                    if cursor.rowcount == 0:
+                        conn.rollback()
+                        return None
+                
+                cursor.execute(
+                    """
+                    INSERT INTO user_warnings (group_id, user_id, warnings, reason) VALUES (?, ?, 1, ?)
+                    ON CONFLICT(group_id, user_id) DO UPDATE SET
+                        warnings = warnings + 1,
+                        reason = excluded.reason,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING warnings
+                    """,
+                    (int(group_id), int(user_id), reason)
+                )
+                warnings = cursor.fetchone()['warnings']
+                
+                # При достижении лимита счетчик сбрасывается в той же транзакции
+                limit_reached = warnings >= max_warnings
+                if limit_reached:
+                    cursor.execute(
+                        "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
+                        "WHERE group_id = ? AND user_id = ?",
+                        (int(group_id), int(user_id))
+                    )
+                
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        return warnings, limit_reached
+    
+    def remove_warning(self, group_id, user_id):
+        """Атомарное снятие одного предупреждения; возвращает остаток или None, если снимать нечего"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE user_warnings SET warnings = warnings - 1, updated_at = CURRENT_TIMESTAMP "
+                "WHERE group_id = ? AND user_id = ? AND warnings > 0 RETURNING warnings",
+                (int(group_id), int(user_id))
+            )
+            row = cursor.fetchone()
+            conn.commit()
+            return row['warnings'] if row else None
+    
+    def reset_warnings(self, group_id, user_id):
+        """Сброс счетчика предупреждений"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
+                "WHERE group_id = ? AND user_id = ?",
+                (int(group_id), int(user_id))
+            )
+            conn.commit()
+    
+    def get_user_record(self, user_id):
+        """Запись о пользователе из таблицы user_info"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM user_info WHERE user_id = ?", (int(user_id),))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def get_analysis(self, analysis_id):
+        """Получение результата анализа по ID"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM message_analysis WHERE id = ?", (analysis_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def get_analyses_page(self, group_id, analysis_filters, after_id=None, limit=ANALYSES_PAGE_SIZE):
+        """Страница результатов анализа (новые сверху) после записи after_id.
+        
+        Курсор - пара (created_at, id) последней показанной записи, поэтому любая
+        страница читается диапазоном по индексу, без OFFSET. Возвращает (строки, есть_еще)
+        или None, если запись-курсор уже удалена.
+        """
+        conditions = ["group_id = ?"]
+        params = [int(group_id)]
+        
+        if analysis_filters.user_id:
+            conditions.append("user_id = ?")
+            params.append(int(analysis_filters.user_id))
+        if analysis_filters.violation_type:
+            conditions.append("instr(',' || violation_types || ',', ?) > 0")
+            params.append(f",{analysis_filters.violation_type},")
+        if analysis_filters.warned is not None:
+            conditions.append("is_warned = ?")
+            params.append(1 if analysis_filters.warned else 0)
+        if analysis_filters.since:
+            conditions.append("created_at >= ?")
+            params.append(analysis_filters.since.isoformat())
+        if analysis_filters.until:
+            conditions.append("created_at < ?")
+            params.append((analysis_filters.until + datetime.timedelta(days=1)).isoformat())
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            if after_id:
+                cursor.execute("SELECT created_at FROM message_analysis WHERE id = ?", (int(after_id),))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                conditions.append("created_at <= ? AND (created_at < ? OR id < ?)")
+                params.extend([row['created_at'], row['created_at'], int(after_id)])
+            
+            # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+            cursor.execute(
+                f"""
+                SELECT id, user_id, violation_types, confidence, is_warned, created_at
+                FROM message_analysis
+                WHERE {' AND '.join(conditions)}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+                """,
+                params + [limit + 1]
+            )
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        return rows[:limit], len(rows) > limit
+    
+    def search_analyses(self, group_id, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Поиск сообщений группы по тексту (по релевантности).
+        
+        Возвращает (строки, есть_еще, обрезано): обрезано - у запроса есть совпадения
+        старше окна SEARCH_RANK_WINDOW, которые в ранжирование не попали.
+        """
+        match = build_search_query(text)
+        if not match:
+            return [], False, False
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Ранжирование считается для каждого совпадения, поэтому для частых слов
+            # ограничиваемся последними SEARCH_RANK_WINDOW совпадениями (обход по rowid дешевый)
+            cursor.execute(
+                """
+                SELECT f.rowid FROM message_analysis_fts f
+                JOIN message_analysis a ON a.id = f.rowid
+                WHERE message_analysis_fts MATCH ? AND a.group_id = ?
+                ORDER BY f.rowid DESC
+                LIMIT 2 OFFSET ?
+                """,
+                (match, int(group_id), SEARCH_RANK_WINDOW - 1)
+            )
+            # Первая строка - граница окна, вторая есть, только если совпадений больше окна
+            bounds = cursor.fetchall()
+            min_rowid = bounds[0][0] if bounds else 0
+            truncated = len(bounds) > 1
+            
+            cursor.execute(
+                """
+                SELECT a.id, a.user_id, a.violation_types, a.created_at,
+                       snippet(message_analysis_fts, 0, '«', '»', '…', 12) AS snippet
+                FROM message_analysis_fts
+                JOIN message_analysis a ON a.id = message_analysis_fts.rowid
+                WHERE message_analysis_fts MATCH ? AND message_analysis_fts.rowid >= ? AND a.group_id = ?
+                ORDER BY message_analysis_fts.rank
+                LIMIT ? OFFSET ?
+                """,
+                (match, min_rowid, int(group_id), limit + 1, int(offset))
+            )
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        return rows[:limit], len(rows) > limit, truncated
+    
+    def get_retention_groups(self):
+        """Группы со сроком хранения и последним свернутым днем"""
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT group_id, analysis_retention_days, analysis_rollup_day FROM group_settings"
+            ).fetchall()
+            return [
+                (row['group_id'], row['analysis_retention_days'] or ANALYSIS_RETENTION_DAYS, row['analysis_rollup_day'])
+                for row in rows
+            ]
+    
+    def rollup_analysis_stats(self, group_id, rollup_day, today):
+        """Свертка закрытых дней (до today) в дневную статистику, возвращает число записанных строк"""
+        start = (datetime.date.fromisoformat(rollup_day) + datetime.timedelta(days=1)) if rollup_day else None
+        if start is not None and start >= today:
+            return 0
+        
+        # Пустой тип - строка со всеми сообщениями за день
+        types = ('',) + VIOLATION_TYPES
+        types_sql = ', '.join('(?)' for _ in types)
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                INSERT INTO analysis_daily_stats (group_id, day, violation_type, messages, warned)
+                WITH types(name) AS (VALUES {types_sql})
+                SELECT a.group_id, date(a.created_at), t.name, COUNT(*), SUM(a.is_warned)
+                FROM message_analysis a, types t
+                WHERE a.group_id = ? AND a.created_at >= ? AND a.created_at < ?
+                  AND (t.name = '' OR instr(',' || a.violation_types || ',', ',' || t.name || ',') > 0)
+                GROUP BY date(a.created_at), t.name
+                ON CONFLICT(group_id, day, violation_type) DO UPDATE SET
+                    messages = excluded.messages,
+                    warned = excluded.warned
+                """,
+                types + (int(group_id), start.isoformat() if start else '', today.isoformat())
+            )
+            written = cursor.rowcount
+            cursor.execute(
+                "UPDATE group_settings SET analysis_rollup_day = ? WHERE group_id = ?",
+                ((today - datetime.timedelta(days=1)).isoformat(), int(group_id))
+            )
+            conn.commit()
+        
+        return written
+    
+    def prune_analyses(self, group_id, cutoff, limit=RETENTION_BATCH_SIZE):
+        """Удаление одной порции результатов анализа старше cutoff"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                DELETE FROM message_analysis WHERE id IN (
+                    SELECT id FROM message_analysis
+                    WHERE group_id = ? AND created_at < ?
+                    ORDER BY created_at
+                    LIMIT ?
+                )
+                """,
+                (int(group_id), cutoff, limit)
+            )
+            conn.commit()
+            return cursor.rowcount
+    
+    def get_lexicon(self):
+        """Слова словаря"""
+        with self.connection() as conn:
+            return [tuple(row) for row in conn.execute("SELECT term, violation_type FROM lexicon")]
+    
+    def add_lexicon_terms(self, violation_type, terms, added_by=None):
+        """Добавление слов одной транзакцией"""
+        with self.connection() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                """
+                INSERT INTO lexicon (term, violation_type, added_by) VALUES (?, ?, ?)
+                ON CONFLICT(term) DO UPDATE SET violation_type = excluded.violation_type
+                WHERE violation_type != excluded.violation_type
+                """,
+                [(term, violation_type, added_by) for term in terms]
+            )
+            conn.commit()
+            return conn.total_changes - before
+    
+    def remove_lexicon_terms(self, terms):
+        """Удаление слов одной транзакцией"""
+        with self.connection() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM lexicon WHERE term = ?", [(term,) for term in terms])
+            conn.commit()
+            return conn.total_changes - before
+    
+    def compact(self, pages):
+        """Возврат свободных страниц файлу системы, возвращает число освобожденных страниц"""
+        with self.connection() as conn:
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if before:
+                # execute() делает только один шаг прагмы (одну страницу), executescript - до конца
+                conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            return before - after
+    
+    def get_violation_stats(self, group_id, days=7):
+        """Количество сообщений по типам нарушений за последние дни (статистика + сегодняшние строки)"""
+        today = datetime.datetime.utcnow().date()
+        since = (today - datetime.timedelta(days=days - 1)).isoformat()
+        stats = defaultdict(int)
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT violation_type, SUM(messages) AS messages FROM analysis_daily_stats
+                WHERE group_id = ? AND day >= ?
+                GROUP BY violation_type
+                """,
+                (int(group_id), since)
+            )
+            for row in cursor.fetchall():
+                stats[row['violation_type']] += row['messages']
+            
+            # Дни после последней свертки еще хранятся только в сыром виде
+            cursor.execute("SELECT analysis_rollup_day FROM group_settings WHERE group_id = ?", (int(group_id),))
+            row = cursor.fetchone()
+            rollup_day = row['analysis_rollup_day'] if row else None
+            raw_since = max(since, (datetime.date.fromisoformat(rollup_day) + datetime.timedelta(days=1)).isoformat()) if rollup_day else since
+            
+            cursor.execute(
+                "SELECT violation_types FROM message_analysis WHERE group_id = ? AND created_at >= ?",
+                (int(group_id), raw_since)
+            )
+            for row in cursor.fetchall():
+                stats[''] += 1
+                for violation in filter(None, (row['violation_types'] or '').split(',')):
+                    stats[violation] += 1
+        
+        return dict(stats)
+
+# Хранилище в памяти: словари и индексы с той же семантикой, что и у SQLite (для тестов и замеров)
+class MemoryStorage(Storage):
+    blocking = False
+    
+    def __init__(self):
+        """Инициализация пустого хранилища в памяти"""
+        self._lock = threading.RLock()
+        self._settings = {}       # group_id -> строка настроек
+        self._warnings = {}       # (group_id, user_id) -> строка предупреждений
+        self._users = {}          # user_id -> строка пользователя
+        self._analyses = {}       # id -> строка анализа
+        self._by_group = defaultdict(list)       # group_id -> [(created_at, id)] по возрастанию
+        self._by_group_user = defaultdict(list)  # (group_id, user_id) -> [(created_at, id)]
+        self._terms = defaultdict(set)           # слово -> {id} для поиска
+        self._daily_stats = {}    # (group_id, day, violation_type) -> {'messages', 'warned'}
+        self._lexicon = {}        # слово -> тип нарушения
+        self._next_id = 1
+    
+    @staticmethod
+    def _now():
+        """Текущее время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+        return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    
+    @staticmethod
+    def _tokens(text):
+        """Слова текста в нижнем регистре (как токенизатор unicode61)"""
+        return re.findall(r'\w+', (text or '').lower())
+    
+    @staticmethod
+    def _done(result):
+        """Уже завершенная future (запись в память происходит сразу)"""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(result)
+        return future
+    
+    def init(self):
+        """Хранилищу в памяти подготовка не нужна"""
+    
+    def stats(self):
+        """Размеры таблиц в памяти"""
+        with self._lock:
+            return {
+                'groups': len(self._settings),
+                'users': len(self._users),
+                'warnings': len(self._warnings),
+                'analyses': len(self._analyses)
+            }
+    
+    # Настройки групп
+    
+    def get_group_settings(self, group_id):
+        """Настройки группы (создаются по умолчанию при первом обращении)"""
+        group_id = int(group_id)
+        with self._lock:
+            settings = self._settings.get(group_id)
+            if settings is None:
+                now = self._now()
+                settings = {
+                    'group_id': group_id,
+                    'welcome_message': 'Добро пожаловать, {name}!',
+                    'rules': 'Правила не установлены!',
+                    'anti_flood': 1,
+                    'smart_warnings': 0,
+                    'smart_warnings_auto': 0,
+                    'smart_warnings_min_confidence': 0.8,
+                    'smart_warnings_enabled_types': ','.join(VIOLATION_TYPES),
+                    'created_at': now,
+                    'updated_at': now,
+                    'analysis_retention_days': None,
+                    'analysis_rollup_day': None,
+                    'flood_rule': None,
+                    'newcomer_flood_rule': None,
+                    'raid_protection': 0
+                }
+                self._settings[group_id] = settings
+            return dict(settings)
+    
+    def update_group_setting(self, group_id, column, value):
+        """Изменение одной настройки группы"""
+        with self._lock:
+            settings = self._settings.get(int(group_id))
+            if settings is None:
+                return False
+            if column not in settings:
+                raise KeyError(f"Неизвестная настройка группы: {column}")
+            settings[column] = value
+            settings['updated_at'] = self._now()
+            return True
+    
+    def get_retention_groups(self):
+        """Группы со сроком хранения и последним свернутым днем"""
+        with self._lock:
+            return [
+                (group_id, settings['analysis_retention_days'] or ANALYSIS_RETENTION_DAYS, settings['analysis_rollup_day'])
+                for group_id, settings in self._settings.items()
+            ]
+    
+    # Предупреждения
+    
+    def get_user_warnings(self, group_id, user_id):
+        """Запись предупреждений пользователя (создается при первом обращении)"""
+        key = (int(group_id), int(user_id))
+        with self._lock:
+            row = self._warnings.get(key)
+            if row is None:
+                now = self._now()
+                row = {'group_id': key[0], 'user_id': key[1], 'warnings': 0, 'reason': None,
+                       'created_at': now, 'updated_at': now}
+                self._warnings[key] = row
+            return dict(row)
+    
+    def get_warning_count(self, group_id, user_id):
+        """Текущее количество предупреждений пользователя"""
+        with self._lock:
+            row = self._warnings.get((int(group_id), int(user_id)))
+            return row['warnings'] if row else 0
+    
+    def add_warning(self, group_id, user_id, reason, max_warnings=MAX_WARNINGS, analysis_id=None):
+        """Атомарная выдача предупреждения (под общей блокировкой)"""
+        with self._lock:
+            # Не выдаем второе предупреждение за один и тот же анализ
+            if analysis_id is not None:
+                analysis = self._analyses.get(int(analysis_id))
+                if analysis is None or analysis['is_warned']:
+                    return None
+                analysis['is_warned'] = 1
+            
+            row = self._warnings.get((int(group_id), int(user_id)))
+            if row is None:
+                self.get_user_warnings(group_id, user_id)
+                row = self._warnings[(int(group_id), int(user_id))]
+            
+            row['warnings'] += 1
+            row['reason'] = reason
+            row['updated_at'] = self._now()
+            warnings = row['warnings']
+            
+            # При достижении лимита счетчик сбрасывается
+            limit_reached = warnings >= max_warnings
+            if limit_reached:
+                row['warnings'] = 0
+        
+        return warnings, limit_reached
+    
+    def remove_warning(self, group_id, user_id):
+        """Снятие одного предупреждения"""
+        with self._lock:
+            row = self._warnings.get((int(group_id), int(user_id)))
+            if not row or row['warnings'] <= 0:
+                return None
+            row['warnings'] -= 1
+            row['updated_at'] = self._now()
+            return row['warnings']
+    
+    def reset_warnings(self, group_id, user_id):
+        """Сброс счетчика предупреждений"""
+        with self._lock:
+            row = self._warnings.get((int(group_id), int(user_id)))
+            if row:
+                row['warnings'] = 0
+                row['updated_at'] = self._now()
+    
+    # Пользователи
+    
+    def get_user_record(self, user_id):
+        """Запись о пользователе"""
+        with self._lock:
+            row = self._users.get(int(user_id))
+            return dict(row) if row else None
+    
+    def get_admin_flag(self, user_id):
+        """Флаг администратора из записи пользователя"""
+        with self._lock:
+            row = self._users.get(int(user_id))
+            return bool(row and row['is_admin'])
+    
+    async def submit_user(self, user_id, username, first_name, last_name, admin_flag):
+        """Сохранение профиля: пустые поля не затирают старые значения"""
+        user_id = int(user_id)
+        with self._lock:
+            row = self._users.get(user_id)
+            if row is None:
+                self._users[user_id] = {
+                    'user_id': user_id, 'username': username, 'first_name': first_name,
+                    'last_name': last_name, 'join_date': self._now(), 'is_admin': admin_flag or 0
+                }
+            else:
+                for column, value in (('username', username), ('first_name', first_name),
+                                      ('last_name', last_name), ('is_admin', admin_flag)):
+                    if value is not None:
+                        row[column] = value
+        return self._done(user_id)
+    
+    # Результаты анализа
+    
+    async def submit_analysis(self, group_id, user_id, message_id, message_text, has_violation,
+                              violation_types, confidence, suggested_warning, is_warned):
+        """Сохранение результата анализа с обновлением индексов"""
+        with self._lock:
+            analysis_id = self._next_id
+            self._next_id += 1
+            row = {
+                'id': analysis_id,
+                'group_id': int(group_id),
+                'user_id': int(user_id),
+                'message_id': int(message_id),
+                'message_text': message_text,
+                'has_violation': 1 if has_violation else 0,
+                'violation_types': violation_types,
+                'confidence': confidence,
+                'suggested_warning': suggested_warning,
+                'is_warned': 1 if is_warned else 0,
+                'created_at': self._now()
+            }
+            self._analyses[analysis_id] = row
+            key = (row['created_at'], analysis_id)
+            bisect.insort(self._by_group[row['group_id']], key)
+            bisect.insort(self._by_group_user[(row['group_id'], row['user_id'])], key)
+            for token in set(self._tokens(message_text)):
+                self._terms[token].add(analysis_id)
+        return self._done(analysis_id)
+    
+    def _delete_analysis(self, analysis_id):
+        """Удаление результата анализа из таблицы и всех индексов"""
+        row = self._analyses.pop(analysis_id)
+        key = (row['created_at'], analysis_id)
+        for index, index_key in ((self._by_group, row['group_id']),
+                                 (self._by_group_user, (row['group_id'], row['user_id']))):
+            entries = index[index_key]
+            position = bisect.bisect_left(entries, key)
+            if position < len(entries) and entries[position] == key:
+                del entries[position]
+            if not entries:
+                del index[index_key]
+        for token in set(self._tokens(row['message_text'])):
+            ids = self._terms.get(token)
+            if ids is not None:
+                ids.discard(analysis_id)
+                if not ids:
+                    del self._terms[token]
+    
+    def get_analysis(self, analysis_id):
+        """Результат анализа по ID"""
+        with self._lock:
+            row = self._analyses.get(int(analysis_id))
+            return dict(row) if row else None
+    
+    def get_analyses_page(self, group_id, analysis_filters, after_id=None, limit=ANALYSES_PAGE_SIZE):
+        """Страница анализа: обход индекса (created_at, id) от курсора к старым записям"""
+        group_id = int(group_id)
+        with self._lock:
+            if analysis_filters.user_id:
+                entries = self._by_group_user.get((group_id, int(analysis_filters.user_id)), [])
+            else:
+                entries = self._by_group.get(group_id, [])
+            
+            # Верхняя граница - курсор или конец дня until, нижняя - начало дня since
+            end = len(entries)
+            if after_id:
+                cursor_row = self._analyses.get(int(after_id))
+                if cursor_row is None:
+                    return None
+                end = bisect.bisect_left(entries, (cursor_row['created_at'], int(after_id)))
+            if analysis_filters.until:
+                until = (analysis_filters.until + datetime.timedelta(days=1)).isoformat()
+                end = min(end, bisect.bisect_left(entries, (until,)))
+            start = bisect.bisect_left(entries, (analysis_filters.since.isoformat(),)) if analysis_filters.since else 0
+            
+            rows = []
+            for position in range(end - 1, start - 1, -1):
+                row = self._analyses[entries[position][1]]
+                if analysis_filters.violation_type and \
+                        analysis_filters.violation_type not in (row['violation_types'] or '').split(','):
+                    continue
+                if analysis_filters.warned is not None and bool(row['is_warned']) != analysis_filters.warned:
+                    continue
+                rows.append({column: row[column] for column in
+                             ('id', 'user_id', 'violation_types', 'confidence', 'is_warned', 'created_at')})
+                if len(rows) > limit:
+                    break
+        
+        return rows[:limit], len(rows) > limit
+    
+    def search_analyses(self, group_id, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Поиск по словарю слов: все слова запроса подряд (как фразы FTS5), ранжирование по частоте"""
+        phrases = [self._tokens(term) for term in text.split()]
+        phrases = [phrase for phrase in phrases if phrase]
+        if not phrases:
+            return [], False, False
+        
+        with self._lock:
+            candidates = None
+            for token in {token for phrase in phrases for token in phrase}:
+                ids = self._terms.get(token, set())
+                candidates = ids if candidates is None else candidates & ids
+            
+            hits = []
+            truncated = False
+            for analysis_id in sorted(candidates or (), reverse=True):
+                row = self._analyses[analysis_id]
+                if row['group_id'] != int(group_id):
+                    continue
+                tokens = self._tokens(row['message_text'])
+                score = 0
+                for phrase in phrases:
+                    matches = sum(1 for i in range(len(tokens) - len(phrase) + 1)
+                                  if tokens[i:i + len(phrase)] == phrase)
+                    if not matches:
+                        break
+                    score += matches
+                else:
+                    # Совпадение за окном ранжирования только отмечаем
+                    if len(hits) >= SEARCH_RANK_WINDOW:
+                        truncated = True
+                        break
+                    hits.append((score / len(tokens), row))
+            
+            hits.sort(key=lambda hit: hit[0], reverse=True)
+            matched = {token for phrase in phrases for token in phrase}
+            rows = []
+            for _, row in hits[offset:offset + limit + 1]:
+                words = row['message_text'].split()
+                snippet = ' '.join(
+                    f"«{word}»" if set(self._tokens(word)) & matched else word for word in words[:12]
+                )
+                rows.append({
+                    'id': row['id'],
+                    'user_id': row['user_id'],
+                    'violation_types': row['violation_types'],
+                    'created_at': row['created_at'],
+                    'snippet': snippet + ('…' if len(words) > 12 else '')
+                })
+        
+        return rows[:limit], len(rows) > limit, truncated
+    
+    def get_violation_stats(self, group_id, days=7):
+        """Количество сообщений по типам нарушений (статистика + несвернутые строки)"""
+        group_id = int(group_id)
+        today = datetime.datetime.utcnow().date()
+        since = (today - datetime.timedelta(days=days - 1)).isoformat()
+        stats = defaultdict(int)
+        
+        with self._lock:
+            for (stats_group, day, violation_type), counters in self._daily_stats.items():
+                if stats_group == group_id and day >= since:
+                    stats[violation_type] += counters['messages']
+            
+            rollup_day = self._settings.get(group_id, {}).get('analysis_rollup_day')
+            raw_since = max(since, (datetime.date.fromisoformat(rollup_day) + datetime.timedelta(days=1)).isoformat()) if rollup_day else since
+            entries = self._by_group.get(group_id, [])
+            for _, analysis_id in entries[bisect.bisect_left(entries, (raw_since,)):]:
+                stats[''] += 1
+                for violation in filter(None, (self._analyses[analysis_id]['violation_types'] or '').split(',')):
+                    stats[violation] += 1
+        
+        return dict(stats)
+    
+    def rollup_analysis_stats(self, group_id, rollup_day, today):
+        """Свертка закрытых дней в дневную статистику"""
+        group_id = int(group_id)
+        start = (datetime.date.fromisoformat(rollup_day) + datetime.timedelta(days=1)) if rollup_day else None
+        if start is not None and start >= today:
+            return 0
+        
+        with self._lock:
+            entries = self._by_group.get(group_id, [])
+            first = bisect.bisect_left(entries, (start.isoformat(),)) if start else 0
+            last = bisect.bisect_left(entries, (today.isoformat(),))
+            
+            counters = defaultdict(lambda: {'messages': 0, 'warned': 0})
+            for created_at, analysis_id in entries[first:last]:
+                row = self._analyses[analysis_id]
+                for violation_type in [''] + [t for t in (row['violation_types'] or '').split(',') if t in VIOLATION_TYPES]:
+                    counter = counters[(group_id, created_at[:10], violation_type)]
+                    counter['messages'] += 1
+                    counter['warned'] += row['is_warned']
+            
+            self._daily_stats.update(counters)
+            if group_id in self._settings:
+                self._settings[group_id]['analysis_rollup_day'] = (today - datetime.timedelta(days=1)).isoformat()
+        
+        return len(counters)
+    
+    def prune_analyses(self, group_id, cutoff, limit=RETENTION_BATCH_SIZE):
+        """Удаление порции самых старых результатов анализа до cutoff"""
+        with self._lock:
+            entries = self._by_group.get(int(group_id), [])
+            expired = [analysis_id for created_at, analysis_id in entries[:limit] if created_at < cutoff]
+            for analysis_id in expired:
+                self._delete_analysis(analysis_id)
+            return len(expired)
+    
+    # Словарь нарушений
+    
+    def get_lexicon(self):
+        """Слова словаря"""
+        with self._lock:
+            return list(self._lexicon.items())
+    
+    def add_lexicon_terms(self, violation_type, terms, added_by=None):
+        """Добавление слов"""
+        changed = 0
+        with self._lock:
+            for term in terms:
+                if self._lexicon.get(term) != violation_type:
+                    self._lexicon[term] = violation_type
+                    changed += 1
+        return changed
+    
+    def remove_lexicon_terms(self, terms):
+        """Удаление слов"""
+        with self._lock:
+            return sum(1 for term in terms if self._lexicon.pop(term, None) is not None)
+
+def create_storage(backend=STORAGE_BACKEND):
+    """Создание хранилища по имени движка"""
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Неизвестное хранилище: {backend}")
+
+storage = create_storage()
+
+def init_db():
+    """Инициализация базы данных"""
+    storage.init()
+
+# ---------------------- УТИЛИТЫ ---------------------- #
+
+# История сообщений пользователя в одном чате: кольцевые массивы времени и сигнатур
+class ChatHistory:
+    __slots__ = ('chat_id', 'timestamps', 'signatures', 'head', 'window_size', 'texts', 'last_seen', 'size')
+    
+    def __init__(self, chat_id, context_messages=TRACKER_CONTEXT_MESSAGES):
+        """Инициализация пустой истории"""
+        self.chat_id = chat_id
+        self.timestamps = array('d')    # время сообщений (кольцо после заполнения)
+        self.signatures = array('Q')    # SimHash текста сообщений
+        self.head = 0                   # индекс самого старого сообщения в кольце
+        self.window_size = 0            # сколько последних сообщений попадает в окно флуда
+        self.texts = deque(maxlen=context_messages)  # тексты последних сообщений для контекста
+        self.last_seen = 0.0            # время последнего сообщения
+        self.size = HISTORY_OVERHEAD_BYTES  # примерный объем истории в памяти (байты)
+    
+    def __len__(self):
+        return len(self.timestamps)
+    
+    def index(self, age):
+        """Индекс сообщения в кольце по возрасту (0 - самое новое)"""
+        return (self.head - 1 - age) % len(self.timestamps)
+    
+    def newest(self):
+        """Время последнего сообщения"""
+        return self.timestamps[self.index(0)]
+
+# Сообщение из истории (создается только при чтении истории)
+class TrackedMessage:
+    __slots__ = ('timestamp', 'chat_id', 'signature', 'text')
+    
+    def __init__(self, timestamp, chat_id, signature, text=None):
+        """Запись о сообщении; текст есть только у последних сообщений"""
+        self.timestamp = timestamp
+        self.chat_id = chat_id
+        self.signature = signature
+        self.text = text
+
+# SimHash: 64 счетчика битов упакованы в одно большое число по 8 бит на счетчик.
+# Для каждого байта хэша шингла заранее посчитано, какие счетчики он увеличивает.
+SIMHASH_COUNTER_BITS = 8
+SIMHASH_COUNTER_MASK = (1 << SIMHASH_COUNTER_BITS) - 1
+SIMHASH_SPREAD = [
+    [
+        sum(1 << ((position * 8 + bit) * SIMHASH_COUNTER_BITS) for bit in range(8) if value >> bit & 1)
+        for value in range(256)
+    ]
+    for position in range(8)
+]
+SIMHASH_SEPARATORS = re.compile(r'[\W_]+')
+SIMHASH_NUMBERS = re.compile(r'\d+')
+
+def simhash(text):
+    """64-битный SimHash по триграммам символов нормализованного текста"""
+    # Числа сводятся к одному символу: счетчики и суммы - обычный способ варьировать шаблонный спам
+    text = SIMHASH_NUMBERS.sub('0', SIMHASH_SEPARATORS.sub(' ', text.lower())).strip()[:SIMHASH_MAX_CHARS]
+    shingles = [text[i:i + 3] for i in range(len(text) - 2)] or ([text] if text else [])
+    if not shingles:
+        return 0
+    
+    spread0, spread1, spread2, spread3, spread4, spread5, spread6, spread7 = SIMHASH_SPREAD
+    counters = 0
+    for shingle in shingles:
+        # Стабильный 64-битный хэш (hash() меняется между запусками, а сигнатуры попадают в снимок)
+        data = shingle.encode('utf-8')
+        value = zlib.crc32(data) | zlib.crc32(data, 0x9E3779B9) << 32
+        counters += (
+            spread0[value & 255] | spread1[value >> 8 & 255] | spread2[value >> 16 & 255]
+            | spread3[value >> 24 & 255] | spread4[value >> 32 & 255] | spread5[value >> 40 & 255]
+            | spread6[value >> 48 & 255] | spread7[value >> 56]
         )
-        ''')
+    
+    # Бит сигнатуры установлен, если он был у большинства шинглов
+    signature = 0
+    for bit in range(64):
+        if (counters >> (bit * SIMHASH_COUNTER_BITS) & SIMHASH_COUNTER_MASK) * 2 > len(shingles):
+            signature |= 1 << bit
+    return signature
+
+def hamming_distance(first, second):
+    """Количество различающихся битов двух сигнатур"""
+    return bin(first ^ second).count('1')
+
+def context_text(text):
+    """Текст сообщения, сохраняемый для контекста (с ограничением длины)"""
+    return text[:TRACKER_CONTEXT_CHARS]
+
+# Секция трекера сообщений: истории части пар (пользователь, чат).
+# Сама секция не синхронизирована - MessageTracker вызывает ее методы под lock
+class TrackerShard:
+    def __init__(self, message_history_size=MESSAGE_HISTORY_SIZE, flood_window_seconds=60,
+                 max_bytes=TRACKER_MAX_BYTES, idle_ttl=TRACKER_IDLE_TTL):
+        """Инициализация секции трекера"""
+        self.lock = threading.Lock()
+        self.histories = OrderedDict()  # (user_id, chat_id) -> ChatHistory, от давно молчавших к активным
+        self.user_chats = defaultdict(set)  # user_id -> {chat_id}
+        self.chat_ids = {}  # chat_id -> единственный объект chat_id для всех ключей
+        self.max_history_size = message_history_size
+        self.flood_window = flood_window_seconds
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.record_size = array('d').itemsize + array('Q').itemsize  # байт на одно сообщение
+        self.total_messages = 0
+        self.total_bytes = 0
+        self.evicted_idle = 0     # Историй удалено по времени простоя
+        self.evicted_budget = 0   # Историй удалено из-за лимита памяти
+    
+    def _evict_window(self, history, current_time):
+        """Сдвиг начала окна флуда за вышедшие из него сообщения"""
+        window_start = current_time - self.flood_window
+        timestamps = history.timestamps
+        window_size = history.window_size
+        while window_size and timestamps[(history.head - window_size) % len(timestamps)] < window_start:
+            window_size -= 1
+        history.window_size = window_size
+    
+    def _drop_history(self, key):
+        """Удаление истории пользователя в чате"""
+        user_id, chat_id = key
+        history = self.histories.pop(key)
+        self.total_messages -= len(history)
+        self.total_bytes -= history.size
+        
+        chats = self.user_chats[user_id]
+        chats.discard(chat_id)
+        if not chats:
+            del self.user_chats[user_id]
+    
+    def add_message(self, user_id, chat_id, message_text, signature=None):
+        """Добавление сообщения (сигнатуру можно передать, если она уже посчитана)"""
+        current_time = time.time()
+        key = (user_id, chat_id)
+        
+        history = self.histories.get(key)
+        if history is None:
+            # Все истории чата ссылаются на один объект chat_id
+            chat_id = self.chat_ids.setdefault(chat_id, chat_id)
+            key = (user_id, chat_id)
+            history = self.histories[key] = ChatHistory(chat_id)
+            self.user_chats[user_id].add(chat_id)
+            self.total_bytes += history.size
+        else:
+            self.histories.move_to_end(key)
+        history.last_seen = current_time
+        
+        # Пока история не заполнена, массивы растут; затем самое старое сообщение перезаписывается
+        if signature is None:
+            signature = simhash(message_text)
+        timestamps = history.timestamps
+        added = 0
+        if len(timestamps) < self.max_history_size:
+            timestamps.append(current_time)
+            history.signatures.append(signature)
+            added += self.record_size
+            self.total_messages += 1
+        else:
+            timestamps[history.head] = current_time
+            history.signatures[history.head] = signature
+            history.head = (history.head + 1) % self.max_history_size
+        if history.window_size < len(timestamps):
+            history.window_size += 1
+        
+        # Полный текст храним только для нескольких последних сообщений
+        texts = history.texts
+        if len(texts) == texts.maxlen:
+            added -= sys.getsizeof(texts[0])
+        text = context_text(message_text)
+        texts.append(text)
+        added += sys.getsizeof(text)
+        history.size += added
+        self.total_bytes += added
+        
+        # При превышении лимита памяти удаляем истории, которые дольше всех молчат
+        while self.total_bytes > self.max_bytes and len(self.histories) > 1:
+            self._drop_history(next(iter(self.histories)))
+            self.evicted_budget += 1
+        
+        # Количество сообщений в окне флуда - размер окна после сдвига его начала
+        self._evict_window(history, current_time)
+        return history.window_size
+    
+    def sweep(self, current_time=None):
+        """Удаление историй пользователей, молчащих дольше idle_ttl; возвращает число удаленных"""
+        if current_time is None:
+            current_time = time.time()
+        idle_before = current_time - self.idle_ttl
+        
+        # Истории упорядочены по последнему сообщению - проверяем только начало
+        evicted = 0
+        while self.histories:
+            key, history = next(iter(self.histories.items()))
+            if history.last_seen >= idle_before:
+                break
+            self._drop_history(key)
+            evicted += 1
+        
+        self.evicted_idle += evicted
+        return evicted
+    
+    def _history_messages(self, history, cutoff_time=None, limit=None):
+        """Сообщения истории от старых к новым (с текстом у последних)"""
+        records = []
+        texts = history.texts
+        for age in range(len(history)):
+            if limit and len(records) >= limit:
+                break
+            index = history.index(age)
+            timestamp = history.timestamps[index]
+            if cutoff_time is not None and timestamp < cutoff_time:
+                break
+            text = texts[len(texts) - 1 - age] if age < len(texts) else None
+            records.append(TrackedMessage(timestamp, history.chat_id, history.signatures[index], text))
+        records.reverse()
+        return records
+    
+    def get_user_messages(self, user_id, limit=None, chat_id=None, seconds=None):
+        """Получение истории сообщений пользователя с фильтрацией"""
+        cutoff_time = time.time() - seconds if seconds else None
+        limit = limit if limit and limit > 0 else None
+        
+        if chat_id is not None:
+            history = self.histories.get((user_id, chat_id))
+            return self._history_messages(history, cutoff_time, limit) if history else []
+        
+        # Сообщения из всех чатов пользователя в порядке времени
+        messages = list(heapq.merge(
+            *(self._history_messages(self.histories[(user_id, chat)], cutoff_time, limit)
+              for chat in self.user_chats.get(user_id, ())),
+            key=lambda msg: msg.timestamp
+        ))
+        return messages[-limit:] if limit else messages
+    
+    def count_similar(self, user_id, chat_id, signature, seconds=None, limit=None, max_distance=SIMILAR_MAX_DISTANCE):
+        """Количество недавних сообщений, чей SimHash отличается от signature не больше чем на max_distance бит"""
+        history = self.histories.get((user_id, chat_id))
+        if history is None:
+            return 0
+        
+        # Окно истории ограничено MESSAGE_HISTORY_SIZE, поэтому достаточно прямого сравнения сигнатур
+        cutoff_time = time.time() - seconds if seconds else None
+        timestamps = history.timestamps
+        signatures = history.signatures
+        count = min(len(timestamps), limit) if limit and limit > 0 else len(timestamps)
+        similar = 0
+        for age in range(count):
+            index = (history.head - 1 - age) % len(timestamps)
+            if cutoff_time is not None and timestamps[index] < cutoff_time:
+                break
+            if bin(signatures[index] ^ signature).count('1') <= max_distance:
+                similar += 1
+        return similar
+    
+    def get_message_frequency(self, user_id, chat_id, seconds=None):
+        """Вычисление частоты сообщений (сообщений в минуту)"""
+        if seconds is None:
+            seconds = self.flood_window
+        
+        history = self.histories.get((user_id, chat_id))
+        if history is None:
+            return 0.0
+        
+        current_time = time.time()
+        if seconds == self.flood_window:
+            # Окно флуда уже поддерживается при добавлении сообщений
+            self._evict_window(history, current_time)
+            count = history.window_size
+        else:
+            # Идем от новых сообщений к старым и останавливаемся на границе окна
+            cutoff_time = current_time - seconds
+            count = 0
+            while count < len(history) and history.timestamps[history.index(count)] >= cutoff_time:
+                count += 1
+        
+        if not count:
+            return 0.0
+        
+        newest_time = history.newest()
+        oldest_time = history.timestamps[history.index(count - 1)]
+        time_span = max(1, newest_time - oldest_time)  # Минимум 1 секунда для избежания деления на 0
+        
+        # Возвращаем сообщений в минуту
+        return (count / time_span) * 60
+
+# Трекер сообщений для обнаружения флуда и анализа.
+# Истории разделены на секции по (user_id, chat_id): обновления разных пар идут параллельно
+# из потоков и задач, а обновления одной пары упорядочены блокировкой ее секции
+class MessageTracker:
+    def __init__(self, message_history_size=MESSAGE_HISTORY_SIZE, flood_window_seconds=60,
+                 max_bytes=TRACKER_MAX_BYTES, idle_ttl=TRACKER_IDLE_TTL, sweep_interval=TRACKER_SWEEP_INTERVAL,
+                 shards=TRACKER_SHARDS):
+        """Инициализация трекера сообщений (лимит памяти делится между секциями поровну)"""
+        self.shards = tuple(
+            TrackerShard(message_history_size, flood_window_seconds, max_bytes // shards, idle_ttl)
+            for _ in range(shards)
+        )
+        self.max_history_size = message_history_size
+        self.flood_window = flood_window_seconds
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.sweeps = 0
+        logger.info(
+            f"MessageTracker инициализирован (история: {message_history_size}, окно флуда: {flood_window_seconds}s, "
+            f"секций: {shards})"
+        )
+    
+    def shard(self, user_id, chat_id):
+        """Секция, в которой хранится история пользователя в чате"""
+        return self.shards[hash((user_id, chat_id)) % len(self.shards)]
+    
+    def add_message(self, user_id, chat_id, message_text, signature=None):
+        """Добавление сообщения; возвращает количество сообщений пользователя в окне флуда"""
+        # Сигнатура считается до блокировки - это самая дорогая часть добавления
+        if signature is None:
+            signature = simhash(message_text)
+        shard = self.shards[hash((user_id, chat_id)) % len(self.shards)]
+        with shard.lock:
+            return shard.add_message(user_id, chat_id, message_text, signature)
+    
+    def sweep(self, current_time=None):
+        """Удаление историй пользователей, молчащих дольше idle_ttl; возвращает число удаленных"""
+        if current_time is None:
+            current_time = time.time()
+        
+        # Секции блокируются по очереди, остальные в это время доступны
+        evicted = 0
+        for shard in self.shards:
+            with shard.lock:
+                evicted += shard.sweep(current_time)
+        self.sweeps += 1
+        return evicted
+    
+    async def run(self):
+        """Периодическая очистка историй молчащих пользователей"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки истории сообщений: {e}")
+    
+    def stats(self):
+        """Размер истории сообщений в памяти"""
+        users = set()
+        metrics = {'histories': 0, 'messages': 0, 'bytes': 0, 'evicted_idle': 0, 'evicted_budget': 0}
+        for shard in self.shards:
+            with shard.lock:
+                users.update(shard.user_chats)
+                metrics['histories'] += len(shard.histories)
+                metrics['messages'] += shard.total_messages
+                metrics['bytes'] += shard.total_bytes
+                metrics['evicted_idle'] += shard.evicted_idle
+                metrics['evicted_budget'] += shard.evicted_budget
+        metrics['users'] = len(users)
+        metrics['sweeps'] = self.sweeps
+        metrics['shards'] = len(self.shards)
+        return metrics
+    
+    def get_user_messages(self, user_id, limit=None, chat_id=None, seconds=None):
+        """Получение истории сообщений пользователя с фильтрацией"""
+        if chat_id is not None:
+            shard = self.shard(user_id, chat_id)
+            with shard.lock:
+                return shard.get_user_messages(user_id, limit, chat_id, seconds)
+        
+        # Чаты пользователя разбросаны по секциям - объединяем их сообщения в порядке времени
+        parts = []
+        for shard in self.shards:
+            with shard.lock:
+                if user_id in shard.user_chats:
+                    parts.append(shard.get_user_messages(user_id, limit, None, seconds))
+        limit = limit if limit and limit > 0 else None
+        messages = list(heapq.merge(*parts, key=lambda msg: msg.timestamp))
+        return messages[-limit:] if limit else messages
+    
+    def count_similar(self, user_id, chat_id, signature, seconds=None, limit=None, max_distance=SIMILAR_MAX_DISTANCE):
+        """Количество недавних сообщений, чей SimHash отличается от signature не больше чем на max_distance бит"""
+        shard = self.shard(user_id, chat_id)
+        with shard.lock:
+            return shard.count_similar(user_id, chat_id, signature, seconds, limit, max_distance)
+    
+    def get_message_frequency(self, user_id, chat_id, seconds=None):
+        """Вычисление частоты сообщений (сообщений в минуту)"""
+        shard = self.shard(user_id, chat_id)
+        with shard.lock:
+            return shard.get_message_frequency(user_id, chat_id, seconds)
+
+# Состояние алгоритма «скользящий журнал»: время последних limit сообщений
+class SlidingLogState:
+    __slots__ = ('rule', 'times', 'head', 'updated')
+    
+    def __init__(self, rule):
+        """Журнал заполнен «давними» сообщениями, поэтому первые limit сообщений проходят"""
+        self.rule = rule
+        self.times = array('d', [float('-inf')]) * rule.limit
+        self.head = 0        # индекс самого старого сообщения в журнале
+        self.updated = 0.0   # время последнего учтенного сообщения
+    
+    def hit(self, now):
+        """Учет сообщения; True, если за период уже было limit сообщений"""
+        times = self.times
+        head = self.head
+        if times[head] > now - self.rule.period:
+            return True
+        times[head] = now
+        head += 1
+        self.head = 0 if head == len(times) else head
+        self.updated = now
+        return False
+    
+    def idle(self, now):
+        """Все сообщения журнала вышли из окна - состояние равно новому"""
+        return self.updated <= now - self.rule.period
+
+# Состояние алгоритма «ведро токенов»: limit токенов, пополняются за period секунд
+class TokenBucketState:
+    __slots__ = ('rule', 'tokens', 'rate', 'updated')
+    
+    def __init__(self, rule):
+        """Новое ведро заполнено"""
+        self.rule = rule
+        self.tokens = float(rule.limit)
+        self.rate = rule.limit / rule.period  # токенов в секунду
+        self.updated = 0.0
+    
+    def hit(self, now):
+        """Списание токена; True, если ведро пусто"""
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.rule.limit:
+            tokens = self.rule.limit
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return True
+        self.tokens = tokens - 1
+        return False
+    
+    def idle(self, now):
+        """Ведро успело заполниться - состояние равно новому"""
+        return self.tokens + (now - self.updated) * self.rate >= self.rule.limit
+
+RATE_LIMIT_STATES = {
+    'sliding_log': SlidingLogState,
+    'token_bucket': TokenBucketState
+}
+
+# Антифлуд: состояние правил группы для каждого участника
+class RateLimiter:
+    def __init__(self, sweep_interval=RATE_LIMIT_SWEEP_INTERVAL, newcomer_period=NEWCOMER_PERIOD):
+        """Инициализация антифлуда"""
+        self.states = {}     # chat_id -> {user_id: состояние правила}
+        self.newcomers = {}  # chat_id -> {user_id: время вступления}
+        self.sweep_interval = sweep_interval
+        self.newcomer_period = newcomer_period
+        self.checks = 0
+        self.limited = 0
+        self.evicted = 0
+    
+    def mark_newcomer(self, chat_id, user_id, joined_at=None):
+        """Отметка вступившего участника (действует newcomer_period секунд)"""
+        self.newcomers.setdefault(chat_id, {})[user_id] = joined_at if joined_at is not None else time.time()
+    
+    def user_class(self, chat_id, user_id, now):
+        """Класс участника для выбора правила"""
+        chat_newcomers = self.newcomers.get(chat_id)
+        if chat_newcomers:
+            joined_at = chat_newcomers.get(user_id)
+            if joined_at is not None and now - joined_at < self.newcomer_period:
+                return 'newcomer'
+        return 'member'
+    
+    def hit(self, chat_id, user_id, rule, now):
+        """Учет сообщения по правилу; True, если лимит превышен"""
+        chat_states = self.states.get(chat_id)
+        if chat_states is None:
+            chat_states = self.states[chat_id] = {}
         
-        # Создаем таблицу информации о пользователях
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_info (
-            id INTEGER PRIMARY KEY,
-            user_id TEXT UNIQUE,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_admin BOOLEAN DEFAULT 0
-        )
-        ''')
+        # Правила декодируются с кэшем, поэтому сменившееся правило - другой объект
+        state = chat_states.get(user_id)
+        if state is None or state.rule is not rule:
+            state = chat_states[user_id] = RATE_LIMIT_STATES[rule.strategy](rule)
         
-        # Создаем таблицу анализа сообщений
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS message_analysis (
-            id INTEGER PRIMARY KEY,
-            group_id TEXT,
-            user_id TEXT,
-            message_id TEXT,
-            message_text TEXT,
-            has_violation BOOLEAN DEFAULT 0,
-            violation_types TEXT,
-            confidence REAL,
-            suggested_warning TEXT,
-            is_warned BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
+        self.checks += 1
+        if state.hit(now):
+            self.limited += 1
+            return True
+        return False
+    
+    def sweep(self, now=None):
+        """Удаление состояний, которые не отличаются от новых, и истекших отметок новичков"""
+        if now is None:
+            now = time.time()
         
-        conn.commit()
+        evicted = 0
+        for chat_id in list(self.states):
+            chat_states = self.states[chat_id]
+            for user_id in [user_id for user_id, state in chat_states.items() if state.idle(now)]:
+                del chat_states[user_id]
+                evicted += 1
+            if not chat_states:
+                del self.states[chat_id]
+        
+        joined_before = now - self.newcomer_period
+        for chat_id in list(self.newcomers):
+            chat_newcomers = self.newcomers[chat_id]
+            for user_id in [user_id for user_id, joined_at in chat_newcomers.items() if joined_at <= joined_before]:
+                del chat_newcomers[user_id]
+            if not chat_newcomers:
+                del self.newcomers[chat_id]
+        
+        self.evicted += evicted
+        return evicted
+    
+    async def run(self):
+        """Периодическая очистка состояний"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки состояний антифлуда: {e}")
+    
+    def stats(self):
+        """Статистика антифлуда"""
+        return {
+            'states': sum(len(chat_states) for chat_states in self.states.values()),
+            'newcomers': sum(len(chat_newcomers) for chat_newcomers in self.newcomers.values()),
+            'checks': self.checks,
+            'limited': self.limited,
+            'evicted': self.evicted
+        }
 
-# ---------------------- УТИЛИТЫ ---------------------- #
+# Сообщения с одинаковым (или почти одинаковым) текстом от разных участников чата
+class ContentCluster:
+    __slots__ = ('signature', 'band_keys', 'entries', 'users')
+    
+    def __init__(self, signature, band_keys):
+        """Кластер по сигнатуре первого сообщения"""
+        self.signature = signature
+        self.band_keys = band_keys
+        self.entries = deque()  # (время, user_id, message_id) в окне
+        self.users = {}         # user_id -> сообщений в окне
 
-# Трекер сообщений для обнаружения флуда и анализа
-class MessageTracker:
-    def __init__(self, message_history_size=100, flood_window_seconds=60):
-        """Инициализация трекера сообщений"""
-        self.message_history = defaultdict(list)  # user_id -> [сообщения]
-        self.max_history_size = message_history_size
-        self.flood_window = flood_window_seconds
-        logger.info(f"MessageTracker инициализирован (история: {message_history_size}, окно флуда: {flood_window_seconds}s)")
-    
-    def add_message(self, user_id, chat_id, message_text):
-        """Добавление сообщения и проверка на флуд"""
-        # Создаем запись о сообщении
-        message = {
-            'text': message_text,
-            'timestamp': time.time(),
-            'chat_id': chat_id
-        }
+# Активность одного чата в скользящем окне
+class ChatActivity:
+    __slots__ = ('messages', 'joins', 'bands', 'clusters', 'last_seen', 'raid_until')
+    
+    def __init__(self):
+        """Пустая активность чата"""
+        self.messages = deque()  # время сообщений в окне
+        self.joins = deque()     # время вступлений в окне
+        self.bands = {}          # ключ полосы сигнатуры -> [кластеры]
+        self.clusters = set()    # кластеры с сообщениями в окне
+        self.last_seen = 0.0
+        self.raid_until = 0.0    # до какого времени чат считается под рейдом
+
+@dataclass(frozen=True)
+class RaidEvent:
+    """Обнаруженный рейд и участники, попавшие под подозрение"""
+    chat_id: int
+    reason: str
+    user_ids: tuple = ()
+    messages: tuple = ()  # пары (участник, сообщение)
+
+# Обнаружение рейдов: общая активность чата по всем участникам
+class RaidDetector:
+    # Сигнатура делится на 8 полос по 8 бит: у текстов, различающихся не больше чем в 7 битах
+    # (RAID_MAX_DISTANCE), хотя бы одна полоса совпадает, поэтому поиск по полосам ничего не пропускает
+    BANDS = 8
+    BAND_BITS = 8
+    
+    def __init__(self, window=RAID_WINDOW, duplicate_users=RAID_DUPLICATE_USERS, join_limit=RAID_JOIN_LIMIT,
+                 message_limit=RAID_MESSAGE_LIMIT, lockdown_time=RAID_LOCKDOWN_TIME, sweep_interval=RAID_SWEEP_INTERVAL):
+        """Инициализация детектора рейдов"""
+        self.chats = {}  # chat_id -> ChatActivity
+        self.saved_permissions = {}  # chat_id -> права чата до закрытия
+        self.window = window
+        self.duplicate_users = duplicate_users
+        self.join_limit = join_limit
+        self.message_limit = message_limit
+        self.lockdown_time = lockdown_time
+        self.sweep_interval = sweep_interval
+        self.events = 0
+        self.band_mask = (1 << self.BAND_BITS) - 1
+    
+    def _activity(self, chat_id, now):
+        """Активность чата (создается при первом обращении)"""
+        activity = self.chats.get(chat_id)
+        if activity is None:
+            activity = self.chats[chat_id] = ChatActivity()
+        activity.last_seen = now
+        return activity
+    
+    def _evict_cluster(self, cluster, window_start):
+        """Удаление из кластера сообщений, вышедших из окна"""
+        entries = cluster.entries
+        users = cluster.users
+        while entries and entries[0][0] < window_start:
+            _, user_id, _ = entries.popleft()
+            left = users[user_id] - 1
+            if left:
+                users[user_id] = left
+            else:
+                del users[user_id]
+    
+    def _raid(self, activity, chat_id, reason, now, cluster=None):
+        """Событие рейда (не чаще одного за время закрытия чата)"""
+        if now < activity.raid_until:
+            return None
+        activity.raid_until = now + self.lockdown_time
+        self.events += 1
+        if cluster is None:
+            return RaidEvent(chat_id, reason)
+        return RaidEvent(
+            chat_id,
+            reason,
+            tuple(cluster.users),
+            tuple((user_id, message_id) for _, user_id, message_id in cluster.entries)
+        )
+    
+    def record_message(self, chat_id, user_id, message_id, signature, now=None):
+        """Учет сообщения в активности чата (signature=None - без сравнения текста); возвращает RaidEvent при рейде"""
+        if now is None:
+            now = time.time()
+        activity = self._activity(chat_id, now)
+        window_start = now - self.window
+        
+        messages = activity.messages
+        messages.append(now)
+        while messages[0] < window_start:
+            messages.popleft()
         
-        # Добавляем в историю
-        if user_id not in self.message_history:
-            self.message_history[user_id] = []
+        if signature is None:
+            if len(messages) >= self.message_limit:
+                return self._raid(activity, chat_id, 'messages', now)
+            return None
         
-        self.message_history[user_id].append(message)
+        # Поиск кластера по полосам сигнатуры: BANDS обращений к словарю и проверка кластеров с той же полосой
+        bands = activity.bands
+        band_keys = tuple(
+            (band << self.BAND_BITS) | (signature >> (band * self.BAND_BITS) & self.band_mask)
+            for band in range(self.BANDS)
+        )
+        cluster = None
+        for key in band_keys:
+            for candidate in bands.get(key, ()):
+                if bin(candidate.signature ^ signature).count('1') <= RAID_MAX_DISTANCE:
+                    cluster = candidate
+                    break
+            if cluster is not None:
+                break
+        if cluster is None:
+            cluster = ContentCluster(signature, band_keys)
+            activity.clusters.add(cluster)
+            for key in band_keys:
+                bands.setdefault(key, []).append(cluster)
         
-        # Ограничиваем размер истории
-        if len(self.message_history[user_id]) > self.max_history_size:
-            self.message_history[user_id] = self.message_history[user_id][-self.max_history_size:]
+        self._evict_cluster(cluster, window_start)
+        cluster.entries.append((now, user_id, message_id))
+        cluster.users[user_id] = cluster.users.get(user_id, 0) + 1
         
-        # Считаем количество сообщений в окне флуда
-        flood_count = 0
-        current_time = time.time()
-        flood_window_start = current_time - self.flood_window
+        if len(cluster.users) >= self.duplicate_users:
+            return self._raid(activity, chat_id, 'duplicates', now, cluster)
+        if len(messages) >= self.message_limit:
+            return self._raid(activity, chat_id, 'messages', now)
+        return None
+    
+    def record_join(self, chat_id, count=1, now=None):
+        """Учет вступлений в чат; возвращает RaidEvent при обнаружении рейда"""
+        if now is None:
+            now = time.time()
+        activity = self._activity(chat_id, now)
+        window_start = now - self.window
         
-        for msg in reversed(self.message_history[user_id]):
-            if msg['timestamp'] >= flood_window_start and msg['chat_id'] == chat_id:
-                flood_count += 1
+        joins = activity.joins
+        for _ in range(count):
+            joins.append(now)
+        while joins[0] < window_start:
+            joins.popleft()
         
-        return flood_count
+        if len(joins) >= self.join_limit:
+            return self._raid(activity, chat_id, 'joins', now)
+        return None
+    
+    def under_raid(self, chat_id, now=None):
+        """Закрыт ли чат из-за рейда"""
+        activity = self.chats.get(chat_id)
+        return activity is not None and (time.time() if now is None else now) < activity.raid_until
+    
+    def end_raid(self, chat_id):
+        """Снятие отметки рейда (чат открыт вручную или по таймеру)"""
+        activity = self.chats.get(chat_id)
+        if activity is not None:
+            activity.raid_until = 0.0
+    
+    def sweep(self, now=None):
+        """Удаление вышедших из окна кластеров и активности молчащих чатов"""
+        if now is None:
+            now = time.time()
+        window_start = now - self.window
+        
+        for chat_id in list(self.chats):
+            activity = self.chats[chat_id]
+            if activity.last_seen < window_start and now >= activity.raid_until:
+                del self.chats[chat_id]
+                continue
+            
+            for cluster in list(activity.clusters):
+                self._evict_cluster(cluster, window_start)
+                if cluster.entries:
+                    continue
+                activity.clusters.discard(cluster)
+                for key in cluster.band_keys:
+                    bucket = activity.bands[key]
+                    bucket.remove(cluster)
+                    if not bucket:
+                        del activity.bands[key]
+    
+    async def run(self):
+        """Периодическая очистка активности"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки активности чатов: {e}")
     
-    def get_user_messages(self, user_id, limit=None, chat_id=None, seconds=None):
-        """Получение истории сообщений пользователя с фильтрацией"""
-        if user_id not in self.message_history:
-            return []
+    def stats(self):
+        """Статистика детектора рейдов"""
+        return {
+            'chats': len(self.chats),
+            'clusters': sum(len(activity.clusters) for activity in self.chats.values()),
+            'events': self.events,
+            'locked': sum(1 for activity in self.chats.values() if time.time() < activity.raid_until)
+        }
+
+# Снимок истории сообщений и состояний антифлуда для быстрого перезапуска
+class TrackerSnapshot:
+    MAGIC = b'TRKS'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHdIII')    # метка, версия, время записи, состояний, новичков, историй
+    STATE = struct.Struct('<qqdB')        # chat_id, user_id, последнее сообщение, длина правила
+    NEWCOMER = struct.Struct('<qqd')      # chat_id, user_id, время вступления
+    HISTORY = struct.Struct('<qqdHHB')    # user_id, chat_id, последнее сообщение, сообщений, в окне, текстов
+    TEXT = struct.Struct('<H')            # длина текста в байтах UTF-8
+    SNAPSHOT_BATCH = 1024                 # Сколько записей собирать, не уступая цикл событий
+    
+    def __init__(self, tracker, limiter, path=TRACKER_SNAPSHOT_FILE, interval=TRACKER_SNAPSHOT_INTERVAL,
+                 restore_budget=TRACKER_RESTORE_BUDGET):
+        """Инициализация снимка трекера и антифлуда"""
+        self.tracker = tracker
+        self.limiter = limiter
+        self.path = path
+        self.interval = interval
+        self.restore_budget = restore_budget
+        self.writes = 0
+        self.size = 0                 # Размер последнего снимка (байты)
+        self.write_ms = 0.0
+        self.restore_ms = 0.0
+        self.restored = {'states': 0, 'newcomers': 0, 'histories': 0}
+        self.restore_complete = True  # Снимок прочитан целиком, а не обрезан по времени
+    
+    def _build(self, chunks, now):
+        """Сборка снимка в chunks; генератор уступает управление каждые SNAPSHOT_BATCH записей"""
+        # Состояния антифлуда идут первыми: без них флудер после перезапуска начнет с чистого листа
+        states = 0
+        for chat_id, chat_states in list(self.limiter.states.items()):
+            for user_id, state in list(chat_states.items()):
+                if state.idle(now):
+                    continue
+                rule = state.rule.encode().encode('ascii')
+                chunks.append(self.STATE.pack(chat_id, user_id, state.updated, len(rule)))
+                chunks.append(rule)
+                if isinstance(state, SlidingLogState):
+                    # Журнал в порядке от старых сообщений к новым
+                    chunks.append((state.times[state.head:] + state.times[:state.head]).tobytes())
+                else:
+                    chunks.append(struct.pack('<d', state.tokens))
+                states += 1
+                if states % self.SNAPSHOT_BATCH == 0:
+                    yield
         
-        messages = self.message_history[user_id]
-        current_time = time.time()
+        newcomers = 0
+        for chat_id, chat_newcomers in list(self.limiter.newcomers.items()):
+            for user_id, joined_at in list(chat_newcomers.items()):
+                chunks.append(self.NEWCOMER.pack(chat_id, user_id, joined_at))
+                newcomers += 1
         
-        # Применяем фильтры
-        if chat_id:
-            messages = [msg for msg in messages if msg['chat_id'] == chat_id]
+        # Истории - по секциям, в секции от недавно писавших к давно молчавшим; кольцо разворачивается
+        # в хронологию. Между порциями секция может измениться, поэтому идем по копии ее ключей
+        histories = 0
+        for shard in self.tracker.shards:
+            with shard.lock:
+                keys = list(reversed(shard.histories))
+            yield
+            for key in keys:
+                with shard.lock:
+                    history = shard.histories.get(key)
+                    if history is None:
+                        continue
+                    user_id, chat_id = key
+                    count = min(len(history.timestamps), len(history.signatures))
+                    head = history.head if count == len(history.timestamps) else 0
+                    texts = [text.encode('utf-8')[:65535] for text in history.texts]
+                    chunks.append(self.HISTORY.pack(
+                        user_id, chat_id, history.last_seen, count, min(history.window_size, count), len(texts)
+                    ))
+                    chunks.append((history.timestamps[head:count] + history.timestamps[:head]).tobytes())
+                    chunks.append((history.signatures[head:count] + history.signatures[:head]).tobytes())
+                for text in texts:
+                    chunks.append(self.TEXT.pack(len(text)))
+                    chunks.append(text)
+                histories += 1
+                if histories % self.SNAPSHOT_BATCH == 0:
+                    yield
         
-        if seconds:
-            cutoff_time = current_time - seconds
-            messages = [msg for msg in messages if msg['timestamp'] >= cutoff_time]
+        chunks.insert(0, self.HEADER.pack(self.MAGIC, self.VERSION, now, states, newcomers, histories))
+    
+    def serialize(self, now=None):
+        """Снимок в виде списка блоков байтов целиком за один вызов"""
+        chunks = []
+        for _ in self._build(chunks, time.time() if now is None else now):
+            pass
+        return chunks
+    
+    def _write_file(self, chunks):
+        """Атомарная запись снимка: во временный файл, затем замена"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.writelines(chunks)
+        os.replace(temp_path, self.path)
+        return os.path.getsize(self.path)
+    
+    def write(self):
+        """Синхронная запись снимка (при завершении работы)"""
+        started = time.perf_counter()
+        self.size = self._write_file(self.serialize())
+        self.writes += 1
+        self.write_ms = (time.perf_counter() - started) * 1000
+    
+    async def run(self):
+        """Периодическая запись снимка: сборка порциями в цикле событий, запись на диск в потоке"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                started = time.perf_counter()
+                chunks = []
+                for _ in self._build(chunks, time.time()):
+                    await asyncio.sleep(0)
+                self.size = await loop.run_in_executor(None, self._write_file, chunks)
+                self.writes += 1
+                self.write_ms = (time.perf_counter() - started) * 1000
+            except Exception as e:
+                logger.error(f"Ошибка записи снимка трекера: {e}")
+    
+    def restore(self, now=None):
+        """Восстановление снимка при запуске (не дольше restore_budget секунд)"""
+        if now is None:
+            now = time.time()
+        started = time.perf_counter()
+        deadline = started + self.restore_budget
         
-        # Ограничиваем количество сообщений
-        if limit and limit > 0:
-            messages = messages[-limit:]
+        # Сборщик циклов на сотнях тысяч новых объектов только тратит время запуска
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._restore_from(data, now, deadline)
+        except FileNotFoundError:
+            pass
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            logger.warning(f"Снимок трекера {self.path} поврежден, восстановлена только часть: {e}")
+        finally:
+            if gc_enabled:
+                gc.enable()
         
-        return messages
+        self.restore_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"Снимок трекера восстановлен за {self.restore_ms:.1f} мс: "
+            f"{self.restored['states']} состояний антифлуда, {self.restored['newcomers']} новичков, "
+            f"{self.restored['histories']} историй" + ("" if self.restore_complete else " (прервано по времени)")
+        )
     
-    def get_message_frequency(self, user_id, chat_id, seconds=None):
-        """Вычисление частоты сообщений (сообщений в минуту)"""
-        if seconds is None:
-            seconds = self.flood_window
+    def _restore_from(self, data, now, deadline):
+        """Разбор снимка из отображенного в память файла"""
+        magic, version, written_at, states, newcomers, histories = self.HEADER.unpack_from(data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"неизвестный формат снимка ({magic!r}, версия {version})")
+        offset = self.HEADER.size
         
-        messages = self.get_user_messages(user_id, chat_id=chat_id, seconds=seconds)
+        limiter = self.limiter
+        # Бюджет проверяем в начале каждой итерации, до любых пропусков записей:
+        # снимок из одних устаревших записей тоже не должен разбираться дольше бюджета
+        for index in range(states):
+            if index % 256 == 0 and time.perf_counter() > deadline:
+                self.restore_complete = False
+                return
+            chat_id, user_id, updated, rule_size = self.STATE.unpack_from(data, offset)
+            offset += self.STATE.size
+            rule = RateLimitRule.decode(data[offset:offset + rule_size].decode('ascii'))
+            offset += rule_size
+            
+            state = RATE_LIMIT_STATES[rule.strategy](rule)
+            state.updated = updated
+            if isinstance(state, SlidingLogState):
+                size = rule.limit * state.times.itemsize
+                state.times = array('d')
+                state.times.frombytes(data[offset:offset + size])
+                offset += size
+            else:
+                state.tokens, = struct.unpack_from('<d', data, offset)
+                offset += 8
+            
+            if not state.idle(now):
+                limiter.states.setdefault(chat_id, {})[user_id] = state
+                self.restored['states'] += 1
         
-        if not messages:
-            return 0.0
+        for index in range(newcomers):
+            if index % 256 == 0 and time.perf_counter() > deadline:
+                self.restore_complete = False
+                return
+            chat_id, user_id, joined_at = self.NEWCOMER.unpack_from(data, offset)
+            offset += self.NEWCOMER.size
+            if now - joined_at < limiter.newcomer_period:
+                limiter.mark_newcomer(chat_id, user_id, joined_at)
+                self.restored['newcomers'] += 1
         
-        # Вычисляем частоту
-        oldest_time = min(msg['timestamp'] for msg in messages)
-        newest_time = max(msg['timestamp'] for msg in messages)
-        time_span = max(1, newest_time - oldest_time)  # Минимум 1 секунда для избежания деления на 0
+        tracker = self.tracker
+        idle_before = now - tracker.idle_ttl
+        for index in range(histories):
+            if index % 256 == 0 and time.perf_counter() > deadline:
+                self.restore_complete = False
+                return
+            user_id, chat_id, last_seen, count, window_size, text_count = self.HISTORY.unpack_from(data, offset)
+            offset += self.HISTORY.size
+            timestamps_offset = offset
+            offset += count * 8
+            signatures_offset = offset
+            offset += count * 8
+            texts = []
+            for _ in range(text_count):
+                size, = self.TEXT.unpack_from(data, offset)
+                offset += self.TEXT.size
+                texts.append(data[offset:offset + size].decode('utf-8'))
+                offset += size
+            
+            if last_seen < idle_before:
+                continue
+            
+            # Число секций могло измениться между запусками - история попадает в свою секцию.
+            # Внутри секции истории записаны от недавних к давним, так что порядок LRU сохраняется
+            shard = tracker.shard(user_id, chat_id)
+            
+            # Размер истории мог уменьшиться между запусками - берем последние сообщения
+            keep = min(count, tracker.max_history_size)
+            skip = count - keep
+            history = ChatHistory(shard.chat_ids.setdefault(chat_id, chat_id))
+            history.timestamps.frombytes(data[timestamps_offset + skip * 8:signatures_offset])
+            history.signatures.frombytes(data[signatures_offset + skip * 8:signatures_offset + count * 8])
+            history.window_size = min(window_size, keep)
+            history.texts.extend(texts)
+            history.last_seen = last_seen
+            history.size += keep * shard.record_size + sum(sys.getsizeof(text) for text in history.texts)
+            
+            if shard.total_bytes + history.size > shard.max_bytes:
+                continue
+            key = (user_id, history.chat_id)
+            shard.histories[key] = history
+            shard.histories.move_to_end(key, last=False)
+            shard.user_chats[user_id].add(history.chat_id)
+            shard.total_messages += keep
+            shard.total_bytes += history.size
+            self.restored['histories'] += 1
+    
+    def stats(self):
+        """Размер и время записи снимка, время восстановления при запуске"""
+        return {
+            'bytes': self.size,
+            'writes': self.writes,
+            'write_ms': self.write_ms,
+            'restore_ms': self.restore_ms,
+            'restored_states': self.restored['states'],
+            'restored_newcomers': self.restored['newcomers'],
+            'restored_histories': self.restored['histories'],
+            'restore_complete': int(self.restore_complete)
+        }
+
+# Автомат Ахо-Корасик: все слова словаря находятся за один проход по тексту,
+# время поиска зависит от длины текста, а не от размера словаря
+class KeywordAutomaton:
+    def __init__(self, terms=()):
+        """Построение автомата по парам (слово, тип нарушения); слова уже в нижнем регистре"""
+        self.transitions = [{}]  # состояние -> {символ: следующее состояние} (префиксное дерево)
+        self.outputs = [()]      # состояние -> ((тип, длина слова), ...) слов, оканчивающихся здесь
+        self.terms = 0
         
-        # Возвращаем сообщений в минуту
-        return (len(messages) / time_span) * 60
+        for term, violation_type in terms:
+            state = 0
+            for char in term:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.outputs.append(())
+                state = next_state
+            if not self.outputs[state]:
+                self.terms += 1
+            self.outputs[state] = ((violation_type, len(term)),)
+        
+        # Ссылки неудач в порядке обхода в ширину: самый длинный собственный суффикс, который есть в дереве.
+        # К выходам состояния добавляются выходы суффикса, чтобы вложенные слова тоже находились
+        self.fail = array('l', [0]) * len(self.transitions)
+        pending = deque(self.transitions[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self.transitions[state].items():
+                pending.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.transitions[fallback].get(char, 0) if state else 0
+                self.fail[next_state] = target
+                if self.outputs[target]:
+                    self.outputs[next_state] += self.outputs[target]
+    
+    def __len__(self):
+        return self.terms
+    
+    def find(self, text):
+        """Вхождения слов в текст: список (тип нарушения, начало, конец)"""
+        transitions = self.transitions
+        fail = self.fail
+        outputs = self.outputs
+        matches = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                for violation_type, length in outputs[state]:
+                    matches.append((violation_type, end - length, end))
+        return matches
 
 # Анализатор сообщений для умных предупреждений
 class WarningAnalyzer:
     def __init__(self):
         """Инициализация анализатора предупреждений"""
-        # Заготовки шаблонов нарушений для демонстрации
+        # Встроенный словарь: ключевые слова без шаблонной части ищутся автоматом, а не регулярным выражением
+        self.builtin_lexicon = {
+            'spam': [
+                'купи', 'продам', 'реклама', 'акция', 'скидка', 'скидки', 'sale', 'http://', 'https://', 'www.',
+                'заработок', 'earn', 'money', 'quick cash'
+            ],
+            'rudeness': ['заткнись', 'fool', 'stupid', 'идиот', 'дебил', 'тупой', 'тупор', 'тупог', 'кретин']
+        }
+        self.lexicon = KeywordAutomaton(self._lexicon_terms())
+        
+        # Заготовки шаблонов нарушений для демонстрации (только то, что не выражается списком слов)
         self.violation_patterns = {
             'spam': [
-                r'купи[те]?|продам|реклама|акция|скидк[аи]|sale|https?://|www\.',
-                r'зарабо[тт]ок|earn|money|quick cash|быстр[ыо].{1,5}деньги',
+                r'быстр[ыо].{1,5}деньги',
                 r'(join|вступ[аи][йт][те]).{1,10}(channel|канал)',
                 r'под[пз]ис[шщ][ие][тс][еь]с[ья]'
             ],
@@ -230,16 +2969,76 @@ class WarningAnalyzer:
                 r'\b[сc][уy][кk][аa]|\b[мm][уy][дd][аa][кk]|\b[дd][уy][рp][аa][кk]|\bлох\b'
             ],
             'rudeness': [
-                r'\b[гg][аоoa][вb][нnh][оoаa]|\b[дd][еe][рp][ьb][мm][оo]|\b[уy][рp][оo][дd]',
-                r'заткнись|fool|stupid|идиот|дебил|тупо[йрг]|кретин'
+                r'\b[гg][аоoa][вb][нnh][оoаa]|\b[дd][еe][рp][ьb][мm][оo]|\b[уy][рp][оo][дd]'
             ],
             'flood': [
-                r'(.)\\1{8,}',  # Повторение одного символа 8+ раз
-                r'(.{1,5})\\1{5,}'  # Повторение группы символов 5+ раз
+                r'(?P<flood_char>.)(?P=flood_char){8,}',  # Повторение одного символа 8+ раз
+                # Повторение группы символов 5+ раз; опережающая проверка отбрасывает позиции,
+                # где первый символ не повторяется в ближайших 5 символах
+                r'(?=(?P<flood_first>.).{0,4}(?P=flood_first))(?P<flood_chunk>.{1,5})(?P=flood_chunk){5,}'
             ]
         }
+        
+        # Все шаблоны собраны в одно выражение с именованной группой на тип нарушения,
+        # поэтому текст просматривается один раз. Шаблоны записаны в нижнем регистре, а текст
+        # приводится к нему перед поиском: IGNORECASE мешает движку отсекать ветви по первому символу
+        type_sources = {
+            violation_type: '|'.join(f'(?:{pattern})' for pattern in patterns)
+            for violation_type, patterns in self.violation_patterns.items()
+        }
+        self.combined_pattern = re.compile('|'.join(
+            f"(?P<{violation_type}>{source})" for violation_type, source in type_sources.items()
+        ))
+        # Отдельные выражения типов - для совпадений, перекрытых совпадением другого типа
+        self.type_patterns = {
+            violation_type: re.compile(source) for violation_type, source in type_sources.items()
+        }
         logger.info(f"WarningAnalyzer инициализирован")
     
+    def _lexicon_terms(self, terms=()):
+        """Пары (слово, тип) встроенного словаря и дополнительных слов"""
+        for violation_type, builtin_terms in self.builtin_lexicon.items():
+            for term in builtin_terms:
+                yield term, violation_type
+        yield from terms
+    
+    def load_lexicon(self, terms):
+        """Замена словаря: автомат строится заново и подменяется целиком (поиск идет без блокировок)"""
+        self.lexicon = KeywordAutomaton(self._lexicon_terms(terms))
+    
+    def stats(self):
+        """Размер словаря"""
+        return {
+            'lexicon_terms': len(self.lexicon),
+            'lexicon_states': len(self.lexicon.transitions)
+        }
+    
+    def find_violations(self, text):
+        """Совпадения слов словаря и шаблонов в тексте (нижний регистр): список (тип нарушения, начало, конец)"""
+        matches = self.lexicon.find(text)
+        pattern_matches = [
+            (match.lastgroup, match.start(), match.end()) for match in self.combined_pattern.finditer(text)
+        ]
+        
+        # finditer не возвращает пересекающиеся совпадения: тип, чье совпадение начинается внутри
+        # найденного совпадения другого типа, теряется. Такие типы ищутся отдельно, начиная с каждого
+        # найденного совпадения. В тексте без совпадений (большинство сообщений) дополнительных проходов нет
+        found = {violation_type for violation_type, _, _ in pattern_matches}
+        for violation_type, pattern in self.type_patterns.items():
+            if violation_type in found:
+                continue
+            for _, start, end in pattern_matches:
+                match = pattern.search(text, start)
+                if match is None:
+                    break
+                if match.start() < end:
+                    matches.append((violation_type, match.start(), match.end()))
+                    break
+        
+        matches.extend(pattern_matches)
+        matches.sort(key=lambda match: match[1])
+        return matches
+    
     def analyze_message(self, message_text, context=None):
         """Анализ сообщения на наличие нарушений"""
         if not message_text:
@@ -247,19 +3046,15 @@ class WarningAnalyzer:
                 'has_violation': False,
                 'violations': [],
                 'confidence': 0.0,
-                'suggested_warning': None
+                'suggested_warning': None,
+                'matches': []
             }
         
-        # Нормализация текста
-        text = message_text.lower()
-        violations = []
-        
-        # Проверяем каждый тип нарушения
-        for violation_type, patterns in self.violation_patterns.items():
-            for pattern in patterns:
-                if re.search(pattern, text, re.IGNORECASE):
-                    violations.append(violation_type)
-                    break  # Если нашли хотя бы один паттерн, переходим к следующему типу
+        # Нормализация текста и поиск всех типов нарушений за один проход. Пробелы схлопываются так же,
+        # как в словах словаря: фраза из словаря находится и при переносе строки между словами
+        matches = self.find_violations(normalize_text(message_text))
+        found = {violation_type for violation_type, _, _ in matches}
+        violations = [violation_type for violation_type in self.violation_patterns if violation_type in found]
         
         # Учитываем контекст для обнаружения флуда
         if context and 'frequency' in context:
@@ -296,12 +3091,302 @@ class WarningAnalyzer:
             'has_violation': has_violation,
             'violations': violations,
             'confidence': confidence,
-            'suggested_warning': suggested_warning
+            'suggested_warning': suggested_warning,
+            'matches': matches
+        }
+
+# Кэш настроек групп
+class GroupSettingsCache:
+    def __init__(self, max_size=GROUP_SETTINGS_CACHE_SIZE):
+        """Инициализация LRU-кэша настроек групп"""
+        self.max_size = max_size
+        self._items = OrderedDict()  # group_id -> GroupContext
+        self._lock = threading.Lock()
+        self._version = 0  # Увеличивается при каждой инвалидации
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def version(self):
+        """Текущая версия кэша (снимается перед чтением из базы)"""
+        return self._version
+    
+    def get(self, group_id):
+        """Получение настроек группы из кэша"""
+        with self._lock:
+            group = self._items.get(group_id)
+            if group is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(group_id)
+            self.hits += 1
+            return group
+    
+    def put(self, group_id, group, version):
+        """Сохранение настроек, если с момента чтения не было инвалидации"""
+        with self._lock:
+            if version != self._version:
+                return  # Настройки изменились, пока мы читали базу
+            self._items[group_id] = group
+            self._items.move_to_end(group_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, group_id=None):
+        """Сброс настроек группы (или всего кэша)"""
+        with self._lock:
+            self._version += 1
+            if group_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(group_id, None)
+    
+    def stats(self):
+        """Статистика использования кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+# Кэш администраторов чатов
+class AdminCache:
+    def __init__(self, ttl=ADMIN_CACHE_TTL, retry=ADMIN_CACHE_RETRY):
+        """Инициализация кэша списков администраторов"""
+        self.ttl = ttl
+        self.retry = retry
+        self._rosters = {}  # chat_id -> (frozenset(user_id), время загрузки)
+        self._refreshing = set()  # Чаты, для которых уже идет фоновое обновление
+        self._backoff = {}  # chat_id -> (время следующей попытки, неудач подряд)
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+    
+    def get(self, chat_id):
+        """Получение списка администраторов и признака его актуальности"""
+        entry = self._rosters.get(chat_id)
+        if entry is None:
+            self.misses += 1
+            return None, False
+        
+        self.hits += 1
+        roster, loaded_at = entry
+        return roster, time.time() - loaded_at < self.ttl
+    
+    def set(self, chat_id, user_ids):
+        """Сохранение полного списка администраторов чата"""
+        self._rosters[chat_id] = (frozenset(user_ids), time.time())
+        self._refreshing.discard(chat_id)
+        self._backoff.pop(chat_id, None)
+        self.refreshes += 1
+    
+    def fail(self, chat_id):
+        """Ошибка загрузки списка: старый список остается, повтор - после паузы"""
+        failures = self._backoff.get(chat_id, (0, 0))[1] + 1
+        delay = min(self.retry * 2 ** (failures - 1), self.ttl)
+        self._backoff[chat_id] = (time.time() + delay, failures)
+        self._refreshing.discard(chat_id)
+        self.failures += 1
+    
+    def update_member(self, chat_id, user_id, is_chat_admin):
+        """Точечное изменение списка по событию chat_member"""
+        entry = self._rosters.get(chat_id)
+        if entry is None:
+            return  # Список еще не загружен, загрузим целиком при первом запросе
+        
+        roster, loaded_at = entry
+        if is_chat_admin:
+            roster = roster | {user_id}
+        else:
+            roster = roster - {user_id}
+        self._rosters[chat_id] = (roster, loaded_at)
+    
+    def start_refresh(self, chat_id):
+        """Отметка о начале обновления (False, если оно уже идет или после ошибки еще не время повтора)"""
+        if chat_id in self._refreshing:
+            return False
+        backoff = self._backoff.get(chat_id)
+        if backoff is not None and time.time() < backoff[0]:
+            return False
+        self._refreshing.add(chat_id)
+        return True
+    
+    def stats(self):
+        """Статистика использования кэша"""
+        total = self.hits + self.misses
+        return {
+            'chats': len(self._rosters),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# Отпечатки последних сохраненных профилей пользователей
+class UserProfileCache:
+    def __init__(self, max_size=USER_PROFILE_CACHE_SIZE):
+        """Инициализация LRU-кэша отпечатков профилей"""
+        self.max_size = max_size
+        self._fingerprints = OrderedDict()  # user_id -> кортеж полей профиля
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.skipped = 0
+    
+    def is_unchanged(self, user_id, fingerprint):
+        """Проверка, совпадает ли профиль с последним сохраненным"""
+        with self._lock:
+            if self._fingerprints.get(user_id) == fingerprint:
+                self._fingerprints.move_to_end(user_id)
+                self.skipped += 1
+                return True
+            return False
+    
+    def remember(self, user_id, fingerprint):
+        """Запоминание сохраненного профиля"""
+        with self._lock:
+            self._fingerprints[user_id] = fingerprint
+            self._fingerprints.move_to_end(user_id)
+            self.writes += 1
+            while len(self._fingerprints) > self.max_size:
+                self._fingerprints.popitem(last=False)
+    
+    def forget(self, user_id=None):
+        """Сброс отпечатка пользователя (или всех отпечатков)"""
+        with self._lock:
+            if user_id is None:
+                self._fingerprints.clear()
+            else:
+                self._fingerprints.pop(user_id, None)
+    
+    def stats(self):
+        """Статистика пропущенных записей"""
+        with self._lock:
+            total = self.writes + self.skipped
+            return {
+                'size': len(self._fingerprints),
+                'writes': self.writes,
+                'skipped': self.skipped,
+                'skip_rate': self.skipped / total if total else 0.0
+            }
+
+# Замер задержки цикла событий
+class LoopLagMonitor:
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        """Инициализация монитора задержки цикла событий"""
+        self.interval = interval
+        self.samples = 0
+        self.last_lag = 0.0
+        self.avg_lag = 0.0
+        self.max_lag = 0.0
+    
+    async def run(self):
+        """Периодически засыпаем и измеряем, насколько позже проснулись"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            
+            self.samples += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            # Экспоненциальное скользящее среднее
+            self.avg_lag = lag if self.samples == 1 else self.avg_lag * 0.9 + lag * 0.1
+    
+    def stats(self):
+        """Статистика задержки в миллисекундах"""
+        return {
+            'samples': self.samples,
+            'last_ms': self.last_lag * 1000,
+            'avg_ms': self.avg_lag * 1000,
+            'max_ms': self.max_lag * 1000
+        }
+
+# Фоновая очистка результатов анализа
+class AnalysisRetentionJob:
+    def __init__(self, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH_SIZE):
+        """Инициализация задачи хранения результатов анализа"""
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.deleted = 0          # Всего удалено строк анализа
+        self.rollup_rows = 0      # Всего записано строк дневной статистики
+        self.freed_pages = 0      # Всего возвращено страниц файла
+        self.last_duration = 0.0
+    
+    async def run(self):
+        """Периодический запуск очистки"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка очистки результатов анализа: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def run_once(self):
+        """Один проход: свертка закрытых дней, удаление старых строк, возврат места"""
+        started = time.time()
+        today = datetime.datetime.utcnow().date()
+        
+        for group_id, retention_days, rollup_day in await run_db(get_retention_groups):
+            self.rollup_rows += await run_db(rollup_analysis_stats, group_id, rollup_day, today)
+            
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+            cutoff = min(cutoff, datetime.datetime.combine(today, datetime.time()))
+            
+            # Удаляем небольшими транзакциями, не блокируя запись надолго
+            while True:
+                deleted = await run_db(
+                    prune_analyses, group_id, cutoff.strftime('%Y-%m-%d %H:%M:%S'), self.batch_size
+                )
+                self.deleted += deleted
+                if deleted < self.batch_size:
+                    break
+                await asyncio.sleep(0)
+        
+        self.freed_pages += await run_db(incremental_vacuum, VACUUM_PAGES_PER_RUN)
+        self.runs += 1
+        self.last_duration = time.time() - started
+    
+    def stats(self):
+        """Статистика очистки"""
+        return {
+            'runs': self.runs,
+            'deleted': self.deleted,
+            'rollup_rows': self.rollup_rows,
+            'freed_pages': self.freed_pages,
+            'last_duration': self.last_duration
         }
 
 # Глобальные экземпляры классов
 message_tracker = MessageTracker()
+rate_limiter = RateLimiter()
+tracker_snapshot = TrackerSnapshot(message_tracker, rate_limiter)
+raid_detector = RaidDetector()
 warning_analyzer = WarningAnalyzer()
+group_settings_cache = GroupSettingsCache()
+admin_cache = AdminCache()
+user_profile_cache = UserProfileCache()
+loop_lag_monitor = LoopLagMonitor()
+analysis_retention_job = AnalysisRetentionJob()
+
+# Ссылки на фоновые задачи, чтобы их не удалил сборщик мусора
+background_tasks = set()
+
+def spawn_background(coro):
+    """Запуск фоновой задачи в текущем цикле событий"""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # ---------------------- УТИЛИТАРНЫЕ ФУНКЦИИ ---------------------- #
 
@@ -309,259 +3394,825 @@ def is_owner(user_id):
     """Проверка, является ли пользователь владельцем бота"""
     return user_id in OWNER_IDS
 
-def is_admin(user_id, chat_id=None):
+async def refresh_chat_admins(bot, chat_id):
+    """Загрузка списка администраторов чата из Telegram"""
+    try:
+        members = await bot.get_chat_administrators(chat_id)
+    except Exception as e:
+        logger.warning(f"Не удалось получить администраторов чата {chat_id}: {e}")
+        admin_cache.fail(chat_id)
+        return None
+    
+    admin_cache.set(chat_id, (member.user.id for member in members))
+    return admin_cache.get(chat_id)[0]
+
+async def get_chat_admins(bot, chat_id):
+    """Получение множества ID администраторов чата"""
+    roster, fresh = admin_cache.get(chat_id)
+    
+    if roster is None:
+        # Первый запрос - загружаем список синхронно
+        if admin_cache.start_refresh(chat_id):
+            roster = await refresh_chat_admins(bot, chat_id)
+    elif not fresh and admin_cache.start_refresh(chat_id):
+        # Устаревший список используем сразу, а обновляем в фоне
+        spawn_background(refresh_chat_admins(bot, chat_id))
+    
+    return roster
+
+async def is_admin(user_id, chat_id=None, bot=None):
     """Проверка, является ли пользователь администратором"""
     # Сначала проверяем, является ли пользователь владельцем
     if is_owner(user_id):
         return True
     
-    # Проверяем запись в базе данных
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_admin FROM user_info WHERE user_id = ?", (str(user_id),))
-        row = cursor.fetchone()
-        
-        if row and row['is_admin']:
-            return True
+    # В группах используем кэшированный список администраторов чата
+    if chat_id is not None and bot is not None and int(chat_id) < 0:
+        roster = await get_chat_admins(bot, int(chat_id))
+        if roster is not None:
+            return int(user_id) in roster
     
-    return False
+    # Проверяем запись в базе данных
+    return await run_db(get_db_admin_flag, user_id)
+
+def get_db_admin_flag(user_id):
+    """Флаг администратора из записи пользователя"""
+    return storage.get_admin_flag(user_id)
 
 def get_group_settings(group_id):
     """Получение настроек группы"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM group_settings WHERE group_id = ?",
-            (str(group_id),)
-        )
-        row = cursor.fetchone()
-        
-        if not row:
-            # Создаем настройки по умолчанию
-            cursor.execute(
-                "INSERT INTO group_settings (group_id) VALUES (?)",
-                (str(group_id),)
-            )
-            conn.commit()
-            
-            cursor.execute(
-                "SELECT * FROM group_settings WHERE group_id = ?",
-                (str(group_id),)
-            )
-            row = cursor.fetchone()
-        
-        return dict(row) if row else None
+    return storage.get_group_settings(group_id)
 
 def get_user_warnings(group_id, user_id):
     """Получение предупреждений пользователя"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM user_warnings WHERE group_id = ? AND user_id = ?",
-            (str(group_id), str(user_id))
-        )
-        row = cursor.fetchone()
-        
-        if not row:
-            # Создаем запись с нулевыми предупреждениями
-            cursor.execute(
-                "INSERT INTO user_warnings (group_id, user_id, warnings) VALUES (?, ?, 0)",
-                (str(group_id), str(user_id))
-            )
-            conn.commit()
-            
-            cursor.execute(
-                "SELECT * FROM user_warnings WHERE group_id = ? AND user_id = ?",
-                (str(group_id), str(user_id))
-            )
-            row = cursor.fetchone()
-        
-        return dict(row) if row else None
+    return storage.get_user_warnings(group_id, user_id)
 
-def update_user_info(user_id, username=None, first_name=None, last_name=None, is_admin=False):
-    """Обновление информации о пользователе"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+def get_warning_count(group_id, user_id):
+    """Текущее количество предупреждений пользователя (без создания записи)"""
+    return storage.get_warning_count(group_id, user_id)
+
+def add_warning(group_id, user_id, reason, max_warnings=MAX_WARNINGS, analysis_id=None):
+    """Атомарная выдача предупреждения"""
+    return storage.add_warning(group_id, user_id, reason, max_warnings, analysis_id)
+
+def remove_warning(group_id, user_id):
+    """Атомарное снятие одного предупреждения; возвращает остаток или None, если снимать нечего"""
+    return storage.remove_warning(group_id, user_id)
+
+def reset_warnings(group_id, user_id):
+    """Сброс счетчика предупреждений"""
+    return storage.reset_warnings(group_id, user_id)
+
+def get_user_record(user_id):
+    """Запись о пользователе из таблицы user_info"""
+    return storage.get_user_record(user_id)
+
+def get_analysis(analysis_id):
+    """Получение результата анализа по ID"""
+    return storage.get_analysis(analysis_id)
+
+async def update_user_info(user_id, username=None, first_name=None, last_name=None, is_admin=None, wait=False):
+    """Обновление информации о пользователе (пропускается, если профиль не изменился)"""
+    user_id = int(user_id)
+    fingerprint = (username, first_name, last_name, is_admin)
+    
+    if user_profile_cache.is_unchanged(user_id, fingerprint):
+        return False
+    
+    # Статус администратора меняем только если он передан явно; владельцы всегда администраторы
+    if is_owner(user_id):
+        admin_flag = 1
+    elif is_admin is not None:
+        admin_flag = 1 if is_admin else 0
+    else:
+        admin_flag = None
+    
+    future = await storage.submit_user(user_id, username, first_name, last_name, admin_flag)
+    
+    # Запоминаем профиль сразу, а при ошибке записи забываем его
+    user_profile_cache.remember(user_id, fingerprint)
+    
+    def forget_on_error(done):
+        if not done.cancelled() and done.exception() is not None:
+            user_profile_cache.forget(user_id)
+    
+    future.add_done_callback(forget_on_error)
+    
+    if wait:
+        await future
+    return True
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    """Правило антифлуда: не больше limit сообщений за period секунд"""
+    strategy: str = FLOOD_STRATEGY
+    limit: int = FLOOD_THRESHOLD
+    period: float = FLOOD_TIME
+    mute_time: int = FLOOD_MUTE_TIME
+    
+    @classmethod
+    def parse(cls, args):
+        """Разбор аргументов команды: алгоритм лимит секунды [минуты_мута]"""
+        if len(args) not in (3, 4):
+            raise ValueError("укажите алгоритм, лимит сообщений, окно в секундах и, при желании, минуты мута")
         
-        # Проверяем, существует ли пользователь
-        cursor.execute("SELECT * FROM user_info WHERE user_id = ?", (str(user_id),))
-        user = cursor.fetchone()
-        
-        if user:
-            # Обновляем существующую запись
-            query = "UPDATE user_info SET "
-            params = []
-            
-            if username is not None:
-                query += "username = ?, "
-                params.append(username)
-            if first_name is not None:
-                query += "first_name = ?, "
-                params.append(first_name)
-            if last_name is not None:
-                query += "last_name = ?, "
-                params.append(last_name)
-            
-            # Обновляем статус администратора только для неосновных владельцев
-            if not is_owner(int(user_id)):
-                query += "is_admin = ?, "
-                params.append(1 if is_admin else 0)
-            
-            # Удаляем последнюю запятую и пробел
-            query = query.rstrip(", ")
-            
-            query += " WHERE user_id = ?"
-            params.append(str(user_id))
-            
-            if len(params) > 1:  # Есть что обновлять
-                cursor.execute(query, params)
-        else:
-            # Создаем нового пользователя
-            is_owner_flag = 1 if is_owner(int(user_id)) else 0
-            is_admin_flag = 1 if is_admin or is_owner_flag else 0
-            
-            cursor.execute(
-                "INSERT INTO user_info (user_id, username, first_name, last_name, is_admin) VALUES (?, ?, ?, ?, ?)",
-                (str(user_id), username, first_name, last_name, is_admin_flag)
-            )
+        strategy = args[0].lower()
+        if strategy not in RATE_LIMIT_STRATEGIES:
+            raise ValueError(f"неизвестный алгоритм '{args[0]}', доступны: {', '.join(RATE_LIMIT_STRATEGIES)}")
+        try:
+            limit = int(args[1])
+            period = float(args[2])
+            mute_minutes = int(args[3]) if len(args) == 4 else FLOOD_MUTE_TIME // 60
+        except ValueError:
+            raise ValueError("лимит, окно и минуты мута должны быть числами")
         
-        conn.commit()
+        if not 1 <= limit <= RATE_LIMIT_MAX_MESSAGES:
+            raise ValueError(f"лимит сообщений должен быть от 1 до {RATE_LIMIT_MAX_MESSAGES}")
+        if not 1 <= period <= RATE_LIMIT_MAX_PERIOD:
+            raise ValueError(f"окно должно быть от 1 до {RATE_LIMIT_MAX_PERIOD} секунд")
+        if mute_minutes < 1:
+            raise ValueError("мут должен длиться хотя бы минуту")
+        return cls(strategy, limit, period, mute_minutes * 60)
+    
+    def encode(self):
+        """Запись правила для хранения в group_settings"""
+        return f"{self.strategy}:{self.limit}:{self.period:g}:{self.mute_time}"
+    
+    @staticmethod
+    def decode(value, fallback=None):
+        """Правило из group_settings; для NULL и некорректной строки - fallback (по умолчанию
+        общее правило группы)"""
+        return RateLimitRule._decode(value) or fallback or DEFAULT_FLOOD_RULE
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _decode(value):
+        """Разбор строки правила (None, если строки нет или она некорректна); одинаковые строки дают один объект"""
+        if not value:
+            return None
+        try:
+            strategy, limit, period, mute_time = value.split(':')
+            rule = RateLimitRule(strategy, int(limit), float(period), int(mute_time))
+        except ValueError:
+            logger.warning(f"Некорректное правило антифлуда '{value}', используется правило по умолчанию")
+            return None
+        if rule.strategy not in RATE_LIMIT_STRATEGIES or rule.limit < 1 or rule.period <= 0:
+            logger.warning(f"Некорректное правило антифлуда '{value}', используется правило по умолчанию")
+            return None
+        # Совпадающее с умолчанием правило - тот же объект, чтобы не сбрасывать состояние участников
+        for default_rule in (DEFAULT_FLOOD_RULE, DEFAULT_NEWCOMER_FLOOD_RULE):
+            if rule == default_rule:
+                return default_rule
+        return rule
+    
+    def describe(self):
+        """Описание правила для администраторов"""
+        return f"{self.limit} сообщ. за {self.period:g} с ({self.strategy}), мут {self.mute_time // 60} мин"
 
-def check_flood(user_id, chat_id, message_text):
-    """Проверка на флуд"""
-    # Получаем настройки группы
-    settings = get_group_settings(chat_id)
+DEFAULT_FLOOD_RULE = RateLimitRule()
+DEFAULT_NEWCOMER_FLOOD_RULE = RateLimitRule(limit=NEWCOMER_FLOOD_THRESHOLD)
+
+@dataclass(frozen=True)
+class GroupContext:
+    """Настройки группы, загружаемые один раз на обновление"""
+    group_id: int
+    welcome_message: str
+    rules: str
+    anti_flood: bool
+    smart_warnings: bool
+    smart_warnings_auto: bool
+    min_confidence: float
+    enabled_types: frozenset
+    retention_days: int
+    flood_rule: RateLimitRule
+    newcomer_flood_rule: RateLimitRule
+    raid_protection: bool
+    
+    @classmethod
+    def from_settings(cls, group_id, settings):
+        """Создание контекста из строки таблицы group_settings"""
+        settings = settings or {}
+        types_str = settings.get('smart_warnings_enabled_types') or ''
+        return cls(
+            group_id=int(group_id),
+            welcome_message=settings.get('welcome_message') or "Добро пожаловать, {name}!",
+            rules=settings.get('rules') or "Правила не установлены!",
+            anti_flood=bool(settings.get('anti_flood', True)),
+            smart_warnings=bool(settings.get('smart_warnings', False)),
+            smart_warnings_auto=bool(settings.get('smart_warnings_auto', False)),
+            min_confidence=float(settings.get('smart_warnings_min_confidence', 0.8)),
+            enabled_types=frozenset(t.strip() for t in types_str.split(',') if t.strip()),
+            retention_days=int(settings.get('analysis_retention_days') or ANALYSIS_RETENTION_DAYS),
+            flood_rule=RateLimitRule.decode(settings.get('flood_rule')),
+            newcomer_flood_rule=RateLimitRule.decode(
+                settings.get('newcomer_flood_rule'), DEFAULT_NEWCOMER_FLOOD_RULE
+            ),
+            raid_protection=bool(settings.get('raid_protection', False))
+        )
+    
+    @property
+    def auto_warnings(self):
+        """Автопредупреждения работают только вместе с умными предупреждениями"""
+        return self.smart_warnings and self.smart_warnings_auto
     
-    if not settings or not settings['anti_flood']:
-        return False  # Антифлуд отключен
+    def rate_limit_rule(self, user_class):
+        """Правило антифлуда для класса участника"""
+        return self.newcomer_flood_rule if user_class == 'newcomer' else self.flood_rule
+
+def _load_group_context(group_id):
+    """Загрузка настроек группы из базы в кэш"""
+    version = group_settings_cache.version
+    group = GroupContext.from_settings(group_id, get_group_settings(group_id))
+    group_settings_cache.put(group_id, group, version)
+    return group
+
+def get_group_context(group_id):
+    """Получение настроек группы в виде контекста обновления (через кэш)"""
+    group_id = int(group_id)
+    group = group_settings_cache.get(group_id)
+    return group if group is not None else _load_group_context(group_id)
+
+async def fetch_group_context(group_id):
+    """Асинхронное получение настроек группы: из кэша сразу, из базы - в потоке БД"""
+    group_id = int(group_id)
+    group = group_settings_cache.get(group_id)
+    return group if group is not None else await run_db(_load_group_context, group_id)
+
+def check_flood(user_id, chat_id, message_text, group=None, signature=None):
+    """Проверка на флуд: нарушенное правило антифлуда или None"""
+    # Получаем настройки группы, если они не переданы обработчиком
+    if group is None:
+        group = get_group_context(chat_id)
     
-    # Добавляем сообщение в трекер и получаем количество сообщений в окне флуда
-    flood_count = message_tracker.add_message(user_id, chat_id, message_text)
+    if not group.anti_flood:
+        return None  # Антифлуд отключен
     
-    # Проверка на флуд
-    if flood_count > FLOOD_THRESHOLD:
-        return True
+    # Добавляем сообщение в историю для анализа
+    message_tracker.add_message(user_id, chat_id, message_text, signature)
     
-    return False
+    # Проверяем лимит по правилу группы для класса участника
+    now = time.time()
+    rule = group.rate_limit_rule(rate_limiter.user_class(chat_id, user_id, now))
+    if rate_limiter.hit(chat_id, user_id, rule, now):
+        return rule
+    
+    return None
 
 def is_smart_warnings_enabled(group_id):
     """Проверка, включены ли умные предупреждения"""
-    settings = get_group_settings(group_id)
-    return settings and settings['smart_warnings']
+    return get_group_context(group_id).smart_warnings
 
 def is_auto_warnings_enabled(group_id):
     """Проверка, включены ли автоматические предупреждения"""
-    settings = get_group_settings(group_id)
-    return settings and settings['smart_warnings'] and settings['smart_warnings_auto']
+    return get_group_context(group_id).auto_warnings
 
 def get_enabled_violation_types(group_id):
     """Получение списка включенных типов нарушений"""
-    settings = get_group_settings(group_id)
-    if not settings or not settings['smart_warnings_enabled_types']:
-        return []
-    
-    return settings['smart_warnings_enabled_types'].split(',')
+    enabled_types = get_group_context(group_id).enabled_types
+    return [t for t in VIOLATION_TYPES if t in enabled_types]
 
 def get_min_confidence(group_id):
     """Получение минимальной уверенности для автопредупреждений"""
-    settings = get_group_settings(group_id)
-    if not settings:
-        return 0.8
-    
-    return float(settings['smart_warnings_min_confidence'])
+    return get_group_context(group_id).min_confidence
+
+def _update_group_setting(group_id, column, value):
+    """Изменение одной настройки группы со сбросом кэша"""
+    updated = storage.update_group_setting(group_id, column, value)
+    group_settings_cache.invalidate(int(group_id))
+    return updated
 
 def toggle_smart_warnings(group_id, enabled=False):
     """Включение/выключение умных предупреждений"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET smart_warnings = ? WHERE group_id = ?",
-            (1 if enabled else 0, str(group_id))
-        )
-        conn.commit()
-        return cursor.rowcount > 0
+    return _update_group_setting(group_id, 'smart_warnings', 1 if enabled else 0)
 
 def toggle_auto_warnings(group_id, enabled=False):
     """Включение/выключение автоматических предупреждений"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET smart_warnings_auto = ? WHERE group_id = ?",
-            (1 if enabled else 0, str(group_id))
-        )
-        conn.commit()
-        return cursor.rowcount > 0
+    return _update_group_setting(group_id, 'smart_warnings_auto', 1 if enabled else 0)
 
 def set_enabled_violation_types(group_id, types):
     """Установка включенных типов нарушений"""
-    types_str = ','.join(types)
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET smart_warnings_enabled_types = ? WHERE group_id = ?",
-            (types_str, str(group_id))
+    return _update_group_setting(group_id, 'smart_warnings_enabled_types', ','.join(types))
+
+def set_min_confidence(group_id, confidence):
+    """Установка минимальной уверенности для автопредупреждений"""
+    return _update_group_setting(group_id, 'smart_warnings_min_confidence', float(confidence))
+
+def set_anti_flood(group_id, enabled=True):
+    """Включение/выключение защиты от флуда"""
+    return _update_group_setting(group_id, 'anti_flood', 1 if enabled else 0)
+
+def set_group_rules(group_id, rules_text):
+    """Установка правил группы"""
+    return _update_group_setting(group_id, 'rules', rules_text)
+
+def set_welcome_message(group_id, welcome_text):
+    """Установка приветственного сообщения"""
+    return _update_group_setting(group_id, 'welcome_message', welcome_text)
+
+def set_flood_rule(group_id, user_class, rule=None):
+    """Установка правила антифлуда для класса участников (None - правило по умолчанию)"""
+    column = 'newcomer_flood_rule' if user_class == 'newcomer' else 'flood_rule'
+    return _update_group_setting(group_id, column, rule.encode() if rule else None)
+
+def set_raid_protection(group_id, enabled=True):
+    """Включение/выключение защиты от рейдов"""
+    return _update_group_setting(group_id, 'raid_protection', 1 if enabled else 0)
+
+async def record_analysis(group_id, user_id, message_id, message_text, analysis_result, is_warned=False, wait=True):
+    """Запись результата анализа сообщения (при wait=True возвращает ID записи)"""
+    violation_types = ','.join(analysis_result['violations']) if analysis_result['violations'] else ''
+    
+    future = await storage.submit_analysis(
+        group_id,
+        user_id,
+        message_id,
+        message_text,
+        analysis_result['has_violation'],
+        violation_types,
+        analysis_result['confidence'],
+        analysis_result['suggested_warning'],
+        is_warned
+    )
+    
+    if not wait:
+        return None
+    return await future
+
+@dataclass(frozen=True)
+class AnalysisFilters:
+    """Фильтры просмотра результатов анализа (/analyses)"""
+    user_id: Optional[int] = None
+    violation_type: Optional[str] = None
+    warned: Optional[bool] = None
+    since: Optional[datetime.date] = None
+    until: Optional[datetime.date] = None
+    
+    @classmethod
+    def parse(cls, args, reply_user_id=None):
+        """Разбор аргументов команды: user:ID type:spam warned|unwarned days:N from:ДАТА to:ДАТА"""
+        values = {'user_id': reply_user_id}
+        for arg in args:
+            key, _, value = arg.lower().partition(':')
+            if key == 'user' and value.lstrip('-').isdigit():
+                values['user_id'] = int(value)
+            elif key == 'type' and value in VIOLATION_TYPES:
+                values['violation_type'] = value
+            elif key in ('warned', 'unwarned') and not value:
+                values['warned'] = key == 'warned'
+            elif key == 'days' and value.isdigit() and int(value) > 0:
+                today = datetime.datetime.utcnow().date()
+                values['since'] = today - datetime.timedelta(days=int(value) - 1)
+            elif key in ('from', 'to'):
+                try:
+                    date = datetime.date.fromisoformat(value)
+                except ValueError:
+                    raise ValueError(f"неверная дата '{value}', используйте формат ГГГГ-ММ-ДД")
+                values['since' if key == 'from' else 'until'] = date
+            else:
+                raise ValueError(f"неизвестный фильтр '{arg}'")
+        return cls(**values)
+    
+    def encode(self):
+        """Компактная запись фильтров для callback_data (лимит Telegram - 64 байта)"""
+        warned = 'a' if self.warned is None else ('y' if self.warned else 'n')
+        return '_'.join((
+            str(self.user_id or ''),
+            self.violation_type or '',
+            warned,
+            self.since.strftime('%y%m%d') if self.since else '',
+            self.until.strftime('%y%m%d') if self.until else ''
+        ))
+    
+    @classmethod
+    def decode(cls, parts):
+        """Восстановление фильтров из частей callback_data"""
+        user_id, violation_type, warned, since, until = parts
+        parse_date = lambda value: datetime.datetime.strptime(value, '%y%m%d').date() if value else None
+        return cls(
+            user_id=int(user_id) if user_id else None,
+            violation_type=violation_type if violation_type in VIOLATION_TYPES else None,
+            warned=None if warned == 'a' else warned == 'y',
+            since=parse_date(since),
+            until=parse_date(until)
         )
-        conn.commit()
-        return cursor.rowcount > 0
+    
+    def describe(self):
+        """Описание фильтров для заголовка страницы"""
+        parts = []
+        if self.user_id:
+            parts.append(f"пользователь {self.user_id}")
+        if self.violation_type:
+            parts.append(f"тип {self.violation_type}")
+        if self.warned is not None:
+            parts.append("с предупреждением" if self.warned else "без предупреждения")
+        if self.since:
+            parts.append(f"с {self.since.isoformat()}")
+        if self.until:
+            parts.append(f"по {self.until.isoformat()}")
+        return ', '.join(parts)
+
+def get_analyses_page(group_id, analysis_filters, after_id=None, limit=ANALYSES_PAGE_SIZE):
+    """Страница результатов анализа (новые сверху) после записи after_id"""
+    return storage.get_analyses_page(group_id, analysis_filters, after_id, limit)
+
+def build_search_query(text):
+    """Запрос FTS5 из текста пользователя: каждое слово - отдельная фраза (без операторов FTS)"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"' for term in terms)
+
+def search_analyses(group_id, text, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Поиск сообщений группы по тексту (по релевантности), возвращает (строки, есть_еще, обрезано)"""
+    return storage.search_analyses(group_id, text, offset, limit)
+
+def set_analysis_retention(group_id, days):
+    """Установка срока хранения результатов анализа (в днях)"""
+    return _update_group_setting(group_id, 'analysis_retention_days', max(1, int(days)))
+
+def get_retention_groups():
+    """Группы со сроком хранения и последним свернутым днем"""
+    return storage.get_retention_groups()
+
+def rollup_analysis_stats(group_id, rollup_day, today):
+    """Свертка закрытых дней (до today) в дневную статистику, возвращает число записанных строк"""
+    return storage.rollup_analysis_stats(group_id, rollup_day, today)
+
+def prune_analyses(group_id, cutoff, limit=RETENTION_BATCH_SIZE):
+    """Удаление одной порции результатов анализа старше cutoff"""
+    return storage.prune_analyses(group_id, cutoff, limit)
+
+def incremental_vacuum(pages):
+    """Возврат свободных страниц файлу системы, возвращает число освобожденных страниц"""
+    return storage.compact(pages)
+
+def normalize_text(text):
+    """Текст в нижнем регистре с пробелами, схлопнутыми до одного (так его просматривает анализатор)"""
+    return ' '.join(text.lower().split())
+
+def normalize_lexicon_term(term):
+    """Слово словаря в том виде, в каком его ищет анализатор (None, если слово не подходит)"""
+    term = normalize_text(term)
+    if not term or len(term) > LEXICON_MAX_TERM_LENGTH:
+        return None
+    return term
+
+def get_lexicon():
+    """Слова словаря: список (слово, тип нарушения)"""
+    return storage.get_lexicon()
+
+def add_lexicon_terms(violation_type, terms, added_by=None):
+    """Добавление слов в словарь, возвращает число добавленных или измененных"""
+    return storage.add_lexicon_terms(violation_type, terms, added_by)
+
+def remove_lexicon_terms(terms):
+    """Удаление слов из словаря, возвращает число удаленных"""
+    return storage.remove_lexicon_terms(terms)
+
+def get_violation_stats(group_id, days=7):
+    """Количество сообщений по типам нарушений за последние дни (статистика + сегодняшние строки)"""
+    return storage.get_violation_stats(group_id, days)
+
+# ------ Экспорт и импорт ------ #
+
+# Таблицы в порядке импорта: (таблица, отбор строк группы, ключ для обновления).
+# Строки анализа получают новые id (ключ None), чтобы не конфликтовать с историей получателя.
+EXPORT_TABLES = (
+    ('group_settings', "group_id = :group_id", ('group_id',)),
+    ('user_info', "user_id IN (SELECT user_id FROM user_warnings WHERE group_id = :group_id "
+                  "UNION SELECT user_id FROM message_analysis WHERE group_id = :group_id)", ('user_id',)),
+    ('user_warnings', "group_id = :group_id", ('group_id', 'user_id')),
+    ('analysis_daily_stats', "group_id = :group_id", ('group_id', 'day', 'violation_type')),
+    ('message_analysis', "group_id = :group_id", None),
+)
+EXPORT_FORMATS = ('jsonl', 'csv')
+EXPORT_MANIFEST = 'manifest.json'
 
-def set_min_confidence(group_id, confidence):
-    """Установка минимальной уверенности для автопредупреждений"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET smart_warnings_min_confidence = ? WHERE group_id = ?",
-            (float(confidence), str(group_id))
-        )
-        conn.commit()
-        return cursor.rowcount > 0
+def file_sha256(path):
+    """Контрольная сумма файла (читается блоками)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-def record_analysis(group_id, user_id, message_id, message_text, analysis_result, is_warned=False):
-    """Запись результата анализа сообщения"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+def _export_table(conn, table, where, path, fmt, group_id):
+    """Потоковая выгрузка одной таблицы в файл, возвращает (колонки, число строк)"""
+    sql = f"SELECT * FROM {table}"
+    params = {}
+    if group_id is not None:
+        sql += f" WHERE {where}"
+        params['group_id'] = int(group_id)
+    
+    cursor = conn.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    rows = 0
+    
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = None
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
         
-        violation_types = ','.join(analysis_result['violations']) if analysis_result['violations'] else ''
+        # Курсор читается порциями, таблица целиком в память не попадает
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            for row in chunk:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+            rows += len(chunk)
+    
+    return columns, rows
+
+def export_data(directory, fmt='jsonl', group_id=None):
+    """Выгрузка данных (всех или одной группы) в каталог с манифестом и контрольными суммами"""
+    if not isinstance(storage, SQLiteStorage):
+        raise ValueError("выгрузка доступна только для хранилища SQLite")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"неизвестный формат '{fmt}', доступны: {', '.join(EXPORT_FORMATS)}")
+    os.makedirs(directory, exist_ok=True)
+    
+    manifest = {
+        'format': fmt,
+        'group_id': int(group_id) if group_id is not None else None,
+        'created_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+        'tables': {}
+    }
+    
+    with get_db_connection() as conn:
+        manifest['schema_version'] = get_schema_version(conn)
+        # Одна читающая транзакция - согласованный снимок всех таблиц
+        conn.execute("BEGIN")
+        try:
+            for table, where, _ in EXPORT_TABLES:
+                filename = f"{table}.{fmt}"
+                path = os.path.join(directory, filename)
+                columns, rows = _export_table(conn, table, where, path, fmt, group_id)
+                manifest['tables'][table] = {
+                    'file': filename,
+                    'columns': columns,
+                    'rows': rows,
+                    'sha256': file_sha256(path)
+                }
+                logger.info(f"Экспорт {table}: {rows} строк")
+        finally:
+            conn.rollback()
+    
+    with open(os.path.join(directory, EXPORT_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+def _read_export_rows(path, fmt, columns):
+    """Потоковое чтение строк выгрузки в виде кортежей значений колонок"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header != columns:
+                raise ValueError(f"заголовок {os.path.basename(path)} не совпадает с манифестом")
+            # В CSV нет NULL: пустые значения читаются как NULL, типы приводит SQLite
+            for row in reader:
+                yield tuple(value if value != '' else None for value in row)
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield tuple(record.get(column) for column in columns)
+
+def _import_update(column):
+    """Обновление колонки существующей строки при импорте"""
+    if column == 'analysis_rollup_day':
+        # День свертки не откатываем назад: иначе уже свернутые дни посчитаются в статистике повторно
+        return (f"{column} = CASE WHEN {column} IS NULL OR excluded.{column} > {column} "
+                f"THEN excluded.{column} ELSE {column} END")
+    return f"{column} = excluded.{column}"
+
+def _import_sql(table, columns, key):
+    """Запрос вставки порции строк: обновление по ключу или вставка с новым id"""
+    placeholders = ', '.join('?' for _ in columns)
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if key:
+        updates = ', '.join(_import_update(column) for column in columns if column not in key)
+        sql += f" ON CONFLICT({', '.join(key)}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING")
+    return sql
+
+def _exported_stat_days(directory, manifest, fmt):
+    """Дни (группа, день), дневная статистика которых есть в выгрузке"""
+    info = manifest['tables'].get('analysis_daily_stats')
+    if not info or 'group_id' not in info['columns'] or 'day' not in info['columns']:
+        return set()
+    group_index = info['columns'].index('group_id')
+    day_index = info['columns'].index('day')
+    rows = _read_export_rows(os.path.join(directory, info['file']), fmt, info['columns'])
+    return {(int(row[group_index]), str(row[day_index])) for row in rows}
+
+def _imported_daily_stats(chunk, columns, rollup_days, covered):
+    """Дневная статистика импортируемых результатов анализа за уже свернутые дни.
+    
+    Свертка идет только вперед от analysis_rollup_day, поэтому строки за более ранние дни
+    сами в статистику не попадут. Дни, статистика которых есть в самой выгрузке, пропускаем:
+    эти строки в ней уже учтены.
+    """
+    if not rollup_days or 'group_id' not in columns or 'created_at' not in columns:
+        return []
+    group_index = columns.index('group_id')
+    created_index = columns.index('created_at')
+    types_index = columns.index('violation_types') if 'violation_types' in columns else None
+    warned_index = columns.index('is_warned') if 'is_warned' in columns else None
+    
+    stats = defaultdict(lambda: [0, 0])
+    for row in chunk:
+        if row[group_index] is None or not row[created_index]:
+            continue
+        group_id = int(row[group_index])
+        day = str(row[created_index])[:10]
+        rollup_day = rollup_days.get(group_id)
+        if rollup_day is None or day > rollup_day or (group_id, day) in covered:
+            continue
         
-        cursor.execute(
+        warned = int(row[warned_index] or 0) if warned_index is not None else 0
+        types = (row[types_index] or '').split(',') if types_index is not None else []
+        # Пустой тип - строка со всеми сообщениями за день (как в rollup_analysis_stats)
+        for violation_type in ('',) + tuple(t for t in VIOLATION_TYPES if t in types):
+            entry = stats[(group_id, day, violation_type)]
+            entry[0] += 1
+            entry[1] += warned
+    
+    return [key + tuple(value) for key, value in stats.items()]
+
+def _write_import_chunk(conn, sql, chunk, import_id, table, rows_done, finished=False, daily_stats=()):
+    """Запись порции строк вместе с отметкой прогресса - одной транзакцией"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(sql, chunk)
+        if daily_stats:
+            # В той же транзакции, чтобы продолжение прерванного импорта не посчитало строки дважды
+            conn.executemany(
+                """
+                INSERT INTO analysis_daily_stats (group_id, day, violation_type, messages, warned)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(group_id, day, violation_type) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    warned = warned + excluded.warned
+                """,
+                daily_stats
+            )
+        conn.execute(
             """
-            INSERT INTO message_analysis 
-            (group_id, user_id, message_id, message_text, has_violation, 
-             violation_types, confidence, suggested_warning, is_warned)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO import_progress (import_id, table_name, rows_done, finished)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(import_id, table_name) DO UPDATE SET
+                rows_done = excluded.rows_done,
+                finished = excluded.finished,
+                updated_at = CURRENT_TIMESTAMP
             """,
-            (
-                str(group_id),
-                str(user_id),
-                str(message_id),
-                message_text,
-                1 if analysis_result['has_violation'] else 0,
-                violation_types,
-                analysis_result['confidence'],
-                analysis_result['suggested_warning'],
-                1 if is_warned else 0
-            )
+            (import_id, table, rows_done, 1 if finished else 0)
         )
-        
         conn.commit()
-        return cursor.lastrowid
+    except Exception:
+        conn.rollback()
+        raise
 
-def get_last_analysis(group_id, limit=10):
-    """Получение последних результатов анализа"""
+def import_data(directory):
+    """Импорт выгрузки порциями; прерванный импорт той же выгрузки продолжается с места остановки"""
+    if not isinstance(storage, SQLiteStorage):
+        raise ValueError("импорт доступен только для хранилища SQLite")
+    manifest_path = os.path.join(directory, EXPORT_MANIFEST)
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    import_id = file_sha256(manifest_path)
+    fmt = manifest.get('format')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"неизвестный формат выгрузки '{fmt}'")
+    
+    # Сначала проверяем целостность всех файлов, чтобы не импортировать половину поврежденной выгрузки
+    for table, info in manifest['tables'].items():
+        if file_sha256(os.path.join(directory, info['file'])) != info['sha256']:
+            raise ValueError(f"контрольная сумма файла {info['file']} не совпадает")
+    
+    imported = {}
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM message_analysis WHERE group_id = ? ORDER BY created_at DESC LIMIT ?",
-            (str(group_id), limit)
-        )
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        for table, _, key in EXPORT_TABLES:
+            info = manifest['tables'].get(table)
+            if not info:
+                continue
+            
+            progress = conn.execute(
+                "SELECT rows_done, finished FROM import_progress WHERE import_id = ? AND table_name = ?",
+                (import_id, table)
+            ).fetchone()
+            rows_done = progress['rows_done'] if progress else 0
+            if progress and progress['finished']:
+                imported[table] = 0
+                continue
+            
+            # Колонки, которых нет в нашей схеме, пропускаем; id анализа назначается заново
+            existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+            indexes = [i for i, column in enumerate(info['columns'])
+                       if column in existing and not (key is None and column == 'id')]
+            columns = [info['columns'][i] for i in indexes]
+            sql = _import_sql(table, columns, key)
+            
+            # Результаты анализа за уже свернутые дни сразу добавляем в дневную статистику
+            rollup_days, covered = {}, set()
+            if table == 'message_analysis':
+                rollup_days = {
+                    row['group_id']: row['analysis_rollup_day']
+                    for row in conn.execute("SELECT group_id, analysis_rollup_day FROM group_settings")
+                }
+                covered = _exported_stat_days(directory, manifest, fmt)
+            
+            rows = _read_export_rows(os.path.join(directory, info['file']), fmt, info['columns'])
+            skipped = 0
+            chunk = []
+            count = 0
+            
+            for row in rows:
+                # Строки, записанные до прерывания, пропускаем
+                if skipped < rows_done:
+                    skipped += 1
+                    continue
+                chunk.append(tuple(row[i] for i in indexes))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    count += len(chunk)
+                    _write_import_chunk(conn, sql, chunk, import_id, table, rows_done + count,
+                                        daily_stats=_imported_daily_stats(chunk, columns, rollup_days, covered))
+                    chunk = []
+            
+            count += len(chunk)
+            _write_import_chunk(conn, sql, chunk, import_id, table, rows_done + count, finished=True,
+                                daily_stats=_imported_daily_stats(chunk, columns, rollup_days, covered))
+            imported[table] = count
+            logger.info(f"Импорт {table}: {count} строк (пропущено уже импортированных: {rows_done})")
+    
+    # Настройки и профили могли измениться в обход кэшей
+    group_settings_cache.invalidate()
+    user_profile_cache.forget()
+    return imported
+
+def pack_export(directory, archive_path):
+    """Упаковка каталога выгрузки в zip-архив"""
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(os.listdir(directory)):
+            archive.write(os.path.join(directory, name), name)
+    return archive_path
+
+def unpack_export(archive_path, directory):
+    """Распаковка архива выгрузки (только манифест и файлы, перечисленные в нем)"""
+    with zipfile.ZipFile(archive_path) as archive:
+        manifest = json.loads(archive.read(EXPORT_MANIFEST).decode('utf-8'))
+        names = [EXPORT_MANIFEST] + [info['file'] for info in manifest['tables'].values()]
+        for name in names:
+            # Защита от путей вида ../file внутри архива
+            if os.path.basename(name) != name:
+                raise ValueError(f"недопустимое имя файла в архиве: {name}")
+            with archive.open(name) as source, open(os.path.join(directory, name), 'wb') as target:
+                shutil.copyfileobj(source, target)
+    return directory
+
+def get_bot_metrics():
+    """Сбор метрик бота для файла состояния"""
+    metrics = {}
+    for key, value in storage.stats().items():
+        metrics[f"db_{key}"] = value
+    for key, value in group_settings_cache.stats().items():
+        metrics[f"settings_cache_{key}"] = value
+    for key, value in admin_cache.stats().items():
+        metrics[f"admin_cache_{key}"] = value
+    for key, value in user_profile_cache.stats().items():
+        metrics[f"user_profiles_{key}"] = value
+    for key, value in loop_lag_monitor.stats().items():
+        metrics[f"loop_lag_{key}"] = value
+    for key, value in analysis_retention_job.stats().items():
+        metrics[f"retention_{key}"] = value
+    for key, value in message_tracker.stats().items():
+        metrics[f"tracker_{key}"] = value
+    for key, value in rate_limiter.stats().items():
+        metrics[f"rate_limit_{key}"] = value
+    for key, value in tracker_snapshot.stats().items():
+        metrics[f"snapshot_{key}"] = value
+    for key, value in raid_detector.stats().items():
+        metrics[f"raid_{key}"] = value
+    metrics.update(warning_analyzer.stats())
+    return metrics
+
+def format_health_status():
+    """Формирование содержимого файла состояния"""
+    lines = [f"Bot is running: {datetime.datetime.now()}"]
+    for key, value in get_bot_metrics().items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        lines.append(f"{key}: {value}")
+    return "\n".join(lines)
 
 def update_health_check():
     """Обновление файла проверки состояния"""
     while True:
         try:
             with open(HEALTH_CHECK_FILE, 'w') as f:
-                f.write(f"Bot is running: {datetime.datetime.now()}")
+                f.write(format_health_status())
             logger.debug("Обновлен файл состояния бота")
         except Exception as e:
             logger.error(f"Ошибка при обновлении файла состояния: {e}")
@@ -576,10 +4227,11 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     filters,
     ContextTypes
 )
-from telegram.constants import ParseMode
+from telegram.constants import ParseMode, ChatMemberStatus
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
@@ -593,7 +4245,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Обновляем информацию о пользователе
-    update_user_info(
+    await update_user_info(
         user.id, 
         username=user.username,
         first_name=user.first_name,
@@ -637,11 +4289,19 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /rules - Показать правила группы
 /setwelcome - Установить приветственное сообщение
 /toggleflood - Включить/выключить антифлуд
+/floodlimit - Правила антифлуда для участников и новичков
+/raid - Защита от рейдов (выключена по умолчанию: on, off, unlock)
 
 *Умные предупреждения:*
 /smartwarnings - Управление системой умных предупреждений
 /analyze - Анализировать сообщение на нарушения
-/analyses - Показать последние результаты анализа
+/analyses - Результаты анализа (фильтры: user:ID type:spam warned days:7)
+/search - Поиск по сохраненным сообщениям
+
+*Только для владельцев:*
+/export [jsonl|csv] - Выгрузить данные (в группе - только этой группы)
+/import - Загрузить выгрузку (ответьте на сообщение с архивом)
+/lexicon - Словарь слов нарушений (add ТИП слова, remove слова)
 
 *Профиль и информация:*
 /id - Показать ID пользователя или группы
@@ -680,6 +4340,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /smartwarnings types - Посмотреть типы нарушений
 /smartwarnings set_types spam,obscenity,rudeness,flood - Установить типы нарушений
 /smartwarnings confidence 0.8 - Установить минимальную уверенность (0-1)
+/smartwarnings retention 30 - Сколько дней хранить результаты анализа
+/smartwarnings stats - Статистика нарушений за 7 дней
 """
     
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
@@ -712,44 +4374,40 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         user = update.effective_user
     
+    # Добавляем пользователя в базу и дожидаемся отложенных записей
+    await update_user_info(
+        user.id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name
+    )
+    await storage.flush()
+    
     # Получаем информацию из базы данных
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM user_info WHERE user_id = ?",
-            (str(user.id),)
-        )
-        db_user = cursor.fetchone()
-        
-        # Если пользователя нет в базе, добавляем его
-        if not db_user:
-            update_user_info(
-                user.id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
-            cursor.execute(
-                "SELECT * FROM user_info WHERE user_id = ?",
-                (str(user.id),)
-            )
-            db_user = cursor.fetchone()
-        
-        # Получаем предупреждения пользователя
-        cursor.execute(
-            "SELECT warnings FROM user_warnings WHERE user_id = ? AND group_id = ?",
-            (str(user.id), str(update.effective_chat.id))
+    db_user = await run_db(get_user_record, user.id)
+    
+    # Если запись потерялась (например, база заменена), создаем ее заново
+    if not db_user:
+        user_profile_cache.forget(user.id)
+        await update_user_info(
+            user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            wait=True
         )
-        warning_row = cursor.fetchone()
-        warnings = warning_row['warnings'] if warning_row else 0
+        db_user = await run_db(get_user_record, user.id)
+    
+    # Получаем предупреждения пользователя
+    warnings = await run_db(get_warning_count, update.effective_chat.id, user.id)
     
     # Формируем информацию
     join_date = db_user['join_date'] if db_user else "Неизвестно"
-    is_admin = db_user['is_admin'] if db_user else False
+    is_admin_user = await is_admin(user.id, update.effective_chat.id, context.bot)
     is_owner_user = is_owner(user.id)
     
     # Статус модератора
-    status = "👑 Владелец бота" if is_owner_user else "⭐️ Администратор" if is_admin else "👤 Пользователь"
+    status = "👑 Владелец бота" if is_owner_user else "⭐️ Администратор" if is_admin_user else "👤 Пользователь"
     
     # Собираем информацию о пользователе
     info_text = f"""
@@ -779,25 +4437,13 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         user = update.effective_user
     
-    # Получаем данные о пользователе
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Предупреждения
-        cursor.execute(
-            "SELECT warnings FROM user_warnings WHERE user_id = ? AND group_id = ?",
-            (str(user.id), str(update.effective_chat.id))
-        )
-        warning_row = cursor.fetchone()
-        warnings = warning_row['warnings'] if warning_row else 0
-        
-        # Статус
-        cursor.execute(
-            "SELECT is_admin FROM user_info WHERE user_id = ?",
-            (str(user.id),)
-        )
-        admin_row = cursor.fetchone()
-        is_admin_user = admin_row and admin_row['is_admin']
+    chat_id = update.effective_chat.id
+    
+    # Предупреждения
+    warnings = await run_db(get_warning_count, chat_id, user.id)
+    
+    # Статус
+    is_admin_user = await is_admin(user.id, chat_id, context.bot)
     
     # Определяем статус
     if is_owner(user.id):
@@ -820,7 +4466,7 @@ ID: `{user.id}`
 """
     
     # Создаем кнопки для быстрых действий (только для администраторов)
-    if (is_owner(update.effective_user.id) or is_admin(update.effective_user.id)) and not is_owner(user.id):
+    if await is_admin(update.effective_user.id, chat_id, context.bot) and not is_owner(user.id):
         # Создаем клавиатуру с действиями
         keyboard = [
             [
@@ -846,7 +4492,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -858,7 +4504,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user = update.message.reply_to_message.from_user
     
     # Нельзя забанить владельца или администратора
-    if is_owner(target_user.id) or is_admin(target_user.id):
+    if is_owner(target_user.id) or await is_admin(target_user.id, chat_id, context.bot):
         await update.message.reply_text("Невозможно забанить администратора или владельца бота.")
         return
     
@@ -886,7 +4532,7 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -929,7 +4575,7 @@ async def kick_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -941,7 +4587,7 @@ async def kick_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user = update.message.reply_to_message.from_user
     
     # Нельзя выгнать владельца или администратора
-    if is_owner(target_user.id) or is_admin(target_user.id):
+    if is_owner(target_user.id) or await is_admin(target_user.id, chat_id, context.bot):
         await update.message.reply_text("Невозможно выгнать администратора или владельца бота.")
         return
     
@@ -970,7 +4616,7 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -982,7 +4628,7 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user = update.message.reply_to_message.from_user
     
     # Нельзя заглушить владельца или администратора
-    if is_owner(target_user.id) or is_admin(target_user.id):
+    if is_owner(target_user.id) or await is_admin(target_user.id, chat_id, context.bot):
         await update.message.reply_text("Невозможно заглушить администратора или владельца бота.")
         return
     
@@ -1065,7 +4711,7 @@ async def unmute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1113,7 +4759,7 @@ async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1125,45 +4771,21 @@ async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user = update.message.reply_to_message.from_user
     
     # Нельзя выдать предупреждение владельцу или администратору
-    if is_owner(target_user.id) or is_admin(target_user.id):
+    if is_owner(target_user.id) or await is_admin(target_user.id, chat_id, context.bot):
         await update.message.reply_text("Невозможно выдать предупреждение администратору или владельцу бота.")
         return
     
     # Получаем причину предупреждения
     reason = " ".join(context.args) if context.args else "Нарушение правил"
     
-    # Получаем текущие предупреждения пользователя
-    warnings_data = get_user_warnings(chat_id, target_user.id)
-    warnings = warnings_data['warnings']
-    
-    # Увеличиваем количество предупреждений
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE user_warnings SET warnings = warnings + 1, reason = ?, updated_at = CURRENT_TIMESTAMP "
-            "WHERE group_id = ? AND user_id = ?",
-            (reason, str(chat_id), str(target_user.id))
-        )
-        conn.commit()
-    
-    # Проверяем, достигнут ли лимит предупреждений
-    warnings += 1
+    # Выдаем предупреждение (счетчик сбрасывается при достижении лимита)
+    warnings, limit_reached = await run_db(add_warning, chat_id, target_user.id, reason)
     
-    if warnings >= MAX_WARNINGS:
+    if limit_reached:
         # Баним пользователя
         try:
             await context.bot.ban_chat_member(chat_id, target_user.id)
             
-            # Сбрасываем счетчик предупреждений
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
-                    "WHERE group_id = ? AND user_id = ?",
-                    (str(chat_id), str(target_user.id))
-                )
-                conn.commit()
-            
             await update.message.reply_text(
                 f"Пользователь {target_user.first_name} (ID: {target_user.id}) забанен после достижения {MAX_WARNINGS} предупреждений.\n"
                 f"Последняя причина: {reason}"
@@ -1189,7 +4811,7 @@ async def unwarn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1200,28 +4822,17 @@ async def unwarn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     target_user = update.message.reply_to_message.from_user
     
-    # Получаем текущие предупреждения пользователя
-    warnings_data = get_user_warnings(chat_id, target_user.id)
-    warnings = warnings_data['warnings']
+    # Уменьшаем количество предупреждений
+    warnings = await run_db(remove_warning, chat_id, target_user.id)
     
-    if warnings <= 0:
+    if warnings is None:
         await update.message.reply_text(f"У пользователя {target_user.first_name} нет предупреждений.")
         return
     
-    # Уменьшаем количество предупреждений
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE user_warnings SET warnings = warnings - 1, updated_at = CURRENT_TIMESTAMP "
-            "WHERE group_id = ? AND user_id = ?",
-            (str(chat_id), str(target_user.id))
-        )
-        conn.commit()
-    
     # Отправляем сообщение
     await update.message.reply_text(
         f"С пользователя {target_user.first_name} (ID: {target_user.id}) снято одно предупреждение.\n"
-        f"Всего предупреждений: {warnings - 1}/{MAX_WARNINGS}"
+        f"Всего предупреждений: {warnings}/{MAX_WARNINGS}"
     )
     
     logger.info(f"С пользователя {target_user.id} снято предупреждение пользователем {user.id}")
@@ -1237,7 +4848,7 @@ async def warnings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user = update.effective_user
     
     # Получаем предупреждения пользователя
-    warnings_data = get_user_warnings(chat_id, target_user.id)
+    warnings_data = await run_db(get_user_warnings, chat_id, target_user.id)
     warnings = warnings_data['warnings']
     reason = warnings_data['reason'] if warnings_data['reason'] else "Причина не указана"
     
@@ -1254,7 +4865,7 @@ async def clear_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1266,14 +4877,7 @@ async def clear_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
     target_user = update.message.reply_to_message.from_user
     
     # Сбрасываем предупреждения
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
-            "WHERE group_id = ? AND user_id = ?",
-            (str(chat_id), str(target_user.id))
-        )
-        conn.commit()
+    await run_db(reset_warnings, chat_id, target_user.id)
     
     # Отправляем сообщение
     await update.message.reply_text(
@@ -1290,7 +4894,7 @@ async def set_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1305,14 +4909,7 @@ async def set_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rules_text = " ".join(context.args)
     
     # Обновляем правила в базе данных
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET rules = ?, updated_at = CURRENT_TIMESTAMP "
-            "WHERE group_id = ?",
-            (rules_text, str(chat_id))
-        )
-        conn.commit()
+    await run_db(set_group_rules, chat_id, rules_text)
     
     # Отправляем сообщение об успешном обновлении
     await update.message.reply_text(
@@ -1326,9 +4923,9 @@ async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать правила группы"""
     chat_id = update.effective_chat.id
     
-    # Получаем правила из базы данных
-    settings = get_group_settings(chat_id)
-    rules = settings['rules'] if settings else "Правила не установлены!"
+    # Получаем правила из настроек группы
+    group = await fetch_group_context(chat_id)
+    rules = group.rules
     
     # Отправляем правила
     await update.message.reply_text(
@@ -1342,7 +4939,7 @@ async def set_welcome_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1358,14 +4955,7 @@ async def set_welcome_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     welcome_text = " ".join(context.args)
     
     # Обновляем приветствие в базе данных
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET welcome_message = ?, updated_at = CURRENT_TIMESTAMP "
-            "WHERE group_id = ?",
-            (welcome_text, str(chat_id))
-        )
-        conn.commit()
+    await run_db(set_welcome_message, chat_id, welcome_text)
     
     # Отправляем сообщение об успешном обновлении
     await update.message.reply_text("Приветственное сообщение обновлено успешно!")
@@ -1378,26 +4968,19 @@ async def toggle_flood_command(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
     # Получаем текущие настройки
-    settings = get_group_settings(chat_id)
-    current_state = settings['anti_flood'] if settings else True
+    group = await fetch_group_context(chat_id)
+    current_state = group.anti_flood
     
     # Переключаем состояние
     new_state = not current_state
     
     # Обновляем настройки в базе данных
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE group_settings SET anti_flood = ?, updated_at = CURRENT_TIMESTAMP "
-            "WHERE group_id = ?",
-            (1 if new_state else 0, str(chat_id))
-        )
-        conn.commit()
+    await run_db(set_anti_flood, chat_id, new_state)
     
     # Отправляем сообщение о новом состоянии
     state_text = "включена" if new_state else "выключена"
@@ -1405,6 +4988,84 @@ async def toggle_flood_command(update: Update, context: ContextTypes.DEFAULT_TYP
     
     logger.info(f"Защита от флуда в группе {chat_id} {state_text} пользователем {user.id}")
 
+async def flood_limit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Настройка правил антифлуда для участников и новичков"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    
+    # Проверяем, является ли пользователь администратором
+    if not await is_admin(user.id, chat_id, context.bot):
+        await update.message.reply_text("Эта команда доступна только администраторам.")
+        return
+    
+    # Без аргументов показываем текущие правила
+    if not context.args:
+        group = await fetch_group_context(chat_id)
+        await update.message.reply_text(
+            "Правила антифлуда:\n"
+            f"- участники: {group.flood_rule.describe()}\n"
+            f"- новички: {group.newcomer_flood_rule.describe()}\n\n"
+            "Изменить: /floodlimit member|newcomer sliding_log|token_bucket ЛИМИТ СЕКУНДЫ [МИНУТЫ_МУТА]\n"
+            "Вернуть по умолчанию: /floodlimit member|newcomer default"
+        )
+        return
+    
+    user_class = context.args[0].lower()
+    if user_class not in USER_CLASSES:
+        await update.message.reply_text(f"Укажите класс участников: {', '.join(USER_CLASSES)}.")
+        return
+    
+    if len(context.args) == 2 and context.args[1].lower() == 'default':
+        rule = None
+    else:
+        try:
+            rule = RateLimitRule.parse(context.args[1:])
+        except ValueError as e:
+            await update.message.reply_text(f"Ошибка: {e}.")
+            return
+    
+    await run_db(set_flood_rule, chat_id, user_class, rule)
+    
+    group = await fetch_group_context(chat_id)
+    await update.message.reply_text(f"Новое правило ({user_class}): {group.rate_limit_rule(user_class).describe()}")
+    
+    logger.info(f"Правило антифлуда ({user_class}) группы {chat_id} изменено пользователем {user.id}")
+
+async def raid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Управление защитой от рейдов"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    
+    # Проверяем, является ли пользователь администратором
+    if not await is_admin(user.id, chat_id, context.bot):
+        await update.message.reply_text("Эта команда доступна только администраторам.")
+        return
+    
+    action = context.args[0].lower() if context.args else 'status'
+    
+    if action in ('on', 'off'):
+        await run_db(set_raid_protection, chat_id, action == 'on')
+        state_text = "включена" if action == 'on' else "выключена"
+        await update.message.reply_text(f"Защита от рейдов {state_text}!")
+        logger.info(f"Защита от рейдов в группе {chat_id} {state_text} пользователем {user.id}")
+    elif action == 'unlock':
+        if not raid_detector.under_raid(chat_id):
+            await update.message.reply_text("Чат не закрыт.")
+            return
+        await unlock_chat(context.bot, chat_id)
+        logger.info(f"Группа {chat_id} открыта после рейда пользователем {user.id}")
+    elif action == 'status':
+        group = await fetch_group_context(chat_id)
+        await update.message.reply_text(
+            f"Защита от рейдов: {'включена ✅' if group.raid_protection else 'выключена ❌'}\n"
+            f"Чат закрыт: {'да' if raid_detector.under_raid(chat_id) else 'нет'}\n\n"
+            f"Рейдом считаются за {RAID_WINDOW} сек.: {RAID_DUPLICATE_USERS} участников с одинаковым текстом, "
+            f"{RAID_JOIN_LIMIT} вступлений или {RAID_MESSAGE_LIMIT} сообщений.\n"
+            "Использование: /raid on|off|unlock"
+        )
+    else:
+        await update.message.reply_text("Использование: /raid on|off|status|unlock")
+
 # ------ Умные предупреждения ------ #
 
 async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1413,17 +5074,17 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
     # Обработка команды без аргументов - показываем текущие настройки
     if not context.args:
-        settings = get_group_settings(chat_id)
-        smart_enabled = settings['smart_warnings'] if settings else False
-        auto_enabled = settings['smart_warnings_auto'] if settings else False
-        confidence = settings['smart_warnings_min_confidence'] if settings else 0.8
-        enabled_types = settings['smart_warnings_enabled_types'].split(',') if settings and settings['smart_warnings_enabled_types'] else []
+        group = await fetch_group_context(chat_id)
+        smart_enabled = group.smart_warnings
+        auto_enabled = group.smart_warnings_auto
+        confidence = group.min_confidence
+        enabled_types = [t for t in VIOLATION_TYPES if t in group.enabled_types]
         
         status_text = f"""
 *Настройки умных предупреждений:*
@@ -1431,6 +5092,7 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
 Автопредупреждения: {'Включены ✅' if auto_enabled else 'Выключены ❌'}
 Минимальная уверенность: {confidence * 100:.0f}%
 Типы нарушений: {', '.join(enabled_types) if enabled_types else 'Не выбраны'}
+Хранение анализа: {group.retention_days} дн.
 
 *Управление:*
 /smartwarnings on - Включить
@@ -1440,6 +5102,8 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
 /smartwarnings types - Посмотреть типы нарушений
 /smartwarnings set_types spam,obscenity,rudeness,flood - Установить типы нарушений
 /smartwarnings confidence 0.8 - Установить минимальную уверенность (0-1)
+/smartwarnings retention 30 - Сколько дней хранить результаты анализа
+/smartwarnings stats - Статистика нарушений за 7 дней
 """
         await update.message.reply_text(status_text, parse_mode=ParseMode.MARKDOWN)
         return
@@ -1449,13 +5113,13 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
     
     if command == 'on':
         # Включаем умные предупреждения
-        toggle_smart_warnings(chat_id, True)
+        await run_db(toggle_smart_warnings, chat_id, True)
         await update.message.reply_text("Умные предупреждения включены! ✅")
     
     elif command == 'off':
         # Выключаем умные предупреждения
-        toggle_smart_warnings(chat_id, False)
-        toggle_auto_warnings(chat_id, False)  # Также выключаем автопредупреждения
+        await run_db(toggle_smart_warnings, chat_id, False)
+        await run_db(toggle_auto_warnings, chat_id, False)  # Также выключаем автопредупреждения
         await update.message.reply_text("Умные предупреждения выключены! ❌")
     
     elif command == 'auto':
@@ -1467,13 +5131,13 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
         
         if auto_command == 'on':
             # Включаем автопредупреждения (и умные предупреждения тоже)
-            toggle_smart_warnings(chat_id, True)
-            toggle_auto_warnings(chat_id, True)
+            await run_db(toggle_smart_warnings, chat_id, True)
+            await run_db(toggle_auto_warnings, chat_id, True)
             await update.message.reply_text("Автоматические предупреждения включены! ✅")
         
         elif auto_command == 'off':
             # Выключаем только автопредупреждения
-            toggle_auto_warnings(chat_id, False)
+            await run_db(toggle_auto_warnings, chat_id, False)
             await update.message.reply_text("Автоматические предупреждения выключены! ❌")
         
         else:
@@ -1494,7 +5158,7 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
 *Как установить:*
 /smartwarnings set_types spam,obscenity,rudeness,flood
 """
-        enabled_types = get_enabled_violation_types(chat_id)
+        enabled_types = await run_db(get_enabled_violation_types, chat_id)
         types_text = types_text.format(', '.join(enabled_types) if enabled_types else 'Не выбраны')
         
         await update.message.reply_text(types_text, parse_mode=ParseMode.MARKDOWN)
@@ -1508,7 +5172,7 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
         types = [t.strip() for t in types_arg.split(',')]
         
         # Проверяем корректность типов
-        valid_types = ['spam', 'obscenity', 'rudeness', 'flood']
+        valid_types = list(VIOLATION_TYPES)
         invalid_types = [t for t in types if t not in valid_types]
         
         if invalid_types:
@@ -1519,7 +5183,7 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
             return
         
         # Устанавливаем типы нарушений
-        set_enabled_violation_types(chat_id, types)
+        await run_db(set_enabled_violation_types, chat_id, types)
         await update.message.reply_text(f"Установлены типы нарушений: {', '.join(types)}")
     
     elif command == 'confidence':
@@ -1533,12 +5197,33 @@ async def smart_warnings_command(update: Update, context: ContextTypes.DEFAULT_T
                 raise ValueError("Значение должно быть от 0 до 1")
             
             # Устанавливаем минимальную уверенность
-            set_min_confidence(chat_id, confidence)
+            await run_db(set_min_confidence, chat_id, confidence)
             await update.message.reply_text(f"Установлена минимальная уверенность: {confidence * 100:.0f}%")
         
         except ValueError as e:
             await update.message.reply_text(f"Ошибка: {e}. Укажите число от 0 до 1.")
     
+    elif command == 'retention':
+        if len(context.args) < 2 or not context.args[1].isdigit() or int(context.args[1]) < 1:
+            await update.message.reply_text("Пожалуйста, укажите срок хранения в днях (целое число от 1).")
+            return
+        
+        days = int(context.args[1])
+        await run_db(set_analysis_retention, chat_id, days)
+        await update.message.reply_text(f"Результаты анализа будут храниться {days} дн.")
+    
+    elif command == 'stats':
+        # Статистика берется из дневных сводок, поэтому переживает удаление старых строк
+        await storage.flush()
+        stats = await run_db(get_violation_stats, chat_id)
+        
+        stats_text = "*Статистика за 7 дней:*\n"
+        stats_text += f"Проанализировано сообщений: {stats.get('', 0)}\n"
+        for violation_type in VIOLATION_TYPES:
+            stats_text += f"- {violation_type}: {stats.get(violation_type, 0)}\n"
+        
+        await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+    
     else:
         await update.message.reply_text("Неизвестная команда. Используйте /smartwarnings без аргументов для справки.")
 
@@ -1548,7 +5233,7 @@ async def analyze_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
+    if not await is_admin(user.id, chat_id, context.bot):
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
     
@@ -1568,35 +5253,34 @@ async def analyze_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Получаем контекст сообщений пользователя
     messages = message_tracker.get_user_messages(
-        str(target_user.id),
-        chat_id=str(chat_id),
+        target_user.id,
+        chat_id=chat_id,
         seconds=60,
         limit=5
     )
     
-    # Подсчитываем похожие сообщения
-    similar_count = 0
-    if messages:
-        # Очень простая проверка на похожесть - совпадение первых 5 символов
-        last_message_prefix = message_text[:5].lower() if len(message_text) >= 5 else message_text.lower()
-        for msg in messages:
-            msg_text = msg['text']
-            if msg_text[:5].lower() == last_message_prefix:
-                similar_count += 1
+    # Подсчитываем похожие сообщения (по расстоянию между SimHash)
+    similar_count = message_tracker.count_similar(
+        target_user.id,
+        chat_id,
+        simhash(message_text),
+        seconds=60,
+        limit=5
+    )
     
     # Создаем контекст для анализа
     context = {
-        'recent_messages': [msg['text'] for msg in messages],
+        'recent_messages': [msg.text for msg in messages if msg.text is not None],
         'message_count': len(messages),
-        'frequency': message_tracker.get_message_frequency(str(target_user.id), str(chat_id), 60),
+        'frequency': message_tracker.get_message_frequency(target_user.id, chat_id, 60),
         'similar_messages': similar_count
     }
     
     # Анализируем сообщение
     analysis_result = warning_analyzer.analyze_message(message_text, context)
     
-    # Записываем результат анализа
-    record_id = record_analysis(
+    # Записываем результат анализа (ID нужен для кнопки предупреждения)
+    record_id = await record_analysis(
         chat_id,
         target_user.id,
         target_message.message_id,
@@ -1604,76 +5288,314 @@ async def analyze_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         analysis_result
     )
     
-    # Формируем текст результата
-    confidence_percent = int(analysis_result['confidence'] * 100)
-    violations_text = ', '.join(analysis_result['violations']) if analysis_result['violations'] else "не обнаружены"
+    # Формируем текст результата
+    confidence_percent = int(analysis_result['confidence'] * 100)
+    violations_text = ', '.join(analysis_result['violations']) if analysis_result['violations'] else "не обнаружены"
+    
+    result_text = f"""
+*Результат анализа сообщения:*
+Пользователь: {target_user.first_name} (ID: {target_user.id})
+Нарушения: {violations_text}
+Уверенность: {confidence_percent}%
+"""
+    
+    if analysis_result['suggested_warning']:
+        result_text += f"Предлагаемое предупреждение: {analysis_result['suggested_warning']}\n"
+    
+    result_text += f"""
+*Контекст:*
+Сообщений за минуту: {context['frequency']:.1f}
+Похожих сообщений: {similar_count}
+"""
+    
+    # Если есть нарушение, добавляем кнопку для выдачи предупреждения
+    if analysis_result['has_violation']:
+        keyboard = [
+            [InlineKeyboardButton(
+                "⚠️ Выдать предупреждение",
+                callback_data=f"warn_{target_user.id}_{target_message.message_id}_{record_id}"
+            )]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(result_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    else:
+        await update.message.reply_text(result_text, parse_mode=ParseMode.MARKDOWN)
+
+def render_analyses_page(analysis_filters, rows, has_more, after_id=None):
+    """Текст и кнопки страницы результатов анализа"""
+    description = analysis_filters.describe()
+    results_text = "*Результаты анализа*"
+    results_text += f" ({description}):\n\n" if description else ":\n\n"
+    
+    for analysis in rows:
+        violations = analysis['violation_types'].split(',') if analysis['violation_types'] else []
+        violations_text = ', '.join(violations) if violations else "нет"
+        
+        confidence_percent = int(analysis['confidence'] * 100) if analysis['confidence'] else 0
+        
+        results_text += f"{analysis['created_at']} - пользователь ID: {analysis['user_id']}\n"
+        results_text += f"   Нарушения: {violations_text}\n"
+        results_text += f"   Уверенность: {confidence_percent}%\n"
+        results_text += f"   Выдано предупреждение: {'Да' if analysis['is_warned'] else 'Нет'}\n\n"
+    
+    # Кнопки листания: курсор - ID последней показанной записи
+    buttons = []
+    if after_id:
+        buttons.append(InlineKeyboardButton("⏮ В начало", callback_data=f"analyses_0_{analysis_filters.encode()}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton(
+            "Далее ▶️", callback_data=f"analyses_{rows[-1]['id']}_{analysis_filters.encode()}"
+        ))
+    
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return results_text, reply_markup
+
+async def show_analyses(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать результаты анализа с фильтрами и постраничным просмотром"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    
+    # Проверяем, является ли пользователь администратором
+    if not await is_admin(user.id, chat_id, context.bot):
+        await update.message.reply_text("Эта команда доступна только администраторам.")
+        return
+    
+    # Ответ на сообщение - фильтр по его автору
+    reply_user_id = None
+    if update.message.reply_to_message:
+        reply_user_id = update.message.reply_to_message.from_user.id
+    
+    try:
+        analysis_filters = AnalysisFilters.parse(context.args or [], reply_user_id)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"Ошибка: {e}.\n"
+            "Фильтры: user:ID, type:spam, warned, unwarned, days:7, from:2024-01-01, to:2024-01-31"
+        )
+        return
+    
+    # Дожидаемся отложенных записей и получаем первую страницу
+    await storage.flush()
+    rows, has_more = await run_db(get_analyses_page, chat_id, analysis_filters)
+    
+    if not rows:
+        await update.message.reply_text("Нет результатов анализа по заданным условиям.")
+        return
+    
+    results_text, reply_markup = render_analyses_page(analysis_filters, rows, has_more)
+    await update.message.reply_text(results_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
+def render_search_page(text, rows, has_more, offset=0, truncated=False):
+    """Текст и кнопки страницы результатов поиска"""
+    results_text = f"Поиск: {text}\n\n"
+    for i, hit in enumerate(rows, offset + 1):
+        violations = hit['violation_types'] or "нет"
+        results_text += f"{i}. {hit['created_at']} - пользователь ID: {hit['user_id']} (нарушения: {violations})\n"
+        results_text += f"   {hit['snippet']}\n\n"
+    
+    if truncated:
+        results_text += (
+            f"Совпадений больше {SEARCH_RANK_WINDOW}: показаны лучшие среди последних {SEARCH_RANK_WINDOW}, "
+            f"более старые сообщения не просмотрены. Уточните запрос.\n"
+        )
+    
+    # Текст запроса не помещается в callback_data, его берем из исходной команды
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(
+            "◀️ Назад", callback_data=f"search_{max(0, offset - SEARCH_PAGE_SIZE)}"
+        ))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Далее ▶️", callback_data=f"search_{offset + SEARCH_PAGE_SIZE}"))
+    
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return results_text, reply_markup
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Полнотекстовый поиск по сохраненным сообщениям группы"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    
+    # Проверяем, является ли пользователь администратором
+    if not await is_admin(user.id, chat_id, context.bot):
+        await update.message.reply_text("Эта команда доступна только администраторам.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            "Пожалуйста, укажите текст для поиска.\n"
+            "Пример: /search t.me/joinchat"
+        )
+        return
+    
+    text = " ".join(context.args)
+    
+    # Дожидаемся отложенных записей, чтобы найти и самые свежие сообщения
+    await storage.flush()
+    rows, has_more, truncated = await run_db(search_analyses, chat_id, text)
+    
+    if not rows:
+        await update.message.reply_text("Ничего не найдено.")
+        return
+    
+    # Без разметки: в найденных сообщениях могут быть символы Markdown
+    results_text, reply_markup = render_search_page(text, rows, has_more, truncated=truncated)
+    await update.message.reply_text(results_text, reply_markup=reply_markup)
+
+# ------ Экспорт и импорт ------ #
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузка данных бота архивом (в группе - только этой группы)"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    
+    if not is_owner(user.id):
+        await update.message.reply_text("Эта команда доступна только владельцам бота.")
+        return
+    
+    fmt = context.args[0].lower() if context.args else 'jsonl'
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Неизвестный формат. Доступные форматы: {', '.join(EXPORT_FORMATS)}")
+        return
+    
+    # В личных сообщениях выгружаем все группы
+    group_id = chat_id if chat_id < 0 else None
+    
+    # Дожидаемся отложенных записей, чтобы они попали в выгрузку
+    await storage.flush()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        export_dir = os.path.join(directory, 'export')
+        try:
+            manifest = await run_db(export_data, export_dir, fmt, group_id)
+        except ValueError as e:
+            await update.message.reply_text(f"Ошибка выгрузки: {e}")
+            return
+        archive_path = await run_db(pack_export, export_dir, os.path.join(directory, 'export.zip'))
+        
+        summary = ', '.join(f"{table}: {info['rows']}" for table, info in manifest['tables'].items())
+        filename = f"export_{group_id or 'all'}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        with open(archive_path, 'rb') as f:
+            await update.message.reply_document(f, filename=filename, caption=f"Выгрузка ({fmt}): {summary}")
+    
+    logger.info(f"Данные {'группы ' + str(group_id) if group_id else 'всех групп'} выгружены пользователем {user.id}")
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загрузка архива выгрузки (ответом на сообщение с архивом)"""
+    user = update.effective_user
     
-    result_text = f"""
-*Результат анализа сообщения:*
-Пользователь: {target_user.first_name} (ID: {target_user.id})
-Нарушения: {violations_text}
-Уверенность: {confidence_percent}%
-"""
+    if not is_owner(user.id):
+        await update.message.reply_text("Эта команда доступна только владельцам бота.")
+        return
     
-    if analysis_result['suggested_warning']:
-        result_text += f"Предлагаемое предупреждение: {analysis_result['suggested_warning']}\n"
+    reply = update.message.reply_to_message
+    if not reply or not reply.document:
+        await update.message.reply_text("Ответьте этой командой на сообщение с архивом выгрузки.")
+        return
     
-    result_text += f"""
-*Контекст:*
-Сообщений за минуту: {context['frequency']:.1f}
-Похожих сообщений: {similar_count}
-"""
+    await update.message.reply_text("Импорт начат...")
     
-    # Если есть нарушение, добавляем кнопку для выдачи предупреждения
-    if analysis_result['has_violation']:
-        keyboard = [
-            [InlineKeyboardButton(
-                "⚠️ Выдать предупреждение",
-                callback_data=f"warn_{target_user.id}_{target_message.message_id}_{record_id}"
-            )]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(result_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-    else:
-        await update.message.reply_text(result_text, parse_mode=ParseMode.MARKDOWN)
+    try:
+        telegram_file = await context.bot.get_file(reply.document.file_id)
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = os.path.join(directory, 'import.zip')
+            await telegram_file.download_to_drive(archive_path)
+            
+            import_dir = os.path.join(directory, 'import')
+            os.makedirs(import_dir)
+            await run_db(unpack_export, archive_path, import_dir)
+            imported = await run_db(import_data, import_dir)
+    except (ValueError, KeyError, zipfile.BadZipFile) as e:
+        await update.message.reply_text(f"Ошибка импорта: {e}")
+        return
+    
+    summary = '\n'.join(f"{table}: {rows}" for table, rows in imported.items())
+    await update.message.reply_text(f"Импорт завершен. Загружено строк:\n{summary}")
+    logger.info(f"Импорт данных выполнен пользователем {user.id}: {imported}")
 
-async def show_analyses(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать последние результаты анализа"""
+# Перестройки словаря идут по очереди, иначе автомат по старым данным может заменить новый
+lexicon_lock = asyncio.Lock()
+
+async def reload_lexicon():
+    """Перестройка автомата словаря в отдельном потоке (на 50 тыс. слов уходит около секунды)"""
+    async with lexicon_lock:
+        terms = await run_db(get_lexicon)
+        await asyncio.get_running_loop().run_in_executor(None, warning_analyzer.load_lexicon, terms)
+
+async def lexicon_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Управление словарем ключевых слов нарушений"""
     user = update.effective_user
-    chat_id = update.effective_chat.id
     
-    # Проверяем, является ли пользователь администратором
-    if not is_admin(user.id):
-        await update.message.reply_text("Эта команда доступна только администраторам.")
+    if not is_owner(user.id):
+        await update.message.reply_text("Эта команда доступна только владельцам бота.")
         return
     
-    # Получаем последние результаты анализа
-    analyses = get_last_analysis(chat_id)
+    action = context.args[0].lower() if context.args else None
     
-    if not analyses:
-        await update.message.reply_text("Пока нет результатов анализа сообщений.")
+    # Без действия показываем состав словаря
+    if action not in ('add', 'remove'):
+        counts = defaultdict(int)
+        for _, violation_type in await run_db(get_lexicon):
+            counts[violation_type] += 1
+        builtin = sum(len(terms) for terms in warning_analyzer.builtin_lexicon.values())
+        types_text = '\n'.join(f"- {violation_type}: {counts[violation_type]}" for violation_type in VIOLATION_TYPES)
+        await update.message.reply_text(
+            f"Словарь нарушений: {sum(counts.values())} слов (встроенных: {builtin})\n{types_text}\n\n"
+            "Добавить: /lexicon add ТИП слово, фраза, ...\n"
+            "Удалить: /lexicon remove слово, фраза, ...\n"
+            "Можно ответить командой на текстовый файл (UTF-8, по слову в строке)."
+        )
         return
     
-    # Формируем текст результатов
-    results_text = "*Последние результаты анализа:*\n\n"
+    args = context.args[1:]
+    violation_type = None
+    if action == 'add':
+        if not args or args[0].lower() not in VIOLATION_TYPES:
+            await update.message.reply_text(f"Укажите тип нарушения: {', '.join(VIOLATION_TYPES)}.")
+            return
+        violation_type = args[0].lower()
+        args = args[1:]
+    
+    # Слова - через запятую в команде и по строке в приложенном файле
+    raw_terms = ' '.join(args).split(',')
+    reply = update.message.reply_to_message
+    if reply and reply.document:
+        telegram_file = await context.bot.get_file(reply.document.file_id)
+        data = await telegram_file.download_as_bytearray()
+        try:
+            raw_terms.extend(bytes(data).decode('utf-8').splitlines())
+        except UnicodeDecodeError:
+            await update.message.reply_text("Файл должен быть в кодировке UTF-8.")
+            return
+    
+    raw_terms = [term for term in raw_terms if term.strip()]
+    terms = list(dict.fromkeys(term for term in map(normalize_lexicon_term, raw_terms) if term))
+    skipped = len(raw_terms) - len(terms)
+    if not terms:
+        await update.message.reply_text("Не указано ни одного слова.")
+        return
     
-    for i, analysis in enumerate(analyses[:5], 1):
-        violations = analysis['violation_types'].split(',') if analysis['violation_types'] else []
-        violations_text = ', '.join(violations) if violations else "нет"
-        
-        confidence_percent = int(analysis['confidence'] * 100) if analysis['confidence'] else 0
-        
-        results_text += f"{i}. Пользователь ID: {analysis['user_id']}\n"
-        results_text += f"   Нарушения: {violations_text}\n"
-        results_text += f"   Уверенность: {confidence_percent}%\n"
-        results_text += f"   Выдано предупреждение: {'Да' if analysis['is_warned'] else 'Нет'}\n\n"
+    if action == 'add':
+        existing = {term for term, _ in await run_db(get_lexicon)}
+        total = len(existing.union(terms))
+        if total > LEXICON_MAX_TERMS:
+            await update.message.reply_text(
+                f"В словаре будет {total} слов, а максимум - {LEXICON_MAX_TERMS}. Удалите часть слов."
+            )
+            return
+        changed = await run_db(add_lexicon_terms, violation_type, terms, user.id)
+        result_text = f"Добавлено или изменено слов ({violation_type}): {changed}"
+    else:
+        changed = await run_db(remove_lexicon_terms, terms)
+        result_text = f"Удалено слов: {changed}"
     
-    # Добавляем информацию о количестве записей
-    total_count = len(analyses)
-    if total_count > 5:
-        results_text += f"... и еще {total_count - 5} записей."
+    if changed:
+        await reload_lexicon()
+    if skipped:
+        result_text += f"\nПропущено (повторы или длиннее {LEXICON_MAX_TERM_LENGTH} символов): {skipped}"
+    await update.message.reply_text(result_text)
     
-    await update.message.reply_text(results_text, parse_mode=ParseMode.MARKDOWN)
+    logger.info(f"Словарь нарушений изменен пользователем {user.id}: {action}, слов: {changed}")
 
 # ------ Обработка колбэков ------ #
 
@@ -1682,6 +5604,9 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     user = query.from_user
     
+    # Чат, в котором нажата кнопка
+    chat_id = query.message.chat_id
+    
     # Извлекаем данные из callback_data
     callback_data = query.data
     
@@ -1692,9 +5617,10 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     if callback_data.startswith('warn_'):
         # Колбэк для выдачи предупреждения из результата анализа
         _, target_user_id, message_id, analysis_id = callback_data.split('_')
+        target_user_id, analysis_id = int(target_user_id), int(analysis_id)
         
         # Проверяем, является ли пользователь администратором
-        if not is_admin(user.id):
+        if not await is_admin(user.id, chat_id, context.bot):
             await query.edit_message_text(
                 "У вас нет прав для выполнения этого действия."
             )
@@ -1702,88 +5628,60 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         try:
             # Получаем информацию о сообщении из базы данных
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT * FROM message_analysis WHERE id = ?",
-                    (analysis_id,)
-                )
-                analysis = cursor.fetchone()
-                
-                if not analysis:
-                    await query.edit_message_text(
-                        "Информация об анализе не найдена."
-                    )
-                    return
-                
-                # Проверяем, было ли уже выдано предупреждение
-                if analysis['is_warned']:
-                    await query.edit_message_text(
-                        "Предупреждение уже было выдано за это сообщение."
-                    )
-                    return
-                
-                # Получаем предупреждение для пользователя
-                suggested_warning = analysis['suggested_warning'] or "Нарушение правил"
-                
-                # Получаем текущие предупреждения пользователя
-                warnings_data = get_user_warnings(analysis['group_id'], target_user_id)
-                warnings = warnings_data['warnings']
-                
-                # Увеличиваем количество предупреждений
-                cursor.execute(
-                    "UPDATE user_warnings SET warnings = warnings + 1, reason = ?, updated_at = CURRENT_TIMESTAMP "
-                    "WHERE group_id = ? AND user_id = ?",
-                    (suggested_warning, analysis['group_id'], target_user_id)
+            analysis = await run_db(get_analysis, analysis_id)
+            
+            if not analysis:
+                await query.edit_message_text(
+                    "Информация об анализе не найдена."
                 )
-                
-                # Помечаем анализ как предупрежденный
-                cursor.execute(
-                    "UPDATE message_analysis SET is_warned = 1 WHERE id = ?",
-                    (analysis_id,)
+                return
+            
+            # Получаем предупреждение для пользователя
+            suggested_warning = analysis['suggested_warning'] or "Нарушение правил"
+            
+            # Выдаем предупреждение и помечаем анализ одной транзакцией
+            warning_result = await run_db(
+                add_warning, analysis['group_id'], target_user_id, suggested_warning, analysis_id=analysis_id
+            )
+            
+            # Проверяем, было ли уже выдано предупреждение
+            if warning_result is None:
+                await query.edit_message_text(
+                    "Предупреждение уже было выдано за это сообщение."
                 )
-                conn.commit()
-                
-                # Проверяем, достигнут ли лимит предупреждений
-                warnings += 1
-                
-                result_text = f"Пользователю (ID: {target_user_id}) выдано предупреждение.\n"
-                result_text += f"Всего предупреждений: {warnings}/{MAX_WARNINGS}\n"
-                result_text += f"Причина: {suggested_warning}"
-                
-                # Если достигнут лимит, баним пользователя
-                if warnings >= MAX_WARNINGS:
-                    try:
-                        await context.bot.ban_chat_member(
-                            int(analysis['group_id']), 
-                            int(target_user_id)
-                        )
-                        
-                        # Сбрасываем счетчик предупреждений
-                        cursor.execute(
-                            "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
-                            "WHERE group_id = ? AND user_id = ?",
-                            (analysis['group_id'], target_user_id)
-                        )
-                        conn.commit()
-                        
-                        result_text += f"\n\nПользователь забанен после достижения {MAX_WARNINGS} предупреждений!"
-                    except Exception as e:
-                        result_text += f"\n\nОшибка при бане пользователя: {e}"
-                
-                await query.edit_message_text(result_text)
-                
-                # Отправляем сообщение в группу
+                return
+            
+            warnings, limit_reached = warning_result
+            
+            result_text = f"Пользователю (ID: {target_user_id}) выдано предупреждение.\n"
+            result_text += f"Всего предупреждений: {warnings}/{MAX_WARNINGS}\n"
+            result_text += f"Причина: {suggested_warning}"
+            
+            # Если достигнут лимит, баним пользователя
+            if limit_reached:
                 try:
-                    await context.bot.send_message(
-                        int(analysis['group_id']),
-                        f"Пользователь (ID: {target_user_id}) получил предупреждение.\n"
-                        f"Всего предупреждений: {warnings}/{MAX_WARNINGS}\n"
-                        f"Причина: {suggested_warning}"
+                    await context.bot.ban_chat_member(
+                        int(analysis['group_id']), 
+                        int(target_user_id)
                     )
+                    
+                    result_text += f"\n\nПользователь забанен после достижения {MAX_WARNINGS} предупреждений!"
                 except Exception as e:
-                    logger.error(f"Ошибка при отправке сообщения в группу: {e}")
-        
+                    result_text += f"\n\nОшибка при бане пользователя: {e}"
+            
+            await query.edit_message_text(result_text)
+            
+            # Отправляем сообщение в группу
+            try:
+                await context.bot.send_message(
+                    int(analysis['group_id']),
+                    f"Пользователь (ID: {target_user_id}) получил предупреждение.\n"
+                    f"Всего предупреждений: {warnings}/{MAX_WARNINGS}\n"
+                    f"Причина: {suggested_warning}"
+                )
+            except Exception as e:
+                logger.error(f"Ошибка при отправке сообщения в группу: {e}")
+    
         except Exception as e:
             await query.edit_message_text(f"Произошла ошибка: {e}")
             logger.error(f"Ошибка при обработке колбэка warn: {e}")
@@ -1791,54 +5689,30 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     elif callback_data.startswith('profile_'):
         # Колбэк для действий из профиля пользователя
         action, target_user_id = callback_data.split('_')[1:]
+        target_user_id = int(target_user_id)
         
         # Проверяем, является ли пользователь администратором
-        if not is_admin(user.id):
+        if not await is_admin(user.id, chat_id, context.bot):
             await query.edit_message_text(
                 "У вас нет прав для выполнения этого действия."
             )
             return
         
-        # Получаем ID чата из предыдущего сообщения
-        chat_id = query.message.chat_id
-        
         try:
             if action == 'warn':
                 # Выдаем предупреждение
-                warnings_data = get_user_warnings(chat_id, target_user_id)
-                warnings = warnings_data['warnings']
-                
-                # Увеличиваем количество предупреждений
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE user_warnings SET warnings = warnings + 1, reason = ?, updated_at = CURRENT_TIMESTAMP "
-                        "WHERE group_id = ? AND user_id = ?",
-                        ("Нарушение правил (из профиля)", str(chat_id), target_user_id)
-                    )
-                    conn.commit()
-                
-                # Проверяем, достигнут ли лимит предупреждений
-                warnings += 1
+                warnings, limit_reached = await run_db(
+                    add_warning, chat_id, target_user_id, "Нарушение правил (из профиля)"
+                )
                 
                 result_text = f"Пользователю (ID: {target_user_id}) выдано предупреждение.\n"
                 result_text += f"Всего предупреждений: {warnings}/{MAX_WARNINGS}"
                 
                 # Если достигнут лимит, баним пользователя
-                if warnings >= MAX_WARNINGS:
+                if limit_reached:
                     try:
                         await context.bot.ban_chat_member(chat_id, int(target_user_id))
                         
-                        # Сбрасываем счетчик предупреждений
-                        with get_db_connection() as conn:
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
-                                "WHERE group_id = ? AND user_id = ?",
-                                (str(chat_id), target_user_id)
-                            )
-                            conn.commit()
-                        
                         result_text += f"\n\nПользователь забанен после достижения {MAX_WARNINGS} предупреждений!"
                     except Exception as e:
                         result_text += f"\n\nОшибка при бане пользователя: {e}"
@@ -1888,16 +5762,166 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         except Exception as e:
             await query.edit_message_text(f"Произошла ошибка: {e}")
             logger.error(f"Ошибка при обработке колбэка profile: {e}")
+    
+    elif callback_data.startswith('analyses_'):
+        # Колбэк листания результатов анализа
+        if not await is_admin(user.id, chat_id, context.bot):
+            return
+        
+        parts = callback_data.split('_')[1:]
+        after_id = int(parts[0])
+        analysis_filters = AnalysisFilters.decode(parts[1:])
+        
+        page = await run_db(get_analyses_page, chat_id, analysis_filters, after_id)
+        if page is None:
+            # Запись-курсор удалена очисткой - начинаем сначала
+            after_id = 0
+            page = await run_db(get_analyses_page, chat_id, analysis_filters)
+        
+        rows, has_more = page
+        if not rows:
+            await query.edit_message_text("Нет результатов анализа по заданным условиям.")
+            return
+        
+        results_text, reply_markup = render_analyses_page(analysis_filters, rows, has_more, after_id)
+        await query.edit_message_text(results_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    
+    elif callback_data.startswith('search_'):
+        # Колбэк листания результатов поиска
+        if not await is_admin(user.id, chat_id, context.bot):
+            return
+        
+        # Текст запроса восстанавливаем из команды, на которую отвечает сообщение с результатами
+        command_message = query.message.reply_to_message
+        command_parts = (command_message.text or '').split(maxsplit=1) if command_message else []
+        if len(command_parts) < 2:
+            await query.edit_message_text("Исходный запрос не найден, повторите команду /search.")
+            return
+        
+        text = command_parts[1]
+        offset = int(callback_data.split('_')[1])
+        rows, has_more, truncated = await run_db(search_analyses, chat_id, text, offset)
+        
+        if not rows:
+            await query.edit_message_text("Ничего не найдено.")
+            return
+        
+        results_text, reply_markup = render_search_page(text, rows, has_more, offset, truncated)
+        await query.edit_message_text(results_text, reply_markup=reply_markup)
 
 # ------ Обработчики событий ------ #
 
+async def unlock_chat(bot, chat_id):
+    """Открытие чата после рейда с возвратом прежних прав"""
+    permissions = raid_detector.saved_permissions.pop(chat_id, None) or ChatPermissions(
+        can_send_messages=True,
+        can_send_media_messages=True,
+        can_send_polls=True,
+        can_send_other_messages=True,
+        can_add_web_page_previews=True,
+        can_change_info=False,
+        can_invite_users=True,
+        can_pin_messages=False
+    )
+    raid_detector.end_raid(chat_id)
+    
+    try:
+        await bot.set_chat_permissions(chat_id, permissions)
+        await bot.send_message(chat_id, "Чат снова открыт.")
+        logger.info(f"Группа {chat_id} открыта после рейда")
+    except Exception as e:
+        logger.error(f"Ошибка при открытии группы {chat_id} после рейда: {e}")
+
+async def unlock_chat_later(bot, chat_id, delay):
+    """Открытие чата по истечении времени закрытия"""
+    await asyncio.sleep(delay)
+    # Чат могли открыть вручную раньше
+    if chat_id in raid_detector.saved_permissions:
+        await unlock_chat(bot, chat_id)
+
+async def handle_raid(bot, event):
+    """Реакция на рейд: закрытие чата, удаление сообщений и мут участников"""
+    chat_id = event.chat_id
+    reasons = {
+        'duplicates': "одинаковые сообщения от разных участников",
+        'joins': "массовое вступление",
+        'messages': "слишком много сообщений"
+    }
+    
+    permissions = ChatPermissions(
+        can_send_messages=False,
+        can_send_media_messages=False,
+        can_send_polls=False,
+        can_send_other_messages=False,
+        can_add_web_page_previews=False,
+        can_change_info=False,
+        can_invite_users=False,
+        can_pin_messages=False
+    )
+    
+    # Без сохраненных прав чат откроется с обычными правами участников
+    raid_detector.saved_permissions.setdefault(chat_id, None)
+    try:
+        # Запоминаем права чата, чтобы вернуть их после закрытия
+        chat = await bot.get_chat(chat_id)
+        if chat is not None and chat.permissions is not None:
+            raid_detector.saved_permissions[chat_id] = chat.permissions
+        
+        await bot.set_chat_permissions(chat_id, permissions)
+        await bot.send_message(
+            chat_id,
+            f"Обнаружен рейд ({reasons.get(event.reason, event.reason)}). "
+            f"Чат закрыт на {RAID_LOCKDOWN_TIME // 60} мин."
+        )
+        logger.warning(f"Рейд в группе {chat_id}: {event.reason}, участников: {len(event.user_ids)}")
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии группы {chat_id} из-за рейда: {e}")
+    
+    spawn_background(unlock_chat_later(bot, chat_id, RAID_LOCKDOWN_TIME))
+    
+    # Владельцы и администраторы, попавшие в кластер, не наказываются: их сообщения остаются
+    exempt = set()
+    for user_id in event.user_ids:
+        if is_owner(user_id) or await is_admin(user_id, chat_id, bot):
+            exempt.add(user_id)
+    
+    # Удаляем сообщения рейда
+    for user_id, message_id in event.messages:
+        if user_id in exempt:
+            continue
+        try:
+            await bot.delete_message(chat_id, message_id)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении сообщения {message_id} рейда: {e}")
+    
+    # Заглушаем участников рейда, кроме владельцев и администраторов
+    until_date = int(time.time() + RAID_MUTE_TIME)
+    for user_id in event.user_ids:
+        if user_id in exempt:
+            continue
+        try:
+            await bot.restrict_chat_member(
+                chat_id,
+                user_id,
+                permissions,
+                until_date=until_date
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при муте участника рейда {user_id}: {e}")
+
 async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Приветствие нового участника группы"""
     chat_id = update.effective_chat.id
     
     # Получаем настройки группы
-    settings = get_group_settings(chat_id)
-    welcome_message = settings['welcome_message'] if settings else "Добро пожаловать, {name}!"
+    group = await fetch_group_context(chat_id)
+    welcome_message = group.welcome_message
+    
+    # Массовое вступление учитывается в активности чата
+    if group.raid_protection:
+        raid_event = raid_detector.record_join(chat_id, len(update.message.new_chat_members))
+        if raid_event:
+            spawn_background(handle_raid(context.bot, raid_event))
     
     # Обрабатываем всех новых участников
     for new_member in update.message.new_chat_members:
@@ -1905,8 +5929,11 @@ async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if new_member.id == context.bot.id:
             continue
         
+        # Для новичков действует отдельное правило антифлуда
+        rate_limiter.mark_newcomer(chat_id, new_member.id)
+        
         # Обновляем информацию о пользователе в базе данных
-        update_user_info(
+        await update_user_info(
             new_member.id,
             username=new_member.username,
             first_name=new_member.first_name,
@@ -1920,6 +5947,16 @@ async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         await update.message.reply_text(formatted_welcome)
 
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновление кэша администраторов по изменениям участников чата"""
+    member_update = update.chat_member
+    if not member_update:
+        return
+    
+    new_member = member_update.new_chat_member
+    is_chat_admin = new_member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+    admin_cache.update_member(member_update.chat.id, new_member.user.id, is_chat_admin)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка каждого сообщения"""
     message = update.message
@@ -1931,77 +5968,92 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Обновляем информацию о пользователе
-    update_user_info(
+    await update_user_info(
         user.id,
         username=user.username,
         first_name=user.first_name,
         last_name=user.last_name
     )
     
+    # Загружаем настройки группы один раз на всё сообщение
+    group = await fetch_group_context(chat_id)
+    
+    # Сигнатура текста считается один раз: ее используют и история антифлуда, и контекст анализа
+    signature = simhash(message.text)
+    
     # Проверка на флуд
-    if check_flood(str(user.id), str(chat_id), message.text):
+    flood_rule = check_flood(user.id, chat_id, message.text, group, signature)
+    
+    # Проверка на рейд: одинаковый текст от разных участников и общий поток сообщений чата
+    if group.raid_protection:
+        raid_event = raid_detector.record_message(
+            chat_id,
+            user.id,
+            message.message_id,
+            signature if len(message.text) >= RAID_MIN_TEXT_LENGTH else None
+        )
+        if raid_event:
+            spawn_background(handle_raid(context.bot, raid_event))
+    if flood_rule:
         # Игнорируем флуд от владельцев и администраторов
-        if is_owner(user.id) or is_admin(user.id):
+        if is_owner(user.id) or await is_admin(user.id, chat_id, context.bot):
             return
         
-        settings = get_group_settings(chat_id)
-        if settings and settings['anti_flood']:
-            try:
-                # Заглушаем пользователя
-                permissions = ChatPermissions(
-                    can_send_messages=False,
-                    can_send_media_messages=False,
-                    can_send_polls=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False,
-                    can_change_info=False,
-                    can_invite_users=False,
-                    can_pin_messages=False
-                )
-                
-                until_date = int(time.time() + FLOOD_MUTE_TIME)
-                
-                await context.bot.restrict_chat_member(
-                    chat_id,
-                    user.id,
-                    permissions,
-                    until_date=until_date
-                )
-                
-                # Отправляем предупреждение
-                await message.reply_text(
-                    f"Пользователь {user.first_name} заглушен на 15 минут за флуд."
-                )
-                
-                logger.info(f"Пользователь {user.id} заглушен за флуд в группе {chat_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при муте пользователя за флуд: {e}")
+        try:
+            # Заглушаем пользователя
+            permissions = ChatPermissions(
+                can_send_messages=False,
+                can_send_media_messages=False,
+                can_send_polls=False,
+                can_send_other_messages=False,
+                can_add_web_page_previews=False,
+                can_change_info=False,
+                can_invite_users=False,
+                can_pin_messages=False
+            )
+            
+            until_date = int(time.time() + flood_rule.mute_time)
+            
+            await context.bot.restrict_chat_member(
+                chat_id,
+                user.id,
+                permissions,
+                until_date=until_date
+            )
+            
+            # Отправляем предупреждение
+            await message.reply_text(
+                f"Пользователь {user.first_name} заглушен на {flood_rule.mute_time // 60} мин. за флуд."
+            )
+            
+            logger.info(f"Пользователь {user.id} заглушен за флуд в группе {chat_id}")
+        except Exception as e:
+            logger.error(f"Ошибка при муте пользователя за флуд: {e}")
     
     # Умные предупреждения
-    if is_smart_warnings_enabled(str(chat_id)):
+    if group.smart_warnings:
         # Получаем контекст сообщений пользователя
         messages = message_tracker.get_user_messages(
-            str(user.id),
-            chat_id=str(chat_id),
+            user.id,
+            chat_id=chat_id,
             seconds=60,
             limit=5
         )
         
-        # Подсчитываем похожие сообщения
-        similar_count = 0
-        if messages:
-            # Простая проверка на похожесть
-            last_message_prefix = message.text[:5].lower() if len(message.text) >= 5 else message.text.lower()
-            for msg in messages:
-                msg_text = msg['text']
-                if msg_text[:5].lower() == last_message_prefix:
-                    similar_count += 1
+        # Подсчитываем похожие сообщения (по расстоянию между SimHash)
+        similar_count = message_tracker.count_similar(
+            user.id,
+            chat_id,
+            signature,
+            seconds=60,
+            limit=5
+        )
         
         # Создаем контекст для анализа
         context_data = {
-            'recent_messages': [msg['text'] for msg in messages],
+            'recent_messages': [msg.text for msg in messages if msg.text is not None],
             'message_count': len(messages),
-            'frequency': message_tracker.get_message_frequency(str(user.id), str(chat_id), 60),
+            'frequency': message_tracker.get_message_frequency(user.id, chat_id, 60),
             'similar_messages': similar_count
         }
         
@@ -2009,9 +6061,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         analysis_result = warning_analyzer.analyze_message(message.text, context_data)
         
         # Отфильтровываем по включенным типам нарушений
-        enabled_types = get_enabled_violation_types(str(chat_id))
-        if enabled_types:
-            analysis_result['violations'] = [v for v in analysis_result['violations'] if v in enabled_types]
+        if group.enabled_types:
+            analysis_result['violations'] = [v for v in analysis_result['violations'] if v in group.enabled_types]
             analysis_result['has_violation'] = len(analysis_result['violations']) > 0
             
             # Пересчитываем уверенность
@@ -2023,44 +6074,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Если есть нарушение, записываем результат
         if analysis_result['has_violation']:
-            record_id = record_analysis(
+            # Администраторы и владельцы не получают предупреждений
+            sender_is_admin = await is_admin(user.id, chat_id, context.bot)
+            
+            # Проверяем на автоматические предупреждения
+            auto_warn = (group.auto_warnings and
+                         analysis_result['confidence'] >= group.min_confidence and
+                         not sender_is_admin)
+            
+            # Запись анализа уходит в фоновую очередь; отметку о предупреждении ставим сразу
+            await record_analysis(
                 chat_id,
                 user.id,
                 message.message_id,
                 message.text,
-                analysis_result
+                analysis_result,
+                is_warned=auto_warn,
+                wait=False
             )
             
-            # Проверяем на автоматические предупреждения
-            min_confidence = get_min_confidence(str(chat_id))
-            
-            if (is_auto_warnings_enabled(str(chat_id)) and
-                analysis_result['confidence'] >= min_confidence and
-                not is_owner(user.id) and
-                not is_admin(user.id)):
-                
+            if auto_warn:
                 # Автоматически выдаем предупреждение
-                warnings_data = get_user_warnings(chat_id, user.id)
-                warnings = warnings_data['warnings']
-                
-                # Увеличиваем количество предупреждений
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE user_warnings SET warnings = warnings + 1, reason = ?, updated_at = CURRENT_TIMESTAMP "
-                        "WHERE group_id = ? AND user_id = ?",
-                        (analysis_result['suggested_warning'], str(chat_id), str(user.id))
-                    )
-                    
-                    # Помечаем анализ как предупрежденный
-                    cursor.execute(
-                        "UPDATE message_analysis SET is_warned = 1 WHERE id = ?",
-                        (record_id,)
-                    )
-                    conn.commit()
-                
-                # Проверяем, достигнут ли лимит предупреждений
-                warnings += 1
+                warnings, limit_reached = await run_db(
+                    add_warning, chat_id, user.id, analysis_result['suggested_warning']
+                )
                 
                 # Отправляем сообщение о предупреждении
                 await message.reply_text(
@@ -2070,20 +6107,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 
                 # Если достигнут лимит, баним пользователя
-                if warnings >= MAX_WARNINGS:
+                if limit_reached:
                     try:
                         await context.bot.ban_chat_member(chat_id, user.id)
                         
-                        # Сбрасываем счетчик предупреждений
-                        with get_db_connection() as conn:
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                "UPDATE user_warnings SET warnings = 0, updated_at = CURRENT_TIMESTAMP "
-                                "WHERE group_id = ? AND user_id = ?",
-                                (str(chat_id), str(user.id))
-                            )
-                            conn.commit()
-                        
                         await message.reply_text(
                             f"Пользователь {user.first_name} (ID: {user.id}) забанен после достижения {MAX_WARNINGS} предупреждений."
                         )
@@ -2091,8 +6118,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         logger.error(f"Ошибка при бане пользователя после предупреждений: {e}")
             
             elif (analysis_result['confidence'] >= 0.7 and
-                  not is_owner(user.id) and
-                  not is_admin(user.id)):
+                  not sender_is_admin):
                 # Предлагаем администраторам выдать предупреждение
                 # Отправляем кнопку предупреждения всем админам в личку
                 pass
@@ -2104,13 +6130,34 @@ def update_health_check_file():
     while True:
         try:
             with open(HEALTH_CHECK_FILE, 'w') as f:
-                f.write(f"Bot is running: {datetime.datetime.now()}")
+                f.write(format_health_status())
             logger.debug("Обновлен файл состояния бота")
         except Exception as e:
             logger.error(f"Ошибка при обновлении файла состояния: {e}")
         
         time.sleep(HEALTH_CHECK_INTERVAL)
 
+async def post_init(application):
+    """Запуск фоновых задач после инициализации приложения"""
+    await storage.start()
+    spawn_background(loop_lag_monitor.run())
+    spawn_background(analysis_retention_job.run())
+    spawn_background(message_tracker.run())
+    spawn_background(rate_limiter.run())
+    spawn_background(tracker_snapshot.run())
+    spawn_background(raid_detector.run())
+
+async def post_shutdown(application):
+    """Остановка фоновых задач с сохранением данных"""
+    await storage.stop()
+    try:
+        tracker_snapshot.write()
+    except Exception as e:
+        logger.error(f"Ошибка записи снимка трекера: {e}")
+    for task in list(background_tasks):
+        task.cancel()
+    db_executor.shutdown(wait=True)
+
 def signal_handler(sig, frame):
     """Обработчик сигналов для корректного завершения"""
     logger.info(f"Получен сигнал {sig}, завершение работы...")
@@ -2119,6 +6166,18 @@ def signal_handler(sig, frame):
             f.write(f"Bot shutdown: {datetime.datetime.now()}")
     except Exception:
         pass
+    
+    # Дописываем в базу отложенные записи, прежде чем завершаться
+    try:
+        storage.drain_sync()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении очереди записи: {e}")
+    
+    # Сохраняем историю и антифлуд, чтобы после перезапуска флудеры не начинали с чистого листа
+    try:
+        tracker_snapshot.write()
+    except Exception as e:
+        logger.error(f"Ошибка записи снимка трекера: {e}")
     sys.exit(0)
 
 def main():
@@ -2126,6 +6185,12 @@ def main():
     # Инициализация базы данных
     init_db()
     
+    # Восстановление истории сообщений и антифлуда после перезапуска
+    tracker_snapshot.restore()
+    
+    # Словарь нарушений из хранилища
+    warning_analyzer.load_lexicon(get_lexicon())
+    
     # Установка обработчиков сигналов
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -2143,7 +6208,13 @@ def main():
     logger.info("Запущен поток проверки состояния бота")
     
     # Создание и настройка приложения бота
-    application = ApplicationBuilder().token(TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("start", start_command))
@@ -2170,17 +6241,26 @@ def main():
     application.add_handler(CommandHandler("rules", rules_command))
     application.add_handler(CommandHandler("setwelcome", set_welcome_command))
     application.add_handler(CommandHandler("toggleflood", toggle_flood_command))
+    application.add_handler(CommandHandler("floodlimit", flood_limit_command))
+    application.add_handler(CommandHandler("raid", raid_command))
     
     # Умные предупреждения
     application.add_handler(CommandHandler("smartwarnings", smart_warnings_command))
     application.add_handler(CommandHandler("analyze", analyze_command))
     application.add_handler(CommandHandler("analyses", show_analyses))
+    application.add_handler(CommandHandler("search", search_command))
+    
+    # Экспорт и импорт
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", import_command))
+    application.add_handler(CommandHandler("lexicon", lexicon_command))
     
     # Обработчик кнопок
     application.add_handler(CallbackQueryHandler(handle_callback_query))
     
     # Обработчики событий
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     # Обработчик ошибок
@@ -2217,6 +6297,61 @@ def main():
                 f.write(f"Bot shutdown: {datetime.datetime.now()}")
         except Exception:
             pass
+        
+        # Закрываем соединения с базой данных
+        storage.close()
+
+def run_cli(argv):
+    """Обслуживание данных из командной строки без запуска бота: экспорт, импорт, перестройка базы"""
+    parser = argparse.ArgumentParser(description="Обслуживание данных бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    export_parser = subparsers.add_parser('export', help="Выгрузить данные")
+    export_parser.add_argument('path', help="Каталог или .zip-архив для выгрузки")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl', help="Формат файлов")
+    export_parser.add_argument('--group', type=int, help="Выгрузить только одну группу")
+    
+    import_parser = subparsers.add_parser('import', help="Загрузить выгрузку (прерванный импорт продолжится)")
+    import_parser.add_argument('path', help="Каталог или .zip-архив выгрузки")
+    
+    subparsers.add_parser('vacuum', help="Перестроить базу с инкрементальным auto_vacuum (при остановленном боте)")
+    
+    args = parser.parse_args(argv)
+    init_db()
+    
+    try:
+        if args.command == 'export':
+            if args.path.endswith('.zip'):
+                with tempfile.TemporaryDirectory() as directory:
+                    manifest = export_data(directory, args.format, args.group)
+                    pack_export(directory, args.path)
+            else:
+                manifest = export_data(args.path, args.format, args.group)
+            for table, info in manifest['tables'].items():
+                print(f"{table}: {info['rows']} строк, sha256 {info['sha256']}")
+        
+        elif args.command == 'vacuum':
+            if not isinstance(storage, SQLiteStorage):
+                raise ValueError("перестройка доступна только для хранилища SQLite")
+            with get_db_connection() as conn:
+                if enable_incremental_vacuum(conn):
+                    print(f"База перестроена, размер {database_size(conn)[0] / 2**20:.1f} МБ")
+                else:
+                    print("Инкрементальный auto_vacuum уже включен")
+        
+        else:
+            if args.path.endswith('.zip'):
+                with tempfile.TemporaryDirectory() as directory:
+                    imported = import_data(unpack_export(args.path, directory))
+            else:
+                imported = import_data(args.path)
+            for table, rows in imported.items():
+                print(f"{table}: загружено {rows} строк")
+    finally:
+        storage.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""Общие функции бенчмарков: загрузка модуля бота из рабочего дерева или из ревизии git"""
+import argparse
+import atexit
+import importlib.util
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+BOT_FILE = "assistant .py"
+
+
+def parse_args(description, **extra):
+    """Аргументы бенчмарка: --rev (ревизия git, по умолчанию рабочее дерево) и дополнительные"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--rev', help="Ревизия git, код которой измерять (например, f639896^)")
+    for name, (kind, default, help_text) in extra.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=kind, default=default, help=help_text)
+    return parser.parse_args()
+
+
+def load_bot(revision=None, workdir=None, env=None):
+    """Загрузка модуля бота с базой и журналом во временном каталоге.
+    
+    revision - ревизия git: код берется из `git show <revision>:"assistant .py"`,
+    так что «до» и «после» измеряются одним и тем же скриптом.
+    """
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="bot-bench-")
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bot.db')
+    os.environ['TRACKER_SNAPSHOT_FILE'] = os.path.join(workdir, 'tracker.snapshot')
+    os.environ.update(env or {})
+    
+    path = REPO / BOT_FILE
+    if revision:
+        source = subprocess.run(
+            ['git', '-C', str(REPO), 'show', f"{revision}:{BOT_FILE}"],
+            check=True, capture_output=True, text=True
+        ).stdout
+        path = pathlib.Path(workdir) / 'assistant.py'
+        path.write_text(source, encoding='utf-8')
+    
+    # Журнал bot_output.log создается в текущем каталоге, а старые ревизии и базу открывают
+    # по относительному пути bot.db - поэтому бенчмарк работает во временном каталоге целиком
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location('assistant', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['assistant'] = module
+    spec.loader.exec_module(module)
+    
+    # Журнал в файл остается, вывод в консоль бенчмарку не нужен
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.ERROR)
+    return module
@@ -0,0 +1,35 @@
+"""Стоимость обращений к базе на одно сообщение: соединение на каждый вызов против пула.
+
+Повторяет запросы, которые обработчик сообщений делал на каждое текстовое сообщение
+(профиль, флуд, настройки умных предупреждений, проверка администратора).
+Функции с этими именами и сигнатурами есть и до, и после перехода на пул (user-001).
+"""
+import time
+
+import common
+
+args = common.parse_args(
+    __doc__.splitlines()[0],
+    messages=(int, 3000, "Сколько сообщений обработать"),
+    users=(int, 50, "Сколько разных авторов"),
+)
+bot = common.load_bot(args.rev)
+bot.init_db()
+
+group_id = '-1001'
+started = time.perf_counter()
+for i in range(args.messages):
+    user_id = 1000 + i % args.users
+    bot.update_user_info(user_id, username='user', first_name='First', last_name='Last')
+    bot.check_flood(str(user_id), group_id, 'hello')
+    bot.is_smart_warnings_enabled(group_id)
+    bot.get_enabled_violation_types(group_id)
+    bot.get_min_confidence(group_id)
+    bot.is_auto_warnings_enabled(group_id)
+    bot.is_admin(user_id)
+elapsed = time.perf_counter() - started
+
+print(f"rev={args.rev or 'working tree'} messages={args.messages} "
+      f"per-message DB cost: {elapsed / args.messages * 1e6:.0f} us")
+if hasattr(bot, 'db_pool'):
+    print(f"pool: {bot.db_pool.stats()}")
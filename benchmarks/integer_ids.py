@@ -0,0 +1,89 @@
+"""Размер базы и задержка поиска при идентификаторах TEXT и INTEGER.
+
+Схема создается самим ботом выбранной ревизии (init_db), затем message_analysis
+заполняется --rows строками (по умолчанию 10 млн) за 30 дней в 500 группах,
+а user_warnings - 300 тысячами пар (группа, пользователь). Идентификаторы
+записываются в том типе, который объявлен в схеме ревизии. Поиск идет через
+функции бота: get_user_warnings и get_last_analysis.
+"""
+import os
+import random
+import sqlite3
+import time
+
+import common
+
+args = common.parse_args(
+    __doc__.splitlines()[0],
+    rows=(int, 10_000_000, "Сколько строк message_analysis создать"),
+    warnings=(int, 300_000, "Сколько строк user_warnings создать"),
+    lookups=(int, 50_000, "Сколько поисков предупреждений выполнить"),
+)
+bot = common.load_bot(args.rev)
+bot.init_db()
+db_path = os.path.abspath(bot.DB_PATH)
+
+GROUPS = 500
+DAYS = 30
+
+
+def group_key(number):
+    return -1001000000000 - number
+
+
+def seed():
+    """Заполнение таблиц напрямую, в обход бота: так быстрее и одинаково для обеих схем"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF")
+    declared = {row[1]: row[2].upper() for row in conn.execute("PRAGMA table_info(message_analysis)")}
+    convert = str if declared['group_id'] == 'TEXT' else int
+    
+    rnd = random.Random(1)
+    rows = (
+        (convert(group_key(rnd.randrange(GROUPS))), convert(rnd.randrange(10**9, 7 * 10**9)),
+         convert(rnd.randrange(10**6)), 'текст сообщения', 0, '', 0.5, None, 0,
+         f"2026-09-{1 + i * DAYS // args.rows:02d} {i % 24:02d}:{i % 60:02d}:{i % 59:02d}")
+        for i in range(args.rows)
+    )
+    conn.executemany(
+        "INSERT INTO message_analysis (group_id, user_id, message_id, message_text, has_violation, "
+        "violation_types, confidence, suggested_warning, is_warned, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    
+    rnd = random.Random(2)
+    keys = {(group_key(rnd.randrange(GROUPS)), rnd.randrange(10**9, 7 * 10**9)) for _ in range(args.warnings)}
+    conn.executemany(
+        "INSERT OR IGNORE INTO user_warnings (group_id, user_id, warnings, reason) VALUES (?, ?, 1, 'спам')",
+        ((convert(group_id), convert(user_id)) for group_id, user_id in keys)
+    )
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    try:
+        sizes = conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC").fetchall()
+    except sqlite3.OperationalError:
+        sizes = []
+    conn.close()
+    return declared['group_id'], sorted(keys), sizes
+
+
+started = time.perf_counter()
+id_type, keys, sizes = seed()
+print(f"rev={args.rev or 'working tree'} id type {id_type}: seeded {args.rows:,} analyses "
+      f"in {time.perf_counter() - started:.0f}s, file {os.path.getsize(db_path) / 1e6:.1f} MB")
+for name, size in sizes[:6]:
+    print(f"  {name}: {size / 1e6:.1f} MB")
+
+sample = random.Random(3).sample(keys, min(args.lookups, len(keys)))
+started = time.perf_counter()
+for group_id, user_id in sample:
+    bot.get_user_warnings(group_id, user_id)
+warning_lookup = (time.perf_counter() - started) / len(sample) * 1e6
+
+started = time.perf_counter()
+for number in range(GROUPS * 4):
+    bot.get_last_analysis(group_key(number % GROUPS), 10)
+last_analyses = (time.perf_counter() - started) / (GROUPS * 4) * 1e6
+
+print(f"  get_user_warnings {warning_lookup:.1f} us, get_last_analysis(10) {last_analyses:.1f} us")
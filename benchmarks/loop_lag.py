@@ -0,0 +1,137 @@
+"""Задержка цикла событий под синтетической нагрузкой на handle_message.
+
+Сообщения подаются с заданной частотой (по умолчанию 1000 в секунду) в одну группу
+с включенными умными предупреждениями, каждое пятое - спам. Порог автоматических
+предупреждений снижен до 0.5, поэтому большая часть сообщений пишет в базу. Параллельно тикер
+спит по 5 мс и записывает, насколько позже он просыпается: это и есть задержка цикла.
+Обновления и бот - минимальные заглушки без сети.
+
+--commit-delay имитирует медленный диск: каждый COMMIT дополнительно ждет столько
+миллисекунд (как долгий fsync). Пока запросы выполняются прямо в цикле событий,
+это ожидание останавливает все чаты.
+"""
+import asyncio
+import itertools
+import sqlite3
+import statistics
+import time
+import types
+
+import common
+
+args = common.parse_args(
+    __doc__.splitlines()[0],
+    rate=(int, 1000, "Сообщений в секунду"),
+    duration=(float, 3.0, "Длительность нагрузки (секунды)"),
+    commit_delay=(float, 0.0, "Дополнительная задержка каждого COMMIT (мс)"),
+)
+
+
+class SlowCommitConnection(sqlite3.Connection):
+    """Соединение, у которого COMMIT ждет --commit-delay миллисекунд"""
+    
+    def commit(self):
+        time.sleep(args.commit_delay / 1000)
+        super().commit()
+
+
+if args.commit_delay:
+    connect = sqlite3.connect
+    sqlite3.connect = lambda *a, **kw: connect(*a, factory=SlowCommitConnection, **kw)
+
+bot_module = common.load_bot(args.rev)
+bot_module.init_db()
+
+GROUP_ID = -1001
+TICK = 0.005
+message_ids = itertools.count(1)
+
+
+class FakeBot:
+    """Бот без сети: администраторов нет, остальные вызовы ничего не делают"""
+    id = 999
+    
+    async def get_chat_administrators(self, chat_id):
+        return []
+    
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            return None
+        return call
+
+
+class FakeMessage:
+    def __init__(self, user, text):
+        self.chat_id = GROUP_ID
+        self.chat = types.SimpleNamespace(id=GROUP_ID, type='supergroup')
+        self.from_user = user
+        self.text = text
+        self.message_id = next(message_ids)
+        self.reply_to_message = None
+        self.new_chat_members = []
+    
+    async def reply_text(self, text, **kwargs):
+        return None
+
+
+def make_update(number):
+    user = types.SimpleNamespace(id=1000 + number % 500, first_name=f"User{number % 7}", username=None,
+                                 last_name=None, is_bot=False)
+    text = 'купите скидка https://example.com' if number % 5 == 0 else f'{number} - обычное сообщение'
+    message = FakeMessage(user, text)
+    return types.SimpleNamespace(message=message, effective_user=user, effective_chat=message.chat,
+                                 effective_message=message, callback_query=None)
+
+
+async def ticker(lags, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(loop.time() - started - TICK)
+
+
+async def run():
+    writer = getattr(bot_module, 'db_writer', None)
+    if writer is not None:
+        await writer.start()
+    
+    bot = FakeBot()
+    context = types.SimpleNamespace(bot=bot, args=[], application=None, bot_data={}, chat_data={}, user_data={})
+    lags = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(ticker(lags, stop))
+    
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    sent = 0
+    pending = set()
+    while loop.time() - started < args.duration:
+        due = int((loop.time() - started) * args.rate)
+        while sent < due:
+            task = asyncio.create_task(bot_module.handle_message(make_update(sent), context))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            sent += 1
+        await asyncio.sleep(0.001)
+    await asyncio.gather(*pending)
+    elapsed = loop.time() - started
+    
+    stop.set()
+    await lag_task
+    if writer is not None:
+        await writer.stop()
+    
+    lags.sort()
+    print(f"rev={args.rev or 'working tree'} commit_delay={args.commit_delay}ms messages={sent} ({sent / elapsed:.0f}/s) "
+          f"loop lag avg={statistics.mean(lags) * 1000:.2f}ms "
+          f"p99={lags[int(len(lags) * 0.99)] * 1000:.2f}ms max={lags[-1] * 1000:.2f}ms")
+
+
+# Настройки меняются только у существующей строки группы
+bot_module.get_group_settings(GROUP_ID)
+bot_module.toggle_smart_warnings(GROUP_ID, True)
+bot_module.toggle_auto_warnings(GROUP_ID, True)
+# Нарушения из нагрузки (уверенность 0.65) должны получать автоматические предупреждения
+bot_module.set_min_confidence(GROUP_ID, 0.5)
+asyncio.run(run())
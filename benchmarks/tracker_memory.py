@@ -0,0 +1,39 @@
+"""Память MessageTracker на одно отслеживаемое сообщение.
+
+--users пользователей пишут в одну группу по --messages сообщений (не больше размера
+истории, чтобы ничего не вытеснялось). Память считается через tracemalloc как прирост
+выделенных байт после заполнения трекера, деленный на число сообщений. Тексты
+сообщений разные и длиной около 30-70 символов.
+"""
+import inspect
+import tracemalloc
+
+import common
+
+args = common.parse_args(
+    __doc__.splitlines()[0],
+    users=(int, 5000, "Сколько пользователей"),
+    messages=(int, 100, "Сколько сообщений у каждого пользователя"),
+)
+bot = common.load_bot(args.rev)
+
+CHAT_ID = -1001234567890
+TEXTS = ['привет всем, как дела? ', 'кто идет вечером на встречу? ', 'ok ',
+         'купите скидка https://t.me/example ', 'смотрите, что нашел в документации: ']
+
+kwargs = {}
+# Ревизии с лимитом памяти трекера: лимит снимаем, чтобы ничего не вытеснялось
+if 'max_bytes' in inspect.signature(bot.MessageTracker).parameters:
+    kwargs['max_bytes'] = 1 << 60
+
+tracemalloc.start()
+before = tracemalloc.get_traced_memory()[0]
+tracker = bot.MessageTracker(**kwargs)
+for user_id in range(args.users):
+    for number in range(args.messages):
+        tracker.add_message(user_id, CHAT_ID, TEXTS[number % len(TEXTS)] * (1 + number % 2) + str(number))
+used = tracemalloc.get_traced_memory()[0] - before
+tracemalloc.stop()
+
+total = args.users * args.messages
+print(f"rev={args.rev or 'working tree'} messages={total:,}: {used / total:.1f} bytes per tracked message")
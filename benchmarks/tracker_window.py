@@ -0,0 +1,40 @@
+"""Пропускная способность MessageTracker при 100 тысячах активных пользователей.
+
+У каждого пользователя сначала набирается история (--history сообщений), затем
+случайные пользователи пишут --ops сообщений (add_message) и столько же раз
+запрашивается частота сообщений за окно флуда (get_message_frequency).
+"""
+import random
+import time
+
+import common
+
+args = common.parse_args(
+    __doc__.splitlines()[0],
+    users=(int, 100_000, "Сколько активных пользователей"),
+    history=(int, 50, "Сколько сообщений у каждого пользователя до замера"),
+    ops=(int, 200_000, "Сколько операций каждого вида измерить"),
+)
+bot = common.load_bot(args.rev)
+
+CHAT_ID = -1001
+tracker = bot.MessageTracker()
+for user_id in range(args.users):
+    for _ in range(args.history):
+        tracker.add_message(user_id, CHAT_ID, 'разогрев')
+
+rnd = random.Random(1)
+user_ids = [rnd.randrange(args.users) for _ in range(args.ops)]
+
+started = time.perf_counter()
+for user_id in user_ids:
+    tracker.add_message(user_id, CHAT_ID, 'привет')
+add_rate = args.ops / (time.perf_counter() - started)
+
+started = time.perf_counter()
+for user_id in user_ids:
+    tracker.get_message_frequency(user_id, CHAT_ID, 60)
+frequency_rate = args.ops / (time.perf_counter() - started)
+
+print(f"rev={args.rev or 'working tree'} users={args.users:,} history={args.history}: "
+      f"add_message {add_rate:,.0f} ops/s, get_message_frequency {frequency_rate:,.0f} ops/s")
@@ -0,0 +1,54 @@
+"""Пропускная способность WarningAnalyzer.analyze_message на типичном потоке сообщений.
+
+Корпус детерминирован (--seed): 90% обычной переписки, 5% рекламы,
+3% оскорблений и 2% флуда, всего --messages сообщений.
+"""
+import random
+import time
+
+import common
+
+WORDS = ('привет как дела сегодня вечером встреча проект код ревью запуск тест сборка ошибка '
+         'исправил спасибо отлично хорошо понял давай завтра hello thanks build deploy merge review').split()
+SPAM = ['Купите скидки на всё! https://shop.example.com', 'Заработок от 1000$ в день, пишите',
+        'join our channel for quick cash', 'Подписывайтесь на канал!', 'www.promo.ru акция']
+OBSCENITY = ['ну ты и дурак', 'заткнись уже', 'какой идиот это написал', 'сука опять сломалось', 'stupid build']
+FLOOD = ['аааааааааааааааа', 'хахахахахахахахаха', '!!!!!!!!!!!!!!!', 'ну ну ну ну ну ну ну ну']
+
+
+def build_corpus(count, seed):
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        kind = rnd.random()
+        if kind < 0.90:
+            text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randrange(2, 25)))
+            messages.append(text.capitalize() + rnd.choice(['', '.', '?', '!', ')']))
+        elif kind < 0.95:
+            messages.append(rnd.choice(SPAM))
+        elif kind < 0.98:
+            messages.append(rnd.choice(OBSCENITY))
+        else:
+            messages.append(rnd.choice(FLOOD))
+    return messages
+
+
+args = common.parse_args(
+    __doc__.splitlines()[0],
+    messages=(int, 1_000_000, "Сколько сообщений проанализировать"),
+    seed=(int, 1, "Зерно генератора корпуса"),
+)
+bot = common.load_bot(args.rev)
+
+messages = build_corpus(args.messages, args.seed)
+analyzer = bot.WarningAnalyzer()
+violations = 0
+
+started = time.perf_counter()
+for text in messages:
+    if analyzer.analyze_message(text)['has_violation']:
+        violations += 1
+elapsed = time.perf_counter() - started
+
+print(f"rev={args.rev or 'working tree'} messages={args.messages:,}: "
+      f"{args.messages / elapsed:,.0f} msg/s, {elapsed:.1f} s, нарушений {violations:,}")
@@ -0,0 +1,32 @@
+import importlib.util
+import os
+import pathlib
+import sys
+
+import pytest
+
+BOT_PATH = pathlib.Path(__file__).resolve().parent.parent / "assistant .py"
+
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+    """Модуль бота, загруженный с базой и журналом во временном каталоге"""
+    pytest.importorskip("telegram")
+    if "assistant" in sys.modules:
+        return sys.modules["assistant"]
+    
+    workdir = tmp_path_factory.mktemp("bot")
+    os.environ["DB_PATH"] = str(workdir / "bot.db")
+    os.environ["TRACKER_SNAPSHOT_FILE"] = str(workdir / "tracker.snapshot")
+    
+    # Журнал bot_output.log создается в текущем каталоге при загрузке модуля
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spec = importlib.util.spec_from_file_location("assistant", BOT_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["assistant"] = module
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
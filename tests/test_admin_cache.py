@@ -0,0 +1,84 @@
+import asyncio
+import types
+
+import pytest
+
+
+class FlakyBot:
+    """Бот, у которого get_chat_administrators падает, пока failing=True"""
+
+    def __init__(self, admins):
+        self.admins = admins
+        self.failing = False
+        self.calls = 0
+
+    async def get_chat_administrators(self, chat_id):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError("Telegram недоступен")
+        return [types.SimpleNamespace(user=types.SimpleNamespace(id=user_id)) for user_id in self.admins]
+
+
+@pytest.fixture
+def clock(bot, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(bot, monkeypatch):
+    cache = bot.AdminCache(ttl=300, retry=15)
+    monkeypatch.setattr(bot, 'admin_cache', cache)
+    return cache
+
+
+def get_admins(bot, api, chat_id=-1):
+    async def run():
+        roster = await bot.get_chat_admins(api, chat_id)
+        # Даем отработать фоновому обновлению
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return roster
+    return asyncio.run(run())
+
+
+def test_failed_first_load_is_not_retried_until_backoff(bot, cache, clock):
+    api = FlakyBot([7])
+    api.failing = True
+    assert get_admins(bot, api) is None
+    assert get_admins(bot, api) is None
+    assert api.calls == 1
+
+    api.failing = False
+    clock[0] += 15
+    assert get_admins(bot, api) == {7}
+    assert api.calls == 2
+
+
+def test_stale_roster_is_reused_while_refresh_fails(bot, cache, clock):
+    api = FlakyBot([7])
+    assert get_admins(bot, api) == {7}
+
+    api.failing = True
+    clock[0] += 301
+    for _ in range(5):
+        assert get_admins(bot, api) == {7}
+    assert api.calls == 2
+    assert cache.stats()['failures'] == 1
+
+
+def test_backoff_doubles_up_to_ttl(bot, cache, clock):
+    api = FlakyBot([7])
+    api.failing = True
+    delays = []
+    for _ in range(7):
+        get_admins(bot, api)
+        retry_at = cache._backoff[-1][0]
+        delays.append(retry_at - clock[0])
+        clock[0] = retry_at
+    assert delays == [15, 30, 60, 120, 240, 300, 300]
+
+    api.failing = False
+    assert get_admins(bot, api) == {7}
+    assert -1 not in cache._backoff
@@ -0,0 +1,166 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def db(bot):
+    bot.init_db()
+    return bot
+
+
+def write_export(directory, tables):
+    """Выгрузка в формате jsonl: {таблица: (колонки, строки)}"""
+    manifest = {'format': 'jsonl', 'tables': {}}
+    for table, (columns, rows) in tables.items():
+        path = directory / f"{table}.jsonl"
+        path.write_text(
+            ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows),
+            encoding='utf-8'
+        )
+        manifest['tables'][table] = {
+            'file': path.name,
+            'columns': columns,
+            'rows': len(rows),
+            'sha256': hashlib.sha256(path.read_bytes()).hexdigest()
+        }
+    (directory / 'manifest.json').write_text(json.dumps(manifest), encoding='utf-8')
+    return directory
+
+
+def daily_stats(bot, group_id):
+    with bot.get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT day, violation_type, messages, warned FROM analysis_daily_stats WHERE group_id = ?",
+            (group_id,)
+        ).fetchall()
+    return {(row['day'], row['violation_type']): (row['messages'], row['warned']) for row in rows}
+
+
+def rolled_up_group(bot, group_id):
+    """Группа, у которой уже свернуты все дни до вчерашнего"""
+    today = datetime.datetime.utcnow().date()
+    bot.storage.get_group_settings(group_id)
+    bot.storage.rollup_analysis_stats(group_id, None, today)
+    return today
+
+
+ANALYSIS_COLUMNS = ['id', 'group_id', 'user_id', 'message_id', 'message_text', 'has_violation',
+                    'violation_types', 'confidence', 'suggested_warning', 'is_warned', 'created_at']
+
+
+def analysis_row(row_id, group_id, day, types='', warned=0):
+    return [row_id, group_id, 1, row_id, 'текст', 1 if types else 0, types, 0.5, None, warned,
+            f"{day.isoformat()} 12:00:00"]
+
+
+def test_import_adds_rolled_up_days_to_daily_stats(db, tmp_path):
+    group_id = -700001
+    today = rolled_up_group(db, group_id)
+    old_day = today - datetime.timedelta(days=10)
+    rows = [
+        analysis_row(1, group_id, old_day, 'spam', warned=1),
+        analysis_row(2, group_id, old_day, 'spam,obscenity'),
+        analysis_row(3, group_id, old_day),
+        # Сегодняшние строки свернет обычная очистка
+        analysis_row(4, group_id, today, 'spam'),
+    ]
+    db.import_data(write_export(tmp_path, {'message_analysis': (ANALYSIS_COLUMNS, rows)}))
+
+    stats = daily_stats(db, group_id)
+    assert stats[(old_day.isoformat(), '')] == (3, 1)
+    assert stats[(old_day.isoformat(), 'spam')] == (2, 1)
+    assert stats[(old_day.isoformat(), 'obscenity')] == (1, 0)
+    assert not any(day == today.isoformat() for day, _ in stats)
+
+
+def test_import_does_not_count_days_with_exported_stats(db, tmp_path):
+    group_id = -700002
+    today = rolled_up_group(db, group_id)
+    old_day = (today - datetime.timedelta(days=5)).isoformat()
+    new_day = today - datetime.timedelta(days=4)
+    stats_columns = ['group_id', 'day', 'violation_type', 'messages', 'warned']
+    db.import_data(write_export(tmp_path, {
+        'analysis_daily_stats': (stats_columns, [[group_id, old_day, '', 7, 2]]),
+        'message_analysis': (ANALYSIS_COLUMNS, [
+            analysis_row(1, group_id, datetime.date.fromisoformat(old_day)),
+            analysis_row(2, group_id, new_day),
+        ]),
+    }))
+
+    stats = daily_stats(db, group_id)
+    assert stats[(old_day, '')] == (7, 2)
+    assert stats[(new_day.isoformat(), '')] == (1, 0)
+
+
+def test_resumed_import_counts_rows_once(db, tmp_path, monkeypatch):
+    group_id = -700003
+    today = rolled_up_group(db, group_id)
+    old_day = today - datetime.timedelta(days=3)
+    monkeypatch.setattr(db, 'IMPORT_CHUNK_SIZE', 2)
+    export = write_export(tmp_path, {'message_analysis': (
+        ANALYSIS_COLUMNS, [analysis_row(i, group_id, old_day) for i in range(1, 6)]
+    )})
+
+    # Прерываем импорт после первой порции
+    write_chunk = db._write_import_chunk
+    calls = []
+
+    def failing_write(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("прервано")
+        return write_chunk(*args, **kwargs)
+
+    monkeypatch.setattr(db, '_write_import_chunk', failing_write)
+    with pytest.raises(RuntimeError):
+        db.import_data(export)
+    monkeypatch.setattr(db, '_write_import_chunk', write_chunk)
+    db.import_data(export)
+
+    assert daily_stats(db, group_id)[(old_day.isoformat(), '')] == (5, 0)
+
+
+def test_existing_database_is_not_rebuilt_at_startup(bot, tmp_path):
+    conn = sqlite3.connect(tmp_path / 'old.db')
+    conn.execute("CREATE TABLE t (x)")
+    conn.commit()
+
+    bot.check_incremental_vacuum(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    assert bot.enable_incremental_vacuum(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert not bot.enable_incremental_vacuum(conn)
+
+
+def test_new_database_starts_incremental(bot, tmp_path):
+    conn = sqlite3.connect(tmp_path / 'new.db')
+    bot.check_incremental_vacuum(conn)
+    conn.execute("CREATE TABLE t (x)")
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def rollup_day(bot, group_id):
+    with bot.get_db_connection() as conn:
+        row = conn.execute("SELECT analysis_rollup_day FROM group_settings WHERE group_id = ?",
+                           (group_id,)).fetchone()
+    return row['analysis_rollup_day']
+
+
+def test_import_keeps_later_rollup_day(db, tmp_path):
+    group_id, new_group_id = -700004, -700005
+    today = rolled_up_group(db, group_id)
+    current = rollup_day(db, group_id)
+    earlier = (today - datetime.timedelta(days=10)).isoformat()
+    db.import_data(write_export(tmp_path, {'group_settings': (
+        ['group_id', 'anti_flood', 'analysis_rollup_day'],
+        [[group_id, 0, earlier], [new_group_id, 1, earlier]]
+    )}))
+
+    assert rollup_day(db, group_id) == current
+    assert db.storage.get_group_settings(group_id)['anti_flood'] == 0
+    assert rollup_day(db, new_group_id) == earlier
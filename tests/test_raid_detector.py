@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def detector(bot):
+    return bot.RaidDetector(window=60, duplicate_users=5, join_limit=15, message_limit=300, lockdown_time=600)
+
+
+def test_duplicates_from_distinct_users_fire_once(bot, detector):
+    signature = bot.simhash("Заходите в наш канал t.me/joinchat/AAAAbbbb бесплатно!")
+    events = [detector.record_message(-1, user_id, 100 + user_id, signature, 1000.0 + user_id) for user_id in range(50)]
+    
+    assert events[:4] == [None] * 4
+    event = events[4]
+    assert event.reason == 'duplicates'
+    assert event.user_ids == (0, 1, 2, 3, 4)
+    assert event.messages == ((0, 100), (1, 101), (2, 102), (3, 103), (4, 104))
+    # Во время закрытия чата повторных событий нет
+    assert all(event is None for event in events[5:])
+    assert detector.under_raid(-1, 1010.0)
+
+
+def test_same_user_repeating_is_not_a_raid(bot, detector):
+    signature = bot.simhash("Заходите в наш канал t.me/joinchat/AAAAbbbb бесплатно!")
+    assert all(detector.record_message(-1, 7, index, signature, 1000.0 + index) is None for index in range(20))
+
+
+def test_near_duplicates_share_a_cluster(bot, detector):
+    text = "Кто хочет заработать 1000$ в день? Пишите в личку @trader"
+    variants = [text, text + "!!!", text.replace("1000", "1500"), "хто" + text[3:], text.upper()]
+    events = [
+        detector.record_message(-1, user_id, user_id, bot.simhash(variant), 1000.0)
+        for user_id, variant in enumerate(variants)
+    ]
+    assert events[-1] is not None and events[-1].reason == 'duplicates'
+
+
+def test_duplicates_outside_window_are_evicted(bot, detector):
+    signature = bot.simhash("Одинаковое сообщение для проверки окна кластера")
+    for user_id in range(4):
+        assert detector.record_message(-1, user_id, user_id, signature, 1000.0) is None
+    # Первые четыре сообщения вышли из окна - пятый участник рейд не вызывает
+    assert detector.record_message(-1, 4, 4, signature, 1061.0) is None
+    
+    cluster = next(iter(detector.chats[-1].clusters))
+    assert list(cluster.users) == [4]
+
+
+def test_sweep_removes_expired_clusters_and_chats(bot, detector):
+    signature = bot.simhash("Одинаковое сообщение для проверки очистки")
+    detector.record_message(-1, 1, 1, signature, 1000.0)
+    detector.record_message(-2, 1, 1, signature, 1050.0)
+    
+    detector.sweep(1070.0)
+    assert -1 not in detector.chats
+    assert detector.chats[-2].clusters
+    
+    detector.chats[-2].last_seen = 1200.0
+    detector.sweep(1200.0)
+    activity = detector.chats[-2]
+    assert not activity.clusters and not activity.bands
+
+
+def test_message_rate_threshold(detector):
+    events = [detector.record_message(-1, index % 40, index, None, 1000.0 + index * 0.1) for index in range(300)]
+    assert events[:299] == [None] * 299
+    assert events[299].reason == 'messages'
+
+
+def test_message_rate_counts_only_window(detector):
+    # 600 сообщений за 200 секунд - в любом окне не больше 180
+    assert all(
+        detector.record_message(-1, index % 40, index, None, 1000.0 + index / 3) is None for index in range(600)
+    )
+
+
+def test_join_threshold(detector):
+    assert [detector.record_join(-1, 1, 1000.0 + index) for index in range(14)] == [None] * 14
+    event = detector.record_join(-1, 1, 1014.0)
+    assert event.reason == 'joins'
+    
+    other = detector.record_join(-2, 14, 1000.0)
+    assert other is None
+    # Вступления старше окна не учитываются
+    assert detector.record_join(-2, 1, 1061.0) is None
+
+
+def test_end_raid_allows_next_event(detector):
+    detector.record_join(-1, 15, 1000.0)
+    assert detector.under_raid(-1, 1001.0)
+    detector.end_raid(-1)
+    assert not detector.under_raid(-1, 1001.0)
+    assert detector.record_join(-1, 15, 1002.0) is not None
+
+
+def test_raid_protection_is_opt_in(bot):
+    assert not bot.GroupContext.from_settings(-1, {}).raid_protection
+    assert bot.MemoryStorage().get_group_settings(-1)['raid_protection'] == 0
+    
+    bot.init_db()
+    assert not bot.storage.get_group_settings(-100500)['raid_protection']
+    bot.set_raid_protection(-100500, True)
+    assert bot.storage.get_group_settings(-100500)['raid_protection']
+
+
+def test_band_lookup_finds_every_close_signature(bot, detector):
+    # Сигнатуры на расстоянии до RAID_MAX_DISTANCE попадают в один кластер при любом расположении битов
+    base = 0x0123456789ABCDEF
+    for shift in range(0, 64 - bot.RAID_MAX_DISTANCE):
+        chat_id = -1000 - shift
+        flipped = base ^ (((1 << bot.RAID_MAX_DISTANCE) - 1) << shift)
+        detector.record_message(chat_id, 1, 1, base, 1000.0)
+        detector.record_message(chat_id, 2, 2, flipped, 1000.0)
+        assert len(detector.chats[chat_id].clusters) == 1
+
+
+class RecordingBot:
+    """Бот без сети: запоминает удаленные сообщения и заглушенных участников"""
+    def __init__(self):
+        self.deleted = []
+        self.restricted = []
+    
+    async def get_chat(self, chat_id):
+        return None
+    
+    async def set_chat_permissions(self, chat_id, permissions):
+        pass
+    
+    async def send_message(self, chat_id, text):
+        pass
+    
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append(message_id)
+    
+    async def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None):
+        self.restricted.append(user_id)
+
+
+def test_raid_spares_admin_messages(bot, monkeypatch):
+    async def is_admin(user_id, chat_id=None, bot=None):
+        return user_id == 2
+    
+    monkeypatch.setattr(bot, 'is_admin', is_admin)
+    # Права чата боту-заглушке не нужны
+    monkeypatch.setattr(bot, 'ChatPermissions', dict)
+    event = bot.RaidEvent(-5, 'duplicates', (1, 2, 3), ((1, 10), (2, 20), (3, 30), (1, 11)))
+    recording = RecordingBot()
+    asyncio.run(bot.handle_raid(recording, event))
+    
+    assert recording.deleted == [10, 30, 11]
+    assert recording.restricted == [1, 3]
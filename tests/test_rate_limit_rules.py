@@ -0,0 +1,28 @@
+import pytest
+
+
+@pytest.mark.parametrize('value', [None, '', 'garbage', 'sliding_log:x:10:900', 'unknown:5:10:900',
+                                   'sliding_log:0:10:900'])
+def test_malformed_rules_fall_back_per_user_class(bot, value):
+    group = bot.GroupContext.from_settings(-1, {'flood_rule': value, 'newcomer_flood_rule': value})
+    assert group.flood_rule is bot.DEFAULT_FLOOD_RULE
+    assert group.newcomer_flood_rule is bot.DEFAULT_NEWCOMER_FLOOD_RULE
+
+
+def test_valid_rules_are_decoded(bot):
+    rule = bot.RateLimitRule('token_bucket', 3, 5.0, 600)
+    group = bot.GroupContext.from_settings(-1, {'flood_rule': rule.encode(), 'newcomer_flood_rule': rule.encode()})
+    assert group.rate_limit_rule('member') == rule
+    # Одинаковые строки правила дают один объект (общее состояние лимитера)
+    assert group.rate_limit_rule('newcomer') is group.rate_limit_rule('member')
+
+
+@pytest.mark.parametrize('period', ['0.5', '0', str(10 ** 9)])
+def test_parse_rejects_period_out_of_bounds(bot, period):
+    with pytest.raises(ValueError, match='окно'):
+        bot.RateLimitRule.parse(['sliding_log', '5', period])
+
+
+def test_parse_accepts_period_bounds(bot):
+    for period in (1, bot.RATE_LIMIT_MAX_PERIOD):
+        assert bot.RateLimitRule.parse(['sliding_log', '5', str(period)]).period == period
@@ -0,0 +1,137 @@
+import asyncio
+import datetime
+
+import pytest
+
+GROUP_ID = -100200300
+USER_ID = 555
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(bot, request, tmp_path):
+    """Одни и те же проверки для обоих движков хранилища"""
+    if request.param == 'sqlite':
+        pool = bot.ConnectionPool(str(tmp_path / 'bot.db'))
+        store = bot.SQLiteStorage(pool, bot.DatabaseWriter(pool=pool))
+    else:
+        store = bot.MemoryStorage()
+    store.init()
+    yield store
+    store.close()
+
+
+def submit(coroutine_function, *args):
+    """Запись через очередь хранилища и ожидание ее результата"""
+    async def run():
+        future = await coroutine_function(*args)
+        return await future
+    return asyncio.run(run())
+
+
+def add_analysis(store, user_id=USER_ID, violation_types='', is_warned=False, text='сообщение'):
+    return submit(store.submit_analysis, GROUP_ID, user_id, 1, text, bool(violation_types),
+                  violation_types, 0.5, None, is_warned)
+
+
+def test_storage_is_abstract(bot):
+    with pytest.raises(TypeError):
+        bot.Storage()
+
+
+def test_warnings_increment_remove_and_reset(bot, store):
+    assert store.get_warning_count(GROUP_ID, USER_ID) == 0
+    assert store.add_warning(GROUP_ID, USER_ID, 'спам', max_warnings=3) == (1, False)
+    assert store.add_warning(GROUP_ID, USER_ID, 'спам', max_warnings=3) == (2, False)
+    assert store.get_user_warnings(GROUP_ID, USER_ID)['reason'] == 'спам'
+    assert store.remove_warning(GROUP_ID, USER_ID) == 1
+    store.reset_warnings(GROUP_ID, USER_ID)
+    assert store.get_warning_count(GROUP_ID, USER_ID) == 0
+    assert store.remove_warning(GROUP_ID, USER_ID) is None
+
+
+def test_warning_limit_resets_counter(bot, store):
+    for expected in (1, 2):
+        assert store.add_warning(GROUP_ID, USER_ID, 'флуд', max_warnings=3) == (expected, False)
+    assert store.add_warning(GROUP_ID, USER_ID, 'флуд', max_warnings=3) == (3, True)
+    assert store.get_warning_count(GROUP_ID, USER_ID) == 0
+
+
+def test_one_warning_per_analysis(bot, store):
+    analysis_id = add_analysis(store, violation_types='spam')
+    assert store.add_warning(GROUP_ID, USER_ID, 'спам', analysis_id=analysis_id) == (1, False)
+    assert store.add_warning(GROUP_ID, USER_ID, 'спам', analysis_id=analysis_id) is None
+    assert store.get_analysis(analysis_id)['is_warned']
+
+
+def test_user_upsert_keeps_known_fields(bot, store):
+    submit(store.submit_user, USER_ID, 'nick', 'Имя', 'Фамилия', None)
+    submit(store.submit_user, USER_ID, None, 'Новое', None, 1)
+    record = store.get_user_record(USER_ID)
+    assert (record['username'], record['first_name'], record['last_name']) == ('nick', 'Новое', 'Фамилия')
+    assert store.get_admin_flag(USER_ID)
+
+
+def test_group_settings_defaults_and_update(bot, store):
+    settings = store.get_group_settings(GROUP_ID)
+    assert settings['anti_flood'] == 1 and settings['smart_warnings'] == 0
+    assert settings['smart_warnings_enabled_types'] == ','.join(bot.VIOLATION_TYPES)
+    assert store.update_group_setting(GROUP_ID, 'smart_warnings', 1)
+    assert store.get_group_settings(GROUP_ID)['smart_warnings'] == 1
+    assert not store.update_group_setting(GROUP_ID + 1, 'smart_warnings', 1)
+
+
+def test_analyses_paging_and_filters(bot, store):
+    ids = [add_analysis(store, user_id=USER_ID + i % 2, violation_types='spam' if i % 3 == 0 else '',
+                        is_warned=i % 4 == 0)
+           for i in range(25)]
+
+    everything = bot.AnalysisFilters()
+    seen, after_id = [], None
+    while True:
+        rows, has_more = store.get_analyses_page(GROUP_ID, everything, after_id, limit=10)
+        seen += [row['id'] for row in rows]
+        if not has_more:
+            break
+        after_id = rows[-1]['id']
+    assert seen == ids[::-1]
+
+    rows, _ = store.get_analyses_page(GROUP_ID, bot.AnalysisFilters(user_id=USER_ID, violation_type='spam'),
+                                      limit=25)
+    assert [row['id'] for row in rows] == [ids[i] for i in range(24, -1, -1) if i % 2 == 0 and i % 3 == 0]
+    rows, _ = store.get_analyses_page(GROUP_ID, bot.AnalysisFilters(warned=True), limit=25)
+    assert [row['id'] for row in rows] == [ids[i] for i in range(24, -1, -1) if i % 4 == 0]
+
+
+def test_retention_keeps_rolled_up_stats(bot, store):
+    store.get_group_settings(GROUP_ID)
+    for i in range(5):
+        add_analysis(store, violation_types='spam' if i < 2 else '')
+    before = store.get_violation_stats(GROUP_ID)
+
+    tomorrow = datetime.datetime.utcnow().date() + datetime.timedelta(days=1)
+    store.rollup_analysis_stats(GROUP_ID, None, tomorrow)
+    cutoff = f"{tomorrow.isoformat()} 00:00:00"
+    assert store.prune_analyses(GROUP_ID, cutoff, limit=3) == 3
+    assert store.prune_analyses(GROUP_ID, cutoff, limit=3) == 2
+    assert store.prune_analyses(GROUP_ID, cutoff, limit=3) == 0
+
+    assert store.get_analyses_page(GROUP_ID, bot.AnalysisFilters()) == ([], False)
+    assert store.get_violation_stats(GROUP_ID) == before
+    assert before['spam'] == 2
+
+
+def test_search_reports_rank_window_cap(bot, store, monkeypatch):
+    monkeypatch.setattr(bot, 'SEARCH_RANK_WINDOW', 3)
+    for i in range(3):
+        add_analysis(store, text=f'вступайте в канал {i}')
+    rows, has_more, truncated = store.search_analyses(GROUP_ID, 'канал')
+    assert len(rows) == 3 and not has_more and not truncated
+
+    add_analysis(store, text='вступайте в канал 3')
+    rows, has_more, truncated = store.search_analyses(GROUP_ID, 'канал')
+    assert len(rows) == 3 and truncated
+    assert store.search_analyses(GROUP_ID, 'нет такого слова') == ([], False, False)
+
+    text, _ = bot.render_search_page('канал', rows, has_more, truncated=truncated)
+    assert 'больше 3' in text
+    assert 'больше' not in bot.render_search_page('канал', rows, has_more)[0]
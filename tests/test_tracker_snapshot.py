@@ -0,0 +1,44 @@
+import time
+
+
+def write_snapshot(bot, path, histories=0, newcomers=0):
+    tracker = bot.MessageTracker()
+    limiter = bot.RateLimiter()
+    for user_id in range(histories):
+        tracker.add_message(user_id, -1, f'сообщение {user_id}')
+    for user_id in range(newcomers):
+        limiter.mark_newcomer(-1, user_id, time.time())
+    bot.TrackerSnapshot(tracker, limiter, path=str(path)).write()
+    return tracker, limiter
+
+
+def restore_snapshot(bot, path, now, budget):
+    snapshot = bot.TrackerSnapshot(bot.MessageTracker(), bot.RateLimiter(), path=str(path), restore_budget=budget)
+    snapshot.restore(now=now)
+    return snapshot
+
+
+def test_snapshot_round_trip(bot, tmp_path):
+    path = tmp_path / 'tracker.snapshot'
+    write_snapshot(bot, path, histories=100, newcomers=10)
+    snapshot = restore_snapshot(bot, path, time.time(), budget=10)
+    assert snapshot.restore_complete
+    assert snapshot.restored['histories'] == 100
+    assert snapshot.restored['newcomers'] == 10
+
+
+def test_idle_histories_respect_restore_budget(bot, tmp_path):
+    path = tmp_path / 'tracker.snapshot'
+    tracker, _ = write_snapshot(bot, path, histories=5000)
+    # Все истории устарели: раньше такие записи пропускались мимо проверки бюджета
+    snapshot = restore_snapshot(bot, path, time.time() + tracker.idle_ttl * 2, budget=0)
+    assert snapshot.restore_complete is False
+    assert snapshot.restored['histories'] == 0
+
+
+def test_expired_newcomers_respect_restore_budget(bot, tmp_path):
+    path = tmp_path / 'tracker.snapshot'
+    _, limiter = write_snapshot(bot, path, newcomers=5000)
+    snapshot = restore_snapshot(bot, path, time.time() + limiter.newcomer_period * 2, budget=0)
+    assert snapshot.restore_complete is False
+    assert snapshot.restored['newcomers'] == 0
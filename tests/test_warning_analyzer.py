@@ -0,0 +1,73 @@
+import random
+import re
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def analyzer(bot):
+    return bot.WarningAnalyzer()
+
+
+def reference_violations(analyzer, text):
+    """Типы нарушений по отдельному поиску каждого шаблона и слова (как до объединения шаблонов)"""
+    lowered = text.lower()
+    found = set()
+    for violation_type, terms in analyzer.builtin_lexicon.items():
+        if any(term in lowered for term in terms):
+            found.add(violation_type)
+    for violation_type, patterns in analyzer.violation_patterns.items():
+        if any(re.search(pattern, lowered) for pattern in patterns):
+            found.add(violation_type)
+    return [violation_type for violation_type in analyzer.violation_patterns if violation_type in found]
+
+
+FRAGMENTS = [
+    "привет всем", "как дела", "сегодня созвон в пять", "спасибо", "ок",
+    "купите", "скидки", "https://example.com", "вступайте в канал", "join the channel",
+    "подписывайтесь", "быстрые деньги", "заработок",
+    "сука", "блять", "лох", "мудак",
+    "идиот", "заткнись", "говно", "тупой",
+    "аааааааааа", "хахахахахахаха", "!!!!!!!!!!",
+]
+
+
+def corpus(count, seed=1):
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        words = [rnd.choice(FRAGMENTS) for _ in range(rnd.randint(1, 5))]
+        # Вставка фрагмента внутрь другого дает пересекающиеся совпадения разных типов
+        if rnd.random() < 0.3 and len(words) > 1:
+            first, second = words[0], words[1]
+            cut = rnd.randint(0, len(first))
+            words[:2] = [first[:cut] + " " + second + " " + first[cut:]]
+        messages.append(" ".join(words))
+    return messages
+
+
+def test_overlapping_types_are_reported(analyzer):
+    result = analyzer.analyze_message("вступайте сука в канал")
+    assert result["violations"] == ["spam", "obscenity"]
+    assert ("obscenity", 10, 14) in result["matches"]
+
+
+def test_matches_per_pattern_loop(analyzer):
+    for text in corpus(5000):
+        assert analyzer.analyze_message(text)["violations"] == reference_violations(analyzer, text), text
+
+
+def test_match_spans_point_at_text(analyzer):
+    text = "Купите скидки! заткнись, идиот"
+    for violation_type, start, end in analyzer.analyze_message(text)["matches"]:
+        assert violation_type in ("spam", "rudeness")
+        assert 0 <= start < end <= len(text)
+    assert analyzer.analyze_message("обычный текст")["matches"] == []
+
+
+def test_lexicon_phrase_matches_across_line_break(bot):
+    analyzer = bot.WarningAnalyzer()
+    phrase = bot.normalize_lexicon_term("Заработок  в\tинтернете")
+    analyzer.load_lexicon([(phrase, "spam")])
+    result = analyzer.analyze_message("Заработок в\nинтернете, пишите")
+    assert ("spam", 0, len(phrase)) in result["matches"]